@@ -7,7 +7,7 @@ Help()
     echo "                     either by itself or with previously run data."
     echo
     echo "Usage: freyja-pipeline.sh -i INPUT_DIRECTORY -o OUTPUT_DIRECTORY -d DEMIX_FILE_DIRECTORY -r REFERENCE -m MASTER_FILE -b BARCODE_FILE -s SUBLINEAGE_MAP"
-    echo "Optional arguments [-p FILE_PATTERN | --byWeek | --combineAll | -h]"
+    echo "Optional arguments [-p FILE_PATTERN | -j JOBS | --byDate | --byWeek | --allGroupings | --combineAll | --cache | -h]"
     echo
     echo "Option Descriptions:"
     echo "-i | --input INPUT_DIRECTORY - [Required] Directory containing input .bam files (Must be existing)."
@@ -22,11 +22,14 @@ Help()
     echo "--filterRecombinants - Tells the pipeline to remove any recombinant variants from the mutation barcodes and classification."
     echo "--byDate - Produces data grouped by date rather than by individual samples."
     echo "--byWeek - Produces data grouped by week rather than by individual samples. (Weeks are noted as beginning on Monday)"
+    echo "--allGroupings - Produces data grouped by sample, by date, and by week (in the by-sample, by-date, and by-week subdirectories of the output directory)."
     echo "--combineAll - Produces a combined file where lineage abundances from all sites are averaged together for each day/week."
+    echo "-j | --jobs JOBS - The number of processes to use when parsing .demix files [Default = 1]."
+    echo "--cache - Caches the parsed .demix files and barcodes in the output directory so that later runs with the same output directory only parse new or changed files. (Lineages are still collapsed and grouped from every sample on each run)"
     echo
 }
 
-OPTIONS=$(getopt -o i:o:d:r:m:b:c:p:h -l input:,output:,demixDir:,reference:,masterfile:,barcode:,collapse:,removeFromFile:,s_gene,filterRecombinants,byDate,byWeek,combineAll,help -a -- "$@")
+OPTIONS=$(getopt -o i:o:d:r:m:b:c:p:j:h -l input:,output:,demixDir:,reference:,masterfile:,barcode:,collapse:,removeFromFile:,jobs:,s_gene,filterRecombinants,byDate,byWeek,allGroupings,combineAll,cache,help -a -- "$@")
 if [ $? -ne 0 ]
 then
     echo ""
@@ -48,6 +51,9 @@ FILTERRECOMBINANTS=
 BYWEEK=
 BYDATE=
 COMBINEALL=
+ALLGROUPINGS=
+JOBS=
+CACHE=
 
 SCRIPT_DIR="$(dirname ${BASH_SOURCE})/"
 CURRENT_DIR="$(pwd)/"
@@ -87,6 +93,10 @@ while true; do
         PATTERN="--pattern $2"
         shift 2
         ;;
+    -j | --jobs )
+        JOBS="--jobs $2"
+        shift 2
+        ;;
     --s_gene )
         SGENE="--s_gene"
         shift
@@ -107,6 +117,14 @@ while true; do
         COMBINEALL="--combineAll"
         shift 
         ;;
+    --allGroupings )
+        ALLGROUPINGS="--allGroupings"
+        shift
+        ;;
+    --cache )
+        CACHE="--cache"
+        shift
+        ;;
     -h | --help )
         Help
         exit 1
@@ -237,6 +255,11 @@ then
     echo "Both the --byDate and --byWeek options have been provided. Only one can be supplied."
     echo ''
     exit 1
+elif [ -n "$ALLGROUPINGS" ] && ([ -n "$BYDATE" ] || [ -n "$BYWEEK" ])
+then
+    echo "The --allGroupings option cannot be supplied with the --byDate or --byWeek options."
+    echo ''
+    exit 1
 else
     if [ -n "$BYDATE" ] 
     then 
@@ -244,6 +267,9 @@ else
     elif [ -n "$BYWEEK" ]
     then
         BYOPTION=$BYWEEK
+    elif [ -n "$ALLGROUPINGS" ]
+    then
+        BYOPTION=$ALLGROUPINGS
     fi
 fi
 
@@ -265,6 +291,14 @@ fi
 
 BARCODEOPT=''
 BARCODE_DIR=$OUTDIR"barcodes-and-collapse/"
+
+# If the cache option was supplied, the parsed barcodes are cached so that
+# barcode files which were already parsed by a previous run are not parsed again.
+BARCODECACHE=''
+if [ -n "$CACHE" ]
+then
+    BARCODECACHE="--barcodeCacheDir ${BARCODE_DIR}barcode-cache/"
+fi
 if [ -z "$BARCODE" ]
 then
     echo "No barcode file provided. Updated barcodes will be created using Freyja"
@@ -276,7 +310,7 @@ then
         mkdir $BARCODE_DIR
     fi
     
-    python3 $SCRIPT_DIR"scripts/update_barcodes_and_collapse.py" -o $BARCODE_DIR -c $COLLAPSE $SGENE $FILTERRECOMBINANTS
+    python3 $SCRIPT_DIR"scripts/update_barcodes_and_collapse.py" -o $BARCODE_DIR -c $COLLAPSE $SGENE $FILTERRECOMBINANTS $BARCODECACHE
 
     if [ -n "$SGENE" ]
     then 
@@ -297,7 +331,7 @@ else
     then
         mkdir $BARCODE_DIR
     fi
-    python3 $SCRIPT_DIR"scripts/update_barcodes_and_collapse.py" -i $BARCODE -o $BARCODE_DIR -c $COLLAPSE $SGENE $FILTERRECOMBINANTS
+    python3 $SCRIPT_DIR"scripts/update_barcodes_and_collapse.py" -i $BARCODE -o $BARCODE_DIR -c $COLLAPSE $SGENE $FILTERRECOMBINANTS $BARCODECACHE
 
     if [ -n "$SGENE" ]
     then 
@@ -329,5 +363,5 @@ done
 echo ''
 
 cp $FREYJA_DIR*.demix $DEMIXDIR
-echo "python3 ${SCRIPT_DIR}scripts/parse_freyja.py -i $DEMIXDIR -o $OUTDIR -s $SUBLINEAGE_MAP -m $MASTER $PATTERN $BYOPTION $COMBINEALL"
-python3 $SCRIPT_DIR"scripts/parse_freyja.py" -i $DEMIXDIR -o $OUTDIR -s $SUBLINEAGE_MAP -m $MASTER $PATTERN $BYOPTION $COMBINEALL
+echo "python3 ${SCRIPT_DIR}scripts/parse_freyja.py -i $DEMIXDIR -o $OUTDIR -s $SUBLINEAGE_MAP -m $MASTER $PATTERN $BYOPTION $COMBINEALL $JOBS $CACHE"
+python3 $SCRIPT_DIR"scripts/parse_freyja.py" -i $DEMIXDIR -o $OUTDIR -s $SUBLINEAGE_MAP -m $MASTER $PATTERN $BYOPTION $COMBINEALL $JOBS $CACHE
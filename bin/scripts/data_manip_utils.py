@@ -1,6 +1,11 @@
 import sys
 import os
 import re
+import csv
+import json
+import hashlib
+import numpy as np
+from array import array
 import pandas as pd
 from datetime import datetime as dt
 
@@ -84,15 +89,149 @@ def parseDate(d,f):
         # If the date is in the incorrect format, notify the user and exit the script.
         sys.exit("Error: Date {0} not provided in correct format".format(d))
 
+class SublineageMap(dict):
+    """ A sublineage map that behaves like the dictionary produced by
+    parseSublinMap (group name keys mapped to [groupType, lineages] values),
+    but also keeps an index used to resolve lineages to their final group
+    without scanning every group in the map.
+
+    The index contains:
+        1. An inverted lineage -> group index. When a lineage is listed under
+           multiple groups, the first group in the map wins (matching the
+           order the groups were previously scanned in).
+        2. A cache of resolved final groups, so that Sub-Group -> Parent-Group
+           chains are only followed once per name.
+        3. The parsed parent and 'Like' lineages of '_Sublineages_Like_' style
+           group names that are not listed within the map.
+
+    NOTE: The index is built when the map is created. If groups are added or
+    removed afterwards, the index is rebuilt automatically, but changes made
+    directly to a group's list of lineages require a call to buildIndex().
+    """
+
+    def __init__(self, *args, **kwargs):
+        dict.__init__(self, *args, **kwargs)
+        self.buildIndex()
+
+    def __setitem__(self, key, value):
+        dict.__setitem__(self, key, value)
+        self.buildIndex()
+
+    def __delitem__(self, key):
+        dict.__delitem__(self, key)
+        self.buildIndex()
+
+    def buildIndex(self):
+        """ Builds the inverted lineage -> group index and clears the
+        cache of resolved groups.
+
+        Parameters:
+            None
+
+        Output:
+            None
+        """
+
+        self.lineageToGroup = {}
+        self.resolvedGroups = {}
+        self.likeNames = {}
+
+        # Loops over every group (in order) and maps each lineage in
+        # the group to the group name. setdefault() is used so that
+        # the first group containing a lineage is kept.
+        for g in self.keys():
+            for lin in self[g][1]:
+                self.lineageToGroup.setdefault(lin, g)
+
+    def getGroup(self, lin):
+        """ Returns the group that directly contains a lineage (without
+        following Sub-Groups to their parents).
+
+        Parameters:
+            lin - the lineage/group name being searched
+
+        Output:
+            The name of the group containing the lineage, or None
+            if the lineage is not listed in the map.
+        """
+        return self.lineageToGroup.get(lin)
+
+    def parseLikeName(self, lin):
+        """ Splits an S-gene identical group name (formatted as
+        PARENT_Sublineages_Like_FIRSTVARIANTALPHABETICALLY) into the
+        parent and 'Like' lineages. The result is stored so that
+        each name is only split once.
+
+        Parameters:
+            lin - the group name to be parsed
+
+        Output:
+            A tuple containing the parent and 'Like' lineages, or None
+            if the name does not contain any underscores (is a lineage).
+        """
+
+        if lin not in self.likeNames:
+            splitName = lin.split("_")
+            if len(splitName) > 1:
+                self.likeNames[lin] = (splitName[0], splitName[-1])
+            else:
+                self.likeNames[lin] = None
+
+        return self.likeNames[lin]
+
+    def findGroup(self, lin):
+        """ Finds the final grouping of a lineage within the map. See
+        findLineageGroup() for a description of the cases considered.
+
+        Parameters:
+            lin - the lineage/group name being searched
+
+        Output:
+            The name of the final (Parent-Group) group, or "Unknown".
+        """
+
+        # Returns the group if this name has already been resolved.
+        if lin in self.resolvedGroups:
+            return self.resolvedGroups[lin]
+
+        # Marks the name as "Unknown" while it is being resolved. This prevents
+        # a map containing a cycle of Sub-Groups from recursing forever.
+        self.resolvedGroups[lin] = "Unknown"
+
+        group = self.getGroup(lin)
+
+        if group != None:
+            # If the group is a sub-group, we then need to find
+            # the parent of that group.
+            if self[group][0] == "Sub-Group":
+                result = self.findGroup(group)
+            else:
+                result = group
+        else:
+            # The name is not listed in the map. If it is an s-gene identical group
+            # name, the 'Like' lineage is checked first and then the parent.
+            likeName = self.parseLikeName(lin)
+            result = "Unknown"
+            if likeName != None:
+                parentLin, likeLin = likeName
+                checkLikeLin = self.findGroup(likeLin)
+                if checkLikeLin != "Unknown":
+                    result = checkLikeLin
+                else:
+                    result = self.findGroup(parentLin)
+
+        self.resolvedGroups[lin] = result
+        return result
+
 def parseSublinMap(sublinFile):
     """ Parses a sublineage map file into
-    a dictionary
+    a SublineageMap (dictionary)
 
     Parameters:
         sublinFile - the name of the sublineage map file to be opened
 
     Output:
-        A dictionary where the keys are groups name and values
+        A SublineageMap where the keys are groups name and values
         are lineages that fall within that group.
     """
 
@@ -131,9 +270,10 @@ def parseSublinMap(sublinFile):
             # the group name to the list of lineages
             sublinMap[group] = [groupType, lineages]
         
-        # Closes the file and returns the dictionary
+        # Closes the file and returns the dictionary with
+        # its lineage index built.
         f.close()
-        return sublinMap
+        return SublineageMap(sublinMap)
     else:
         # If the file does not exist, notify the user and exit.
         sys.exit("ERROR: File {0} does not exist!".format(sublinFile))
@@ -171,11 +311,10 @@ def getMutationCoords(m):
     return coord
 
 def findLineageGroup(lin, map):
-    """ A recursive method that finds the final grouping of a 
-    lineage within a sublineage map. It searches the values of the
-    key-value pairs in the dictionary until it locates the lineage. It then 
-    takes the group name and, if the group is a 'Sub-Group', calls itself again. 
-    Once the group type is 'Parent-Group', we have reached the final grouping
+    """ Finds the final grouping of a lineage within a sublineage map. It
+    looks up the group containing the lineage in the map's lineage index. It then 
+    takes the group name and, if the group is a 'Sub-Group', looks up that group's
+    parent. Once the group type is 'Parent-Group', we have reached the final grouping
     and this is returned.
 
     There are a few special cases that need to be considered:
@@ -198,110 +337,17 @@ def findLineageGroup(lin, map):
 
     Parameters:
         lin - the lineage/group name being searched
-        map - the sublineage map being traversed.
+        map - the sublineage map being traversed. If a plain dictionary is
+              provided, it is indexed as a SublineageMap first.
     """
 
-    # Create a boolean variable to denote whether
-    # the given lineage has been found yet.
-    #found = False
-
-    # Create an empty variable to store the group name.
-    group = ''
-
-    # Create an empty variable to store the group type
-    groupType = ''
-
-    # Loop over each group in the sublineage map
-    for g in map.keys():
-
-        # Check whether the lineage is found in that group
-        if lin in map[g][1]:
-            # If so, update the group variable to
-            # contain the group that the lineage
-            # was found under and the group type
-            group = g
-            groupType = map[g][0]
-
-            # Once the lineage is found, we can
-            # break from the loop to prevent unnecessary 
-            # comparisons
-            break 
-
-    # If the group is not empty, then
-    # the lineage was found
-    if group != '':
-
-        # If the group is a sub-group, we then need to find
-        # the parent of that group.
-        if groupType == "Sub-Group":
-            return findLineageGroup(group, map)
-        # If not, the group must be a 'Parent-Group', in which case,
-        # we can return the group
-        else:
-            return group
+    # Lookups are performed using the SublineageMap's inverted index. A plain
+    # dictionary (such as one built by hand) is converted first, which costs
+    # the same as a single scan of the map.
+    if not isinstance(map, SublineageMap):
+        map = SublineageMap(map)
 
-    # If the group is empty, then the lineage
-    # was not found in any of the values
-    # of the dictionary.
-    else:
-        # If the lineage is one of the sublineage map
-        # keys, then it is the final classification and
-        # should be returned
-        #if lin in map.keys():
-        #    return lin
-        # If the lineage is not one of they keys,
-        # this means that the name provided was not
-        # found within the map. 
-        # 
-        # We need to check whether it is an s-gene identical group name
-        # and if we can use any of the 
-        # lineages present in the name to classify
-        # the group.
-        #else:
-
-        # We can break a group's name apart by
-        # underscores to grab any lineages present
-        splitName = lin.split("_")
-
-        # We need to check whether we are looking at
-        # a group name vs a lineage. A lineage should not contain any
-        # underscores and should have a length of 1.
-        if len(splitName) > 1:
-            # If the split name has more than 1 value, then it
-            # is an s-gene identical group name. In the groups,
-            # the last item in the split list will be the first
-            # lineage in the list alphabetically and the first
-            # is the most recent common parent of the group. Thus,
-            # we can grab these try to find their final groups.
-            checkLikeLin = findLineageGroup(splitName[-1], map)
-            checkParentLin = findLineageGroup(splitName[0], map)
-
-            # The first lineage in the group alphabetically should be
-            # used before the parent (because a likely case
-            # is that another lineage was just added to the group
-            # and came before this lineage alphabetically)
-            if checkLikeLin != "Unknown":
-                # If a group was found for this lineage, return it.
-                return checkLikeLin
-
-            # If no lineage group was found for the first lineage
-            # alphabetically, then this lineage may have been removed
-            # from the group due to being withdraw. Thus, we should
-            # use the common parent's group
-            elif checkParentLin != "Unknown":
-                # If a group was found for the common parent, return it.
-                return checkParentLin
-
-            # Finally, if neither the first lineage alphabetically
-            # or common parent had a group in the list, return "Unknown"
-            else:
-                return "Unknown"
-            
-        # If the split name only contained 1 value, then this
-        # was likely a single lineage and is thus unknown.
-        else:
-            # Return "unknown"
-            return "Unknown"
+    return map.findGroup(lin)
 
 def collapseLineages(sample, unfiltData, cutoff, map):
     """ Collapses individual lineages into their parents based on
@@ -319,12 +365,17 @@ def collapseLineages(sample, unfiltData, cutoff, map):
         cutoff: the percent cutoff above which a lineage will
         not be collapsed
 
-        map: a pandas dataframe containing the sublineage map.
+        map: a SublineageMap (or dictionary) containing the sublineage map.
 
     Output:
         A list of lists containing collapsed lienage data. Each list
         will contain the sample name, lineage, and abundance.
     """
+    # Indexes the map once up front (if it was not already) so that each
+    # row is resolved with a single lookup.
+    if not isinstance(map, SublineageMap):
+        map = SublineageMap(map)
+
     filteredDict = {}
 
     # Loops over each row in the data and adds the entries to a new dictionary
@@ -357,6 +408,942 @@ def collapseLineages(sample, unfiltData, cutoff, map):
 
     return returnData
 
+def collapseLineageTable(unfiltData, cutoff, map):
+    """ A batch version of collapseLineages() that collapses every sample/group
+    in a long-format table at once. Rather than looping over rows in python,
+    lineages and groups are integer coded, and the abundances are summed for each
+    (sample, group) using numpy reductions.
+
+    Each consecutive run of rows with the same sample and site is collapsed
+    as one unit (the equivalent of one collapseLineages() call), and the output
+    matches calling collapseLineages() on each unit in order:
+        - Lineages with an abundance at or above the cutoff are not collapsed.
+        - Groups/lineages are reported in the order they first appear in the unit.
+        - Abundances are summed in row order.
+
+    Parameters:
+        unfiltData: a pandas dataframe containing the columns sample, lineage,
+        abundance, and site for every sample to be collapsed.
+
+        cutoff: the percent cutoff above which a lineage will
+        not be collapsed
+
+        map: a SublineageMap (or dictionary) containing the sublineage map.
+
+    Output:
+        A pandas dataframe with the columns sample, lineage, abundance, and site
+        containing the collapsed lineage data.
+    """
+    columns = ["sample", "lineage", "abundance", "site"]
+
+    # If there is no data, there is nothing to collapse.
+    if len(unfiltData.index) == 0:
+        return pd.DataFrame(columns=columns)
+
+    if not isinstance(map, SublineageMap):
+        map = SublineageMap(map)
+
+    samples = unfiltData["sample"].values
+    sites = unfiltData["site"].values
+    abundances = unfiltData["abundance"].values.astype(float)
+    positions = np.arange(len(abundances))
+
+    # Integer codes the lineages, and resolves each distinct lineage to
+    # its group only once.
+    lineageCodes, lineages = pd.factorize(unfiltData["lineage"])
+    groups = [map.findGroup(lin) for lin in lineages]
+
+    # Lineages and groups share a single set of codes (as a lineage above
+    # the cutoff may have the same name as a group), giving an array
+    # which maps a lineage's code to the code of its own name and of its group.
+    nameCodes, names = pd.factorize(np.concatenate([np.asarray(lineages, dtype=object), np.asarray(groups, dtype=object)]))
+    lineageToName = nameCodes[:len(lineages)]
+    lineageToGroup = nameCodes[len(lineages):]
+
+    # Lineages at or above the cutoff keep their own name, while the rest
+    # are collapsed into their group.
+    notCollapsed = abundances >= float(cutoff)
+    rowNames = np.where(notCollapsed, lineageToName[lineageCodes], lineageToGroup[lineageCodes])
+
+    # Each consecutive run of rows from the same sample and site is one unit.
+    newUnit = np.ones(len(abundances), dtype=bool)
+    newUnit[1:] = (samples[1:] != samples[:-1]) | (sites[1:] != sites[:-1])
+    units = np.cumsum(newUnit) - 1
+
+    # Codes each (unit, name) pair. The codes are assigned in order of first
+    # appearance, which is the order the output rows should be reported in.
+    outCodes, outKeys = pd.factorize(units * len(names) + rowNames)
+    numOut = len(outKeys)
+
+    # An uncollapsed lineage replaces whatever abundance was previously stored
+    # for that name, so rows that come before the last uncollapsed row of a
+    # given (unit, name) pair are not summed.
+    lastReplaced = np.full(numOut, -1)
+    np.maximum.at(lastReplaced, outCodes[notCollapsed], positions[notCollapsed])
+    toSum = positions >= lastReplaced[outCodes]
+
+    # Sums the abundances for each (unit, name) pair. bincount adds the values
+    # in row order, so the sums are identical to summing row by row.
+    summed = np.bincount(outCodes[toSum], weights=abundances[toSum], minlength=numOut)
+
+    # The sample is taken from the first row of each pair, and the site
+    # from the last row.
+    firstRow = np.full(numOut, len(abundances))
+    np.minimum.at(firstRow, outCodes, positions)
+    lastRow = np.full(numOut, -1)
+    np.maximum.at(lastRow, outCodes, positions)
+
+    return pd.DataFrame({
+        "sample": samples[firstRow],
+        "lineage": names[outKeys % len(names)],
+        "abundance": summed,
+        "site": sites[lastRow]
+    }, columns=columns)
+
+class LineageMatrix:
+    """ A sparse matrix of lineage abundances where rows represent lineages
+    and columns represent samples/dates/weeks. Rather than storing a list
+    containing a value for every column of every lineage, only the values
+    that were set are stored (as row index, column index, and value arrays).
+    Columns and lineages can be appended at any point.
+
+    Parameters:
+        columns: a list of column names (samples/dates/weeks) to start with.
+
+        dtype: the type used to store the values. Defaults to 'd' (64-bit float)
+        so that the values written match those provided. 'f' (32-bit float)
+        halves the memory used, at the cost of precision.
+    """
+
+    def __init__(self, columns=None, dtype='d'):
+        self.columns = []
+        self.lineages = []
+        self.lineageRows = {}
+        self.rowIndices = array('i')
+        self.colIndices = array('i')
+        self.values = array(dtype)
+
+        if columns != None:
+            self.addColumns(columns)
+
+    def addColumn(self, name):
+        """ Appends a column (sample/date/week) to the matrix.
+
+        Parameters:
+            name: the name of the column
+
+        Output:
+            The index of the new column.
+        """
+        self.columns.append(name)
+        return len(self.columns) - 1
+
+    def addColumns(self, names):
+        """ Appends a list of columns (samples/dates/weeks) to the matrix.
+
+        Parameters:
+            names: a list of column names
+
+        Output:
+            None
+        """
+        for name in names:
+            self.addColumn(name)
+
+    def addLineage(self, lin):
+        """ Appends a lineage (row) to the matrix if it is not already
+        present. Rows are written in the order the lineages were added.
+
+        Parameters:
+            lin: the lineage name
+
+        Output:
+            The index of the lineage's row.
+        """
+        if lin not in self.lineageRows:
+            self.lineageRows[lin] = len(self.lineages)
+            self.lineages.append(lin)
+
+        return self.lineageRows[lin]
+
+    def setValue(self, lin, col, value):
+        """ Sets the abundance of a lineage in a given column. If the value
+        is set more than once, the last value set is kept.
+
+        Parameters:
+            lin: the lineage name (added to the matrix if not present)
+
+            col: the index of the column
+
+            value: the abundance of the lineage
+
+        Output:
+            None
+        """
+        self.rowIndices.append(self.addLineage(lin))
+        self.colIndices.append(col)
+        self.values.append(float(value))
+
+    def iterRows(self):
+        """ A generator which yields the lineages in the matrix one at a time
+        along with a (dense) array of their values for every column. Columns where
+        a value was not set contain 0.
+
+        Parameters:
+            None
+
+        Output:
+            Yields a tuple containing the lineage name and an array of values.
+        """
+        rows = np.frombuffer(self.rowIndices, dtype=np.dtype(self.rowIndices.typecode)) if len(self.rowIndices) > 0 else np.zeros(0, dtype=int)
+        cols = np.frombuffer(self.colIndices, dtype=np.dtype(self.colIndices.typecode)) if len(self.colIndices) > 0 else np.zeros(0, dtype=int)
+        values = np.frombuffer(self.values, dtype=np.dtype(self.values.typecode)) if len(self.values) > 0 else np.zeros(0)
+
+        # Removes values that were later overwritten by keeping only the last
+        # value set for each (row, column) pair.
+        keys = rows.astype(np.int64) * max(len(self.columns), 1) + cols
+        reversedFirst = np.unique(keys[::-1], return_index=True)[1]
+        keep = np.sort(len(keys) - 1 - reversedFirst)
+
+        # Orders the remaining values by row and finds where each row starts
+        # and ends.
+        order = keep[np.argsort(rows[keep], kind="stable")]
+        bounds = np.searchsorted(rows[order], np.arange(len(self.lineages) + 1))
+
+        for r, lin in enumerate(self.lineages):
+            rowValues = np.zeros(len(self.columns))
+            entries = order[bounds[r]:bounds[r + 1]]
+            rowValues[cols[entries]] = values[entries]
+            yield lin, rowValues
+
+class BarcodeMatrix:
+    """ A matrix of lineage barcodes where rows represent lineages and columns
+    represent mutations. Because barcodes only contain 0s and 1s, each row is
+    stored as bit-packed bytes (1 bit per mutation rather than the 64 bits used by
+    a pandas dataframe), which uses ~64x less memory and allows identical barcodes
+    to be compared as bytes.
+
+    Barcodes can be read from and written to the barcode csv format, or a compact
+    binary (.npz) format which can be read without parsing any text.
+
+    Parameters:
+        bits: a 2D uint8 numpy array of the bit-packed rows (see np.packbits())
+
+        lineages: a list of the lineage names (one per row)
+
+        mutations: a list of the mutation names (one per column)
+
+        floatColumns: (optional) a list of boolean values denoting which columns
+            were written as floats (Ex: 1.0 rather than 1) in the csv the barcodes
+            were read from, so that they are written the same way. Defaults to all
+            columns.
+
+        indexName: (optional) the name of the lineage column written in the
+            header of the csv. Defaults to ''.
+    """
+
+    def __init__(self, bits, lineages, mutations, floatColumns=None, indexName=''):
+        self.bits = np.asarray(bits, dtype=np.uint8).reshape(len(lineages), (len(mutations) + 7) // 8)
+        self.lineages = np.array(lineages, dtype=object)
+        self.mutations = np.array(mutations, dtype=object)
+        self.floatColumns = np.ones(len(mutations), dtype=bool) if floatColumns is None else np.array(floatColumns, dtype=bool)
+        self.indexName = indexName
+        self.lineageRows = None
+
+    def __len__(self):
+        return len(self.lineages)
+
+    def __contains__(self, lin):
+        return lin in self.getLineageRows()
+
+    def getLineageRows(self):
+        """ Returns a dictionary linking each lineage to its row in the matrix
+        (built the first time it is needed).
+
+        Parameters:
+            None
+
+        Output:
+            A dictionary of lineage names and row indices.
+        """
+        if self.lineageRows == None:
+            self.lineageRows = {}
+            for row, lin in enumerate(self.lineages):
+                self.lineageRows.setdefault(lin, row)
+
+        return self.lineageRows
+
+    def getRows(self, rows):
+        """ Unpacks rows of the matrix into boolean values.
+
+        Parameters:
+            rows: an index, slice, or list of the rows to unpack
+
+        Output:
+            A boolean numpy array with a value for every mutation.
+        """
+        return np.unpackbits(self.bits[rows], axis=-1, count=len(self.mutations)).astype(bool)
+
+    def getMutations(self, lin):
+        """ Returns the mutation profile of a lineage (the mutations
+        which have a 1 in the lineage's barcode).
+
+        Parameters:
+            lin: the lineage name
+
+        Output:
+            A list of mutations (in the order of the columns), or None
+            if the lineage is not in the matrix.
+        """
+        row = self.getLineageRows().get(lin)
+        if row == None:
+            return None
+
+        return self.mutations[self.getRows(row)].tolist()
+
+    def selectLineages(self, rows):
+        """ Creates a matrix containing a subset of the lineages (rows).
+
+        Parameters:
+            rows: a boolean mask or list of the rows to keep
+
+        Output:
+            A new BarcodeMatrix.
+        """
+        return BarcodeMatrix(self.bits[rows], self.lineages[rows], self.mutations, self.floatColumns, self.indexName)
+
+    def selectMutations(self, cols, chunkSize=1000):
+        """ Creates a matrix containing a subset of the mutations (columns). The
+        rows are repacked in chunks, so the full matrix is never unpacked at once.
+
+        Parameters:
+            cols: a boolean mask or list of the columns to keep
+
+            chunkSize: (optional) the number of rows to repack at once.
+
+        Output:
+            A new BarcodeMatrix.
+        """
+        mutations = self.mutations[cols]
+        bits = np.zeros((len(self.lineages), (len(mutations) + 7) // 8), dtype=np.uint8)
+
+        for start in range(0, len(self.lineages), chunkSize):
+            bits[start:start + chunkSize] = np.packbits(self.getRows(slice(start, start + chunkSize))[:, cols], axis=1)
+
+        return BarcodeMatrix(bits, self.lineages, mutations, self.floatColumns[cols], self.indexName)
+
+    def renameLineages(self, lineages):
+        """ Creates a matrix containing the same barcodes under new lineage names.
+
+        Parameters:
+            lineages: a list of the new names (one per row)
+
+        Output:
+            A new BarcodeMatrix.
+        """
+        return BarcodeMatrix(self.bits, lineages, self.mutations, self.floatColumns, self.indexName)
+
+    def groupIdentical(self):
+        """ Groups the lineages which have identical barcodes. The groups are sorted
+        by barcode (in the same order as grouping a dataframe of the barcodes with
+        pandas), and the lineages within each group are kept in their original order.
+
+        Parameters:
+            None
+
+        Output:
+            A list of groups, each a list of lineage names.
+        """
+        if len(self.lineages) == 0:
+            return []
+        elif self.bits.shape[1] == 0:
+            return [self.lineages.tolist()]
+
+        # Views each packed row as a single value so that identical rows
+        # can be found with numpy.
+        rowKeys = np.ascontiguousarray(self.bits).view(np.dtype((np.void, self.bits.shape[1])))[:, 0]
+        groupIds = np.unique(rowKeys, return_inverse=True)[1].reshape(-1)
+
+        order = np.argsort(groupIds, kind="stable")
+        bounds = np.flatnonzero(np.diff(groupIds[order])) + 1
+
+        return [g.tolist() for g in np.split(self.lineages[order], bounds)]
+
+    def toDataFrame(self):
+        """ Converts the matrix into a (dense) pandas dataframe indexed by lineage.
+
+        Parameters:
+            None
+
+        Output:
+            A pandas dataframe of the barcodes.
+        """
+        df = pd.DataFrame(self.getRows(slice(None)).astype(np.int64), index=pd.Index(self.lineages, name=self.indexName or None), \
+            columns=self.mutations)
+
+        if self.floatColumns.any():
+            df = df.astype({m: float for m in self.mutations[self.floatColumns]})
+
+        return df
+
+    def writeCSV(self, outfile, chunkSize=1000):
+        """ Writes the matrix to a barcode csv. The values are formatted the same
+        as writing the barcodes with pandas.
+
+        Parameters:
+            outfile: the name of the file to be written to.
+
+            chunkSize: (optional) the number of rows to unpack at once.
+
+        Output:
+            None
+        """
+        ones = np.where(self.floatColumns, "1.0", "1").astype(object)
+        zeros = np.where(self.floatColumns, "0.0", "0").astype(object)
+
+        with open(outfile, "w", newline='') as f:
+            writer = csv.writer(f, lineterminator=os.linesep)
+            writer.writerow([self.indexName] + self.mutations.tolist())
+
+            for start in range(0, len(self.lineages), chunkSize):
+                rows = self.getRows(slice(start, start + chunkSize))
+                for lin, row in zip(self.lineages[start:start + chunkSize], rows):
+                    writer.writerow([lin] + np.where(row, ones, zeros).tolist())
+
+    def writeBinary(self, outfile):
+        """ Writes the matrix to a binary (.npz) file.
+
+        Parameters:
+            outfile: the name of the file to be written to.
+
+        Output:
+            None
+        """
+        np.savez(outfile, bits=self.bits, lineages=self.lineages.astype(str), mutations=self.mutations.astype(str), \
+            floatColumns=self.floatColumns, indexName=np.array(self.indexName))
+
+    @classmethod
+    def readBinary(cls, f):
+        """ Reads a matrix from a binary (.npz) file written by writeBinary().
+
+        Parameters:
+            f: a path to the binary file
+
+        Output:
+            A BarcodeMatrix.
+        """
+        if not os.path.exists(f):
+            sys.exit("ERROR: File {0} does not exist!".format(f))
+
+        with np.load(f, allow_pickle=False) as data:
+            return cls(data["bits"], data["lineages"].tolist(), data["mutations"].tolist(), data["floatColumns"], str(data["indexName"]))
+
+    @classmethod
+    def readCSV(cls, f, usecols=None, chunkSize=1000):
+        """ Reads a matrix from a barcode csv, where the first column contains the
+        lineage names and the remaining columns contain a 0 or 1 for each mutation.
+        The file is parsed in chunks of rows, which are packed as they are read, so the
+        dense barcodes are never held in memory at once.
+
+        Parameters:
+            f: a path to the barcode csv
+
+            usecols: (optional) a list of the columns to read (including the
+                lineage column). All columns are read by default.
+
+            chunkSize: (optional) the number of rows to parse at once.
+
+        Output:
+            A BarcodeMatrix.
+        """
+        if not os.path.exists(f):
+            sys.exit("ERROR: File {0} does not exist!".format(f))
+
+        lineages = []
+        bits = []
+        floatColumns = None
+
+        reader = pd.read_csv(f, delimiter=",", header=0, usecols=usecols, chunksize=chunkSize)
+        for chunk in reader:
+            values = chunk.iloc[:, 1:].to_numpy()
+            if not ((values == 0) | (values == 1)).all():
+                sys.exit("ERROR: Barcode file {0} contains values other than 0 and 1!".format(f))
+
+            # A column is written as floats if any of its values were floats
+            # (as pandas does when parsing the whole file).
+            chunkFloats = np.array([t.kind == "f" for t in chunk.dtypes.iloc[1:]], dtype=bool)
+            floatColumns = chunkFloats if floatColumns is None else floatColumns | chunkFloats
+
+            lineages.extend(chunk.iloc[:, 0].tolist())
+            bits.append(np.packbits(values == 1, axis=1))
+
+        # Reads the header separately if the file contains no barcodes.
+        if len(bits) == 0:
+            header = pd.read_csv(f, delimiter=",", header=0, usecols=usecols, nrows=0).columns
+            bits = [np.zeros((0, (len(header) + 6) // 8), dtype=np.uint8)]
+        else:
+            header = chunk.columns
+
+        mutations = header[1:].tolist()
+        bits = np.concatenate(bits)
+
+        return cls(bits, lineages, mutations, floatColumns, header[0])
+
+# The version of the parsed barcode cache format. Caches written with a
+# different version are ignored.
+BARCODE_CACHE_VERSION = 1
+
+def getBarcodeCacheKey(f, usecols=None):
+    """ Creates the key used to identify the cached barcodes parsed from a
+    barcode csv. The key is a SHA-256 hash of the contents of the file and the
+    columns read, so the same barcodes are found in the cache no matter where
+    the file is stored, and a changed file is never read from the cache.
+
+    Parameters:
+        f: a path to the barcode csv
+
+        usecols: (optional) a list of the columns read from the file
+
+    Output:
+        The key as a hexadecimal string.
+    """
+    sha = hashlib.sha256()
+    with open(f, "rb") as bf:
+        for block in iter(lambda: bf.read(1 << 20), b""):
+            sha.update(block)
+    sha.update(b"usecols=" + json.dumps(None if usecols is None else sorted(usecols)).encode())
+
+    return sha.hexdigest()
+
+def getBarcodeCacheFiles(cacheDir, key):
+    """ Returns the paths of the files storing cached barcodes: a .npy file containing
+    the bit-packed barcodes and a .json file containing the lineages, mutations,
+    and format of the barcodes.
+
+    Parameters:
+        cacheDir: the directory containing the cache
+
+        key: the key of the barcodes (see getBarcodeCacheKey)
+
+    Output:
+        The paths of the .npy and .json files.
+    """
+    return os.path.join(cacheDir, "barcodes-{0}.npy".format(key)), os.path.join(cacheDir, "barcodes-{0}.json".format(key))
+
+def readBarcodeCache(cacheDir, key):
+    """ Reads barcodes written by writeBarcodeCache. The barcodes are memory-mapped
+    rather than read, so only the rows that are used are loaded from the disk.
+
+    Parameters:
+        cacheDir: the directory containing the cache
+
+        key: the key of the barcodes (see getBarcodeCacheKey)
+
+    Output:
+        The cached BarcodeMatrix. None if the barcodes are not in the cache or
+        the cache cannot be read.
+    """
+    bitsFile, infoFile = getBarcodeCacheFiles(cacheDir, key)
+    if not os.path.exists(bitsFile) or not os.path.exists(infoFile):
+        return None
+
+    try:
+        with open(infoFile, "r") as f:
+            info = json.load(f)
+
+        if not isinstance(info, dict) or info.get("version") != BARCODE_CACHE_VERSION:
+            return None
+
+        # An empty file cannot be memory-mapped.
+        bits = np.load(bitsFile, mmap_mode="r" if len(info["lineages"]) > 0 else None, allow_pickle=False)
+        return BarcodeMatrix(bits, info["lineages"], info["mutations"], info["floatColumns"], info["indexName"])
+    except (ValueError, KeyError, TypeError, OSError):
+        print("WARNING: The barcode cache {0} could not be read. The barcodes will be parsed.\n".format(infoFile))
+        return None
+
+def writeBarcodeCache(cacheDir, key, barcodes):
+    """ Writes parsed barcodes to the cache so that they do not need
+    to be parsed by the next run with the same barcode file.
+
+    Parameters:
+        cacheDir: the directory containing the cache
+
+        key: the key of the barcodes (see getBarcodeCacheKey)
+
+        barcodes: the BarcodeMatrix to be cached
+
+    Output:
+        None
+    """
+    bitsFile, infoFile = getBarcodeCacheFiles(cacheDir, key)
+    info = {"version": BARCODE_CACHE_VERSION, "lineages": barcodes.lineages.tolist(), "mutations": barcodes.mutations.tolist(), \
+        "floatColumns": barcodes.floatColumns.tolist(), "indexName": barcodes.indexName}
+
+    # Writes to temporary files first so that an interrupted run does not
+    # leave a partial cache behind. The barcodes are moved into place before their
+    # information, as the cache is only read if both files exist.
+    with open(bitsFile + ".tmp", "wb") as f:
+        np.save(f, np.ascontiguousarray(barcodes.bits), allow_pickle=False)
+    with open(infoFile + ".tmp", "w") as f:
+        json.dump(info, f)
+    os.replace(bitsFile + ".tmp", bitsFile)
+    os.replace(infoFile + ".tmp", infoFile)
+
+def parseBarcodeCSV(f, usecols=None, cacheDir=None):
+    """ Parses a barcode csv into a BarcodeMatrix. If a cache directory is
+    supplied, the parsed barcodes are stored in the cache, and later calls with the
+    same file (and columns) load them from the cache instead of parsing the csv again.
+
+    Parameters:
+        f: a path to the barcode csv
+
+        usecols: (optional) a list of the columns to read (including the
+            lineage column). All columns are read by default.
+
+        cacheDir: (optional) the directory containing the cache. The
+            barcodes are not cached by default.
+
+    Output:
+        A BarcodeMatrix.
+    """
+    if cacheDir == None:
+        return BarcodeMatrix.readCSV(f, usecols)
+
+    if not os.path.exists(f):
+        sys.exit("ERROR: File {0} does not exist!".format(f))
+
+    key = getBarcodeCacheKey(f, usecols)
+    barcodes = readBarcodeCache(cacheDir, key)
+
+    if barcodes != None:
+        print("Barcodes loaded from cache {0}\n".format(getBarcodeCacheFiles(cacheDir, key)[0]))
+    else:
+        barcodes = BarcodeMatrix.readCSV(f, usecols)
+        writeBarcodeCache(cacheDir, key, barcodes)
+
+    return barcodes
+
+def parseBarcodes(f, usecols=None, cacheDir=None):
+    """ Parses a barcode file into a BarcodeMatrix. Files ending in '.npz'
+    are read as binary files written by BarcodeMatrix.writeBinary(), and
+    other files are read as barcode csvs (see parseBarcodeCSV()).
+
+    Parameters:
+        f: a path to the barcode file
+
+        usecols: (optional) a list of the columns to read (including the
+            lineage column). All columns are read by default.
+
+        cacheDir: (optional) the directory containing the cache of parsed
+            barcode csvs. The barcodes are not cached by default.
+
+    Output:
+        A BarcodeMatrix.
+    """
+    if f.endswith(".npz"):
+        barcodes = BarcodeMatrix.readBinary(f)
+        if usecols != None:
+            barcodes = barcodes.selectMutations(np.isin(barcodes.mutations, list(usecols)))
+        return barcodes
+
+    return parseBarcodeCSV(f, usecols, cacheDir)
+
+# The formats that the dataframe and lineage matrix files can be written in. 'parquet'
+# and 'feather' files are written with pyarrow.
+OUTPUT_FORMATS = ["csv", "parquet", "feather"]
+
+class ColumnarWriter:
+    """ Writes rows of data to a typed columnar (parquet or feather) file in batches,
+    so that only a single batch of rows is held in memory at once. Each batch is
+    written to the file (as a parquet row group or a feather record batch) once it
+    is full.
+
+    Categorical columns are written as dictionary-encoded columns. Every batch uses
+    the categories seen so far (in the order they first appeared), so the categories
+    of a batch always extend those of the previous batch.
+
+    The file is written to a temporary file (with a '.tmp' extension), which only
+    replaces the output file once it is closed, so a run that fails partway through
+    does not leave an unreadable file behind.
+
+    Parameters:
+        outfile: the name of the file to be written to (the format is added
+        as the file extension).
+
+        columns: a list of tuples containing the name and type of each column. The
+        type can be 'str', 'category', or 'float'.
+
+        outputFormat: the format of the file ('parquet' or 'feather').
+
+        batchRows: the number of rows to hold before writing a batch.
+    """
+
+    def __init__(self, outfile, columns, outputFormat, batchRows=100000):
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            sys.exit("ERROR: Writing {0} files requires the pyarrow package to be installed!".format(outputFormat))
+
+        self.pa = pa
+        self.batchRows = batchRows
+        self.types = [t for name, t in columns]
+
+        arrowTypes = {"str": pa.string(), "category": pa.dictionary(pa.int32(), pa.string()), "float": pa.float64()}
+        self.schema = pa.schema([(name, arrowTypes[t]) for name, t in columns])
+
+        # Stores the values of the current batch for each column, and the code
+        # of each category for the categorical columns.
+        self.values = [[] for c in columns]
+        self.categories = [{} if t == "category" else None for t in self.types]
+
+        self.path = outfile + "." + outputFormat
+        if outputFormat == "parquet":
+            self.writer = pq.ParquetWriter(self.path + ".tmp", self.schema)
+        elif outputFormat == "feather":
+            # Feather (version 2) files are arrow IPC files. Dictionary deltas allow
+            # each batch to add the categories which first appeared in it.
+            options = pa.ipc.IpcWriteOptions(compression="lz4", emit_dictionary_deltas=True)
+            self.writer = pa.ipc.new_file(self.path + ".tmp", self.schema, options=options)
+        else:
+            sys.exit("ERROR: The output format {0} is not supported. Supported formats: {1}".format(outputFormat, ", ".join(OUTPUT_FORMATS)))
+
+    def writeRow(self, row):
+        """ Adds a row to the current batch, writing the batch if it is full.
+
+        Parameters:
+            row: a list containing a value for each column
+
+        Output:
+            None
+        """
+        for values, categories, value in zip(self.values, self.categories, row):
+            if categories != None:
+                value = categories.setdefault(value, len(categories))
+            values.append(value)
+
+        if len(self.values[0]) >= self.batchRows:
+            self.flush()
+
+    def flush(self):
+        """ Writes the current batch of rows to the file.
+
+        Parameters:
+            None
+
+        Output:
+            None
+        """
+        if len(self.values[0]) == 0:
+            return
+
+        pa = self.pa
+        arrays = []
+        for values, categories, field in zip(self.values, self.categories, self.schema):
+            if categories != None:
+                arrays.append(pa.DictionaryArray.from_arrays(pa.array(values, type=pa.int32()), \
+                    pa.array(list(categories.keys()), type=pa.string())))
+            else:
+                arrays.append(pa.array(values, type=field.type))
+
+        self.writer.write_batch(pa.record_batch(arrays, schema=self.schema))
+        self.values = [[] for v in self.values]
+
+    def close(self):
+        """ Writes the remaining rows, closes the file, and moves it
+        to the output file.
+
+        Parameters:
+            None
+
+        Output:
+            None
+        """
+        self.flush()
+        self.writer.close()
+        os.replace(self.path + ".tmp", self.path)
+
+    def discard(self):
+        """ Closes and removes the temporary file without writing the output file.
+
+        Parameters:
+            None
+
+        Output:
+            None
+        """
+        self.writer.close()
+        os.remove(self.path + ".tmp")
+
+class DataFrameWriter:
+    """ Writes rows of data into a 'dataframe'-like file as they are
+    produced, rather than storing every row until the end of the run.
+    The file is opened (and the header written) when the writer is created.
+
+    The rows are written to a temporary file (with a '.tmp' extension), which only
+    replaces the output file once the writer is closed. Can be used as a context
+    manager, which closes the file on exit, or discards it if an exception was raised.
+
+    Columnar formats (parquet/feather) are written in batches of rows (see
+    ColumnarWriter) to a typed file with categorical lineage and site columns.
+
+    Parameters:
+        outfile: the name of the file to be written to.
+
+        header: the header of the dataframe to be written.
+
+        outputFormat: the format of the file (one of OUTPUT_FORMATS).
+    """
+
+    def __init__(self, outfile, header, outputFormat="csv"):
+        self.outfile = outfile
+        self.outputFormat = outputFormat
+
+        if outputFormat == "csv":
+            # Opens the temporary output file and creates it if it does not exist.
+            self.path = outfile + ".csv"
+            self.outdf = open(self.path + ".tmp", "w+")
+
+            # Writes the header to the file.
+            self.outdf.write(header)
+        else:
+            columns = header.strip("\n").split(",")
+            self.outdf = ColumnarWriter(outfile, list(zip(columns, ["str", "category", "float", "category"])), outputFormat)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        if excType == None:
+            self.close()
+        else:
+            self.discard()
+
+    def writeRows(self, data):
+        """ Writes rows of data to the file.
+
+        Parameters:
+            data: a list of lists (or a pandas dataframe) containing data to be
+            written. Each row should contain the following datapoints:
+                1. Sample/Group Name
+                2. Lineage
+                3. Abundance
+                4. Site
+
+        Output:
+            None
+        """
+        if isinstance(data, pd.DataFrame):
+            data = data.itertuples(index=False, name=None)
+
+        if self.outputFormat != "csv":
+            for d in data:
+                self.outdf.writeRow([str(d[0]), d[1], round(float(d[2]), 4), d[3]])
+            return
+
+        # Loops over each line in the data, joins the values with a 
+        # comma, and adds a newline character to the end.
+        self.outdf.writelines(["{0},{1},{2},{3}\n".format(d[0], d[1], round(float(d[2]), 4), d[3]) for d in data])
+
+    def close(self):
+        """ Closes the output file stream (writing any remaining
+        rows of a columnar file) and moves it to the output file.
+
+        Parameters:
+            None
+
+        Output:
+            None
+        """
+        self.outdf.close()
+        if self.outputFormat == "csv":
+            os.replace(self.path + ".tmp", self.path)
+
+    def discard(self):
+        """ Closes and removes the temporary file without writing
+        the output file.
+
+        Parameters:
+            None
+
+        Output:
+            None
+        """
+        if self.outputFormat == "csv":
+            self.outdf.close()
+            os.remove(self.path + ".tmp")
+        else:
+            self.outdf.discard()
+
+class CollapsedDataFrameWriter(DataFrameWriter):
+    """ A DataFrameWriter which collapses the lineages of the rows provided
+    (see collapseLineageTable) before writing them. Rows are held until a batch
+    of at least batchRows rows has been collected and are then collapsed and written
+    at once. A batch is only written between samples/groups, so rows for the same 
+    sample and site provided one after the other are always collapsed together.
+
+    Parameters:
+        outfile: the name of the file to be written to.
+
+        header: the header of the dataframe to be written.
+
+        cutoff: the abundance cutoff used when collapsing lineages.
+
+        map: the sublineage map used when collapsing lineages.
+
+        batchRows: the number of rows to collect before collapsing and writing them.
+
+        outputFormat: the format of the file (one of OUTPUT_FORMATS).
+    """
+
+    def __init__(self, outfile, header, cutoff, map, batchRows=100000, outputFormat="csv"):
+        DataFrameWriter.__init__(self, outfile, header, outputFormat)
+        self.cutoff = cutoff
+        self.map = map
+        self.batchRows = batchRows
+        self.pending = []
+
+    def writeRows(self, data):
+        """ Adds rows of data to the current batch, writing the previous batch
+        first if it is full.
+
+        Parameters:
+            data: a list of lists containing the sample/group name, lineage,
+            abundance, and site of each row.
+
+        Output:
+            None
+        """
+        data = list(data)
+        if len(data) == 0:
+            return
+
+        # Writes the full batch, unless the new rows continue the last sample/site
+        # in the batch.
+        if len(self.pending) >= self.batchRows and \
+            (self.pending[-1][0], self.pending[-1][3]) != (data[0][0], data[0][3]):
+            self.flush()
+
+        self.pending.extend(data)
+
+    def flush(self):
+        """ Collapses and writes the current batch of rows.
+
+        Parameters:
+            None
+
+        Output:
+            None
+        """
+        if len(self.pending) > 0:
+            columns = ["sample", "lineage", "abundance", "site"]
+            DataFrameWriter.writeRows(self, collapseLineageTable(pd.DataFrame(self.pending, columns=columns), self.cutoff, self.map))
+            self.pending = []
+
+    def close(self):
+        self.flush()
+        DataFrameWriter.close(self)
+
 def writeDataFrame(data, outfile, header):
     """ Writes data into a 'dataframe'-like format for
     visualization and analysis.
@@ -376,25 +1363,40 @@ def writeDataFrame(data, outfile, header):
         None
     """
     
-    # Opens the output file and creates it if it does not exist.
-    outdf = open(outfile + ".csv", "w+")
-    
-    # Writes the header to the file.
-    outdf.write(header)
-    
-    # Loops over each line in the data, joins the values with a 
-    # comma, and adds a newline character to the end.
-    for d in data:
-        sample = d[0]
-        lin = d[1]
-        abundance = round(float(d[2]), 4)
-        site = d[3]
-        outdf.write("{0},{1},{2},{3}\n".format(sample, lin, abundance, site))
-    
-    # Closes the output file stream.
-    outdf.close()
+    with DataFrameWriter(outfile, header) as writer:
+        writer.writeRows(data)
 
-def writeLineageMatrix(samples, lngAbunds, outfile):
+def getUniqueColumnNames(names):
+    """ Renames duplicate column names the same way pandas does when it
+    reads a csv file with a repeated header (the second 'S1' becomes 'S1.1',
+    the third 'S1.2', and so on, skipping names that are already used).
+
+    Parameters:
+        names: a list of column names
+
+    Output:
+        A list of unique column names in the same order.
+    """
+    # Names already in the list are skipped when renaming a duplicate.
+    existing = set(names)
+    counts = {}
+    unique = []
+    for name in names:
+        original = name
+        count = counts.get(name, 0)
+        while count > 0:
+            counts[original] = count + 1
+            name = "{0}.{1}".format(original, count)
+            if name in existing:
+                count += 1
+            else:
+                count = counts.get(name, 0)
+        unique.append(name)
+        counts[name] = count + 1
+
+    return unique
+
+def writeLineageMatrix(samples, lngAbunds, outfile, outputFormat="csv"):
     """ Formats and outputs a file in matrix style format. The 
     Columns represent samples/dates/weeks and the rows represent
     a lineages. The intersection of the column and row is the abundance
@@ -403,16 +1405,42 @@ def writeLineageMatrix(samples, lngAbunds, outfile):
     Parameters:
         samples: A list of sample names/dates/weeks to output
         
-        lngAbunds: a dictionary where lineages keys are paired with
-        lists of abundance values. The abundance values are present
-        at the same index in the list as their sample in the samples
-        list.
+        lngAbunds: a LineageMatrix (whose rows are written one at a time) or a
+        dictionary where lineages keys are paired with lists of abundance values.
+        The abundance values are present at the same index in the list as 
+        their sample in the samples list.
 
         outfile: The name of a file to write the data to.
 
+        outputFormat: the format of the file (one of OUTPUT_FORMATS). Columnar
+        formats contain a categorical 'lineage' column followed by a column for
+        each sample/date/week (see getUniqueColumnNames() for repeated samples).
+
     Output: 
         Nothing to return.
     """
+
+    # Grabs the rows of the matrix. A LineageMatrix streams its rows
+    # rather than storing them.
+    if isinstance(lngAbunds, LineageMatrix):
+        rows = lngAbunds.iterRows()
+    else:
+        rows = lngAbunds.items()
+
+    if outputFormat != "csv":
+        # Writes the rows in batches, so the matrix is never held in memory at once. A sample
+        # listed more than once would give duplicate column names (which cannot be read back), so
+        # they are renamed to match the columns pandas reads from the csv file.
+        columns = getUniqueColumnNames(["lineage"] + [str(s) for s in samples])
+        writer = ColumnarWriter(outfile, [(columns[0], "category")] + [(c, "float") for c in columns[1:]], outputFormat)
+        try:
+            for x, abunds in rows:
+                writer.writeRow([x] + [round(float(i),4) for i in abunds])
+        except BaseException:
+            writer.discard()
+            raise
+        writer.close()
+        return
     
     # Opens the output file and creates it if it does not exist.
     o = open(outfile + ".csv", "w+")
@@ -427,10 +1455,10 @@ def writeLineageMatrix(samples, lngAbunds, outfile):
     # of dates with commas.
     o.write("," + ",".join(samples) + "\n")
 
-    # Loops over the abundaces in the dicationary and writes each line joined
+    # Loops over the abundaces in the matrix and writes each line joined
     # with commas.
-    for x in lngAbunds.keys():
-        o.write(x + "," + ",".join([str(round(float(i),4)) for i in lngAbunds[x]]) + '\n')
+    for x, abunds in rows:
+        o.write(x + "," + ",".join([str(round(float(i),4)) for i in abunds]) + '\n')
 
     # Closes the output stream.
     o.close()
\ No newline at end of file
@@ -170,10 +170,13 @@ def main():
         help = '[Required] - File containing mappings to sublineages to parent lineages', \
         action = 'store', dest = 'sublin')
     parser.add_argument("-b", "--barcodes", required = True, type=str, \
-        help="[Required] - Barcode file containing mutation profiles to be searched.", \
+        help="[Required] - Barcode file containing mutation profiles to be searched. Either a .csv file or a binary barcode file (.npz)", \
         action = 'store', dest = 'barcodes')
     parser.add_argument("-o", "--outpref", required = True, type=str, \
         help="[Required] - Prefix to append to output files", action = 'store', dest="outpref")
+    parser.add_argument("--barcodeCacheDir", required = False, type=str, \
+        help="Directory to cache the parsed barcodes in. Barcode files that were already parsed (with the same contents) are loaded from the cache rather than parsed again. If not provided, the barcodes are not cached", \
+        action = 'store', dest = 'barcodeCacheDir')
 
     # Parses the arguments provided by the user
     args = parser.parse_args()
@@ -183,13 +186,20 @@ def main():
     if len(lins) == 0:
         sys.exit("ERROR: Please provide one or more lineages separated by commas")
 
-    # Reads in the sublineage map into a dictionary.
+    # Reads in the sublineage map into an indexed SublineageMap (dictionary).
     sublinMap = data_manip_utils.parseSublinMap(args.sublin)
     
-    # Parses the provided barcodes into a pandas dataframe and sets the index
-    # to the first column (containing the lineage/lineage group name)
-    barcodes = data_manip_utils.parseCSVToDF(args.barcodes, ",", True)
-    barcodes = barcodes.set_index('Unnamed: 0')
+    # Parses the barcode cache directory (if supplied)
+    barcodeCacheDir = None
+    if args.barcodeCacheDir:
+        os.makedirs(args.barcodeCacheDir, exist_ok=True)
+        barcodeCacheDir = data_manip_utils.parseDirectory(args.barcodeCacheDir)
+
+    # Parses the provided barcodes (a csv or binary barcode file) into a bit-packed
+    # barcode matrix indexed by the first column (containing the lineage/lineage group name).
+    # If a barcode cache directory was supplied, barcodes that were already parsed are loaded
+    # from the cache.
+    barcodes = data_manip_utils.parseBarcodes(args.barcodes, cacheDir=barcodeCacheDir)
 
     # Creates a text file to store complete mutation profiles and
     # unique mutations for each lineage (if multiple were supplied)
@@ -218,11 +228,11 @@ def main():
         LinsInGroup = None
 
         # Checks whether the lineage is present in the barcode file's index
-        if l in barcodes.index:
+        if l in barcodes:
             # If so, this means that the lineage is not part of any
             # s-gene identical group, and we can grab the mutation profile
             # directory.
-            mutations = list(barcodes.columns[barcodes.loc[l,:].isin([1])].values)
+            mutations = barcodes.getMutations(l)
             
             # Sets the lineage group and lineages in group variables to "None"
             LinGroup = "Unique From other Lineage in the S gene"
@@ -232,22 +242,19 @@ def main():
             # it may be part of an S gene identical group (and thus the group may be
             # listed in the index). Thus, we can check for this by using the sublineage map.
 
-            # Loops over the groups in the sublineage map
-            for g in sublinMap.keys():
-                # Checks whether the lineage is
-                # found within the group.
-                if l in sublinMap[g][1]:
-                    # If so, update the lineage group and lineages in group
-                    # variable and break from the loop to prevent unnecessary comparisons.
-                    LinGroup = g
-                    LinsInGroup = sublinMap[g][1]
-                    break
+            # Looks up the group containing the lineage in the sublineage
+            # map's index.
+            LinGroup = sublinMap.getGroup(l)
+            if LinGroup != None:
+                # If the lineage was found, grab the other lineages
+                # in the group.
+                LinsInGroup = sublinMap[LinGroup][1]
 
             # Checks whether the lineage was found in any groups and whether this 
             # group exists in the barcode file supplied.
-            if LinGroup != None and LinGroup in barcodes.index:
+            if LinGroup != None and LinGroup in barcodes:
                 # If so, grab the list of mutations for that group
-                mutations = list(barcodes.columns[barcodes.loc[LinGroup,:].isin([1])].values)
+                mutations = barcodes.getMutations(LinGroup)
             # If no group containing the lineage was found or the lineage group does not 
             # exist within the barcodes, then we cannot output any mutations. Thus, this 
             # variable is left as 'None'
@@ -0,0 +1,213 @@
+import sys
+import os
+import re
+import json
+import argparse
+import contextlib
+from data_manip_utils import parseDirectory
+from tree_utils import checkLineageExists, getParentLineage, iterSubLineages, getCommonLineageParent, \
+    checkIfRecombinant, AliasResolver, LineageLCAIndex
+from update_barcodes_and_collapse import buildLineageTree, getLineageTreeCacheKey, readLineageTreeCache, \
+    writeLineageTreeCache, LINEAGE_TREE_CACHE_FILE
+
+# The queries that can be answered and a description of each (used in the help message).
+QUERY_COMMANDS = {
+    "ancestor": "the ancestors of a lineage, from its parent up to (but not including) the root",
+    "descendants": "all sublineages of a lineage",
+    "lca": "the lowest common ancestor of two or more lineages",
+    "recombinant": "whether a lineage is a recombinant (True/False)",
+    "alias": "the fully unaliased name of a lineage (Ex: BA.5.1 -> B.1.1.529.5.1)"
+}
+
+def loadLineageTree(lineageDir, treeCacheDir, filterRecombinants):
+    """ Loads the lineage tree built by the barcode and collapse module from its
+    cache. If the cache does not exist or was built from different files, the tree
+    is built from the lineage, alias, and clade files in the directory and cached
+    so that later queries do not need to build it again.
+
+    Parameters:
+        lineageDir: the barcode and collapse module's output directory, containing
+            the lineages.txt, alias_key.json, and NSClades.json files.
+
+        treeCacheDir: the directory containing the lineage tree cache.
+
+        filterRecombinants: a boolean value denoting whether the tree was built with
+            recombinant lineages filtered.
+
+    Output:
+        A LineageTree containing SARS-CoV-2 lineages and an AliasResolver
+        built from the alias_key.json file.
+    """
+
+    inputFiles = [lineageDir + "lineages.txt", lineageDir + "alias_key.json", lineageDir + "NSClades.json"]
+    for f in inputFiles:
+        if not os.path.exists(f):
+            sys.exit("ERROR: {0} does not exist. Please supply the output directory of the barcode_and_collapse module".format(f))
+
+    aliases = AliasResolver(json.load(open(lineageDir + "alias_key.json")))
+
+    treeCacheFile = treeCacheDir + LINEAGE_TREE_CACHE_FILE
+    treeCacheKey = getLineageTreeCacheKey(inputFiles, filterRecombinants)
+
+    # The query results may be written to stdout, so any messages
+    # from loading or building the tree are sent to stderr.
+    with contextlib.redirect_stdout(sys.stderr):
+        tree = readLineageTreeCache(treeCacheFile, treeCacheKey)
+
+        if tree == None:
+            print("NOTE: No lineage tree cache matching the files in {0} was found. The tree will be built and cached in {1}\n".format(lineageDir, treeCacheFile))
+
+            lineageFile = open(lineageDir + "lineages.txt", "r")
+            lineageFile.readline()
+            nsclades = json.load(open(lineageDir + "NSClades.json"))
+
+            tree = buildLineageTree(lineageFile, aliases, nsclades, filterRecombinants)
+            lineageFile.close()
+
+            writeLineageTreeCache(treeCacheFile, treeCacheKey, tree)
+
+    return tree, aliases
+
+def answerQuery(tree, aliases, command, lins, lcaIndex=None):
+    """ Answers a single query about one or more lineages.
+
+    Parameters:
+        tree: a tree containing SARS-CoV-2 lineages
+
+        aliases: an AliasResolver (or dictionary mapping aliases to lineages)
+
+        command: the query to answer (one of the keys of QUERY_COMMANDS)
+
+        lins: a list of the lineages supplied with the query (only the first
+            lineage is used by commands other than lca)
+
+        lcaIndex: (optional) a LineageLCAIndex of the tree used to answer
+            lca queries.
+
+    Output:
+        The answer as a string. Lists of lineages are separated by commas.
+        'None' is returned when a lineage is not in the tree.
+    """
+
+    if command == "lca":
+        return getCommonLineageParent(tree, lins, lcaIndex)
+
+    lin = lins[0]
+
+    if command == "recombinant":
+        return str(checkIfRecombinant(lin, aliases))
+    elif command == "alias":
+        return aliases.dealias(lin)
+
+    if not checkLineageExists(tree, lin):
+        return "None"
+
+    if command == "ancestor":
+        # Climbs the tree from the lineage's parent to the root.
+        ancestors = []
+        parent = getParentLineage(tree, lin)
+        while parent != None and parent != "root":
+            ancestors.append(parent)
+            parent = getParentLineage(tree, parent)
+        return ",".join(ancestors)
+    elif command == "descendants":
+        return ",".join(iterSubLineages(tree, lin))
+
+def runQueries(tree, aliases, queryFile, outFile):
+    """ Answers a batch of queries and writes the answers as a tab separated
+    table (with the columns Command, Query, and Result).
+
+    Each line of the query file contains a command followed by one or more lineages
+    separated by spaces, tabs, or commas (Ex: 'lca BA.1 BA.2'). An lca query is answered
+    for all of its lineages together, while the other commands are answered (on a
+    separate line) for each lineage. Empty lines and lines beginning with '#' are skipped.
+
+    Parameters:
+        tree: a tree containing SARS-CoV-2 lineages
+
+        aliases: an AliasResolver built from the alias key
+
+        queryFile: a file containing the queries (one per line)
+
+        outFile: a file to write the answers to
+
+    Output:
+        None
+    """
+
+    outFile.write("Command\tQuery\tResult\n")
+
+    # The common ancestor index is only built if an lca query is asked.
+    lcaIndex = None
+
+    for line in queryFile:
+        line = line.strip()
+        if line == "" or line[0] == "#":
+            continue
+
+        fields = re.split(r"[\s,]+", line)
+        command = fields[0].lower()
+        lins = fields[1:]
+
+        if command not in QUERY_COMMANDS or len(lins) == 0:
+            print("WARNING: Could not parse the query '{0}'. Queries must contain one of the commands ({1}) followed by one or more lineages\n".format(line, ", ".join(QUERY_COMMANDS.keys())), file=sys.stderr)
+            outFile.write("{0}\t{1}\tNone\n".format(command, ",".join(lins)))
+            continue
+
+        # An lca query is answered for all of its lineages together, while
+        # the other commands are answered for each lineage separately.
+        if command == "lca":
+            if lcaIndex == None:
+                lcaIndex = LineageLCAIndex(tree)
+
+            outFile.write("{0}\t{1}\t{2}\n".format(command, ",".join(lins), answerQuery(tree, aliases, command, lins, lcaIndex)))
+        else:
+            for lin in lins:
+                outFile.write("{0}\t{1}\t{2}\n".format(command, lin, answerQuery(tree, aliases, command, [lin])))
+
+def main():
+    parser = argparse.ArgumentParser(usage = "Lineage Query - answers batches of ancestor, descendant, common ancestor, recombinant, and alias queries using the lineage tree built by the barcode_and_collapse module", \
+        epilog = "Commands: " + "; ".join("{0} - {1}".format(c, d) for c, d in QUERY_COMMANDS.items()))
+
+    parser.add_argument("-d", "--lineageDir", required = True, type=str, \
+        help="[Required] - The output directory of the barcode_and_collapse module (containing the lineages.txt, alias_key.json, and NSClades.json files)", \
+        action = 'store', dest = 'lineageDir')
+    parser.add_argument("-q", "--queries", required = False, type=str, \
+        help="File containing queries, one per line, each consisting of a command followed by one or more lineages (Ex: 'lca BA.1 BA.2'). Queries are read from stdin if not provided.", \
+        action = 'store', dest = 'queries', default = "-")
+    parser.add_argument("-o", "--output", required = False, type=str, \
+        help="File to write the answers to (as a tab separated table). Answers are written to stdout if not provided.", \
+        action = 'store', dest = 'output', default = "-")
+    parser.add_argument("--treeCacheDir", required = False, type=str, \
+        help = "Directory containing the lineage tree cache (the lineage directory by default). If no matching cache exists, the tree is built and cached there", \
+        action = 'store', dest = 'treeCacheDir')
+    parser.add_argument("--filterRecombinants", required=False, \
+        help = "Supply this option if the barcode_and_collapse module was run with --filterRecombinants, so that the tree built without recombinant lineages is used", \
+        action ='store_true', dest = 'noRecombinants')
+
+    args = parser.parse_args()
+
+    # Parses the lineage directory and the lineage tree cache
+    # directory (the lineage directory by default)
+    lineageDir = parseDirectory(args.lineageDir)
+    treeCacheDir = lineageDir
+    if args.treeCacheDir:
+        os.makedirs(args.treeCacheDir, exist_ok=True)
+        treeCacheDir = parseDirectory(args.treeCacheDir)
+
+    tree, aliases = loadLineageTree(lineageDir, treeCacheDir, args.noRecombinants)
+
+    # Opens the query and output files (using stdin and stdout
+    # if they were not supplied).
+    queryFile = sys.stdin if args.queries == "-" else open(args.queries, "r")
+    outFile = sys.stdout if args.output == "-" else open(args.output, "w")
+
+    runQueries(tree, aliases, queryFile, outFile)
+
+    if queryFile is not sys.stdin:
+        queryFile.close()
+    if outFile is not sys.stdout:
+        outFile.close()
+
+if __name__ == "__main__":
+    main()
\ No newline at end of file
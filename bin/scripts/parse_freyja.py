@@ -2,10 +2,21 @@ import sys
 import os
 import argparse
 import re
+import json
+import numpy as np
 import pandas as pd
 from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
 import data_manip_utils #import parseDirectory, parseDate, collapseLineages, parseCSVToDF, writeDataFrame
 
+# The name of the cache file (written to the output directory) and the version of its
+# format. Caches written with a different version are ignored.
+DEMIX_CACHE_FILE = "demix-cache.json"
+DEMIX_CACHE_VERSION = 1
+
+# The subdirectory each grouping is written to when every grouping is requested.
+GROUPING_DIRS = {"Sample": "by-sample", "Date": "by-date", "Week": "by-week"}
+
 def grabFiles(d):
     """ Gathers files matching a specific pattern from 
     a directory
@@ -111,23 +122,170 @@ def parseDemix(file):
     return lngs, abunds
 
 
-def getAverage(list):
-    """ Returns the average of a list of float values
+def readDemixCache(cacheFile):
+    """ Reads the cache of previously parsed '.demix' files written by 
+    writeDemixCache.
+
+    Parameters:
+        cacheFile: path to the cache file.
+
+    Output:
+        A dictionary pairing the path of each cached '.demix' file with a 
+        dictionary containing its size, modification time, lineages, and abundances.
+        If the cache file does not exist or cannot be read, an empty dictionary is
+        returned (and every file will be parsed).
+    """
+    if not os.path.exists(cacheFile):
+        return {}
+
+    try:
+        with open(cacheFile, "r") as f:
+            cache = json.load(f)
+    except (ValueError, OSError):
+        print("WARNING: The cache file {0} could not be read. All .demix files will be parsed.".format(cacheFile))
+        return {}
+
+    if not isinstance(cache, dict) or cache.get("version") != DEMIX_CACHE_VERSION:
+        return {}
+
+    return cache["files"]
+
+
+def writeDemixCache(cacheFile, cache):
+    """ Writes the cache of parsed '.demix' files so that they do not need to be
+    parsed again by the next run.
+
+    Parameters:
+        cacheFile: path to the cache file.
+
+        cache: a dictionary of parsed files (see readDemixCache)
+
+    Output:
+        None
+    """
+    # Writes to a temporary file first so that an interrupted run does not
+    # leave a partial cache behind.
+    with open(cacheFile + ".tmp", "w") as f:
+        json.dump({"version": DEMIX_CACHE_VERSION, "files": cache}, f)
+    os.replace(cacheFile + ".tmp", cacheFile)
+
+
+def loadDemixFiles(samples, indir, sampleToFile, jobs=1, cache=None):
+    """ Parses the '.demix' file of every sample once, so that the
+    lineages and abundances can be reused for each site, group, and
+    the 'All' site without re-reading the files.
+
+    Parameters:
+        samples: a list of sample names to be loaded
+
+        indir: the directory containing the input .demix files
+
+        sampleToFile: a dictionary pairing sample name keys to file values
+
+        jobs: the number of processes to parse the files with. If greater
+        than 1, the files are parsed across a pool of processes.
+
+        cache: a dictionary of previously parsed files (see readDemixCache). Files
+        whose size and modification time match their cached entry are not parsed
+        again. The dictionary is updated with the files loaded by this run. Entries
+        for other files are kept (so a run on a subset of the samples does not empty
+        the cache), unless the file was removed or has changed since it was cached.
+
+    Output:
+        A dictionary pairing each sample name with a tuple containing the
+        list of lineages and list of abundances parsed from its file. The
+        samples are stored in the order they were provided.
+    """
+
+    # Grabs the unique samples (a sample may be listed more than once in
+    # the masterfile) while keeping their order.
+    uniqueSamples = list(dict.fromkeys(samples))
+    files = [indir + sampleToFile[sample] + ".demix" for sample in uniqueSamples]
+
+    # Identifies the files which need to be parsed (every file if there is no cache).
+    parsed = [None] * len(files)
+    if cache != None:
+        keys = [os.path.abspath(f) for f in files]
+        stats = [os.stat(f) for f in files]
+        for i, (key, stat) in enumerate(zip(keys, stats)):
+            entry = cache.get(key)
+            if entry != None and entry["size"] == stat.st_size and entry["mtime"] == stat.st_mtime_ns:
+                parsed[i] = (entry["lineages"], entry["abundances"])
+    toParse = [i for i in range(len(files)) if parsed[i] == None]
+    parseFiles = [files[i] for i in toParse]
+
+    if jobs > 1 and len(parseFiles) > 1:
+        # Splits the files into chunks for each process. map() returns the results in 
+        # the same order as the files, so the output matches a serial run.
+        chunksize = max(1, len(parseFiles) // (jobs * 4))
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            results = list(executor.map(parseDemix, parseFiles, chunksize=chunksize))
+    else:
+        results = [parseDemix(f) for f in parseFiles]
+
+    for i, result in zip(toParse, results):
+        parsed[i] = result
+
+    # Stores the files loaded by this run in the cache, and drops the entries of
+    # any other files which were removed or changed since they were cached.
+    if cache != None:
+        for key, stat, (lngs, abunds) in zip(keys, stats, parsed):
+            cache[key] = {"size": stat.st_size, "mtime": stat.st_mtime_ns, \
+                "lineages": lngs, "abundances": abunds}
+
+        loaded = set(keys)
+        for key in list(cache.keys()):
+            if key in loaded:
+                continue
+
+            try:
+                stat = os.stat(key)
+            except OSError:
+                del cache[key]
+                continue
+
+            if cache[key]["size"] != stat.st_size or cache[key]["mtime"] != stat.st_mtime_ns:
+                del cache[key]
+
+    return dict(zip(uniqueSamples, parsed))
+
+
+def buildAbundanceTable(demixData):
+    """ Places the lineages and abundances parsed from every sample into a
+    single long-format (sparse) table, where each row contains a sample,
+    lineage, and abundance. Lineages absent from a sample have no row.
 
     Parameters:
-        list: a list of float values
+        demixData: a dictionary pairing sample names with the lineages and
+        abundances parsed from their .demix files (see loadDemixFiles)
 
     Output:
-        The average of the list of values.
+        A pandas dataframe containing the columns Sample, lineage, abundance
+        and position (the position of the lineage within the sample's file).
     """
-    floatvals = [float(x) for x in list]
-    return sum(floatvals) / len(floatvals)
+    samples = []
+    lineages = []
+    abundances = []
+    positions = []
 
+    for sample, (lngs, abunds) in demixData.items():
+        samples.extend([sample] * len(lngs))
+        lineages.extend(lngs)
+        abundances.extend([float(a) for a in abunds[:len(lngs)]])
+        positions.extend(range(len(lngs)))
 
-def parseByGroup(site, groups, groupCol, master, indir, sampleToFile, abunCutoff, sublinMap):
+    return pd.DataFrame({"Sample": samples, "lineage": lineages, \
+        "abundance": abundances, "position": positions})
+
+
+def parseByGroup(site, groups, groupCol, master, abundanceTable):
     """ Instead of parsing by samples groups the samples by either week or dates and
     calculates average abundance of lineages present in samples for those groups.
 
+    The averages for every group are calculated at once by joining the site's samples
+    in the masterfile with the abundance table and summing the abundances of
+    each (group, lineage) pair. Lineages absent from a sample count as an abundance of 0.
+
     Parameters:
         site: The wastewater site being analyzed currently
 
@@ -138,91 +296,173 @@ def parseByGroup(site, groups, groupCol, master, indir, sampleToFile, abunCutoff
 
         master: a pandas dataframe containing the data from the masterfile.
 
-        indir: the directory containing the input .demix files
+        abundanceTable: a pandas dataframe containing the lineages and abundances
+        parsed from every sample (see buildAbundanceTable)
 
-        sampleToFile: a dictionary pairing sample name keys to file values
+    Output:
+        lngAbunds: a LineageMatrix whose columns are the groups in the site. The value at a 
+        given lineage and column represents the lineage's average abundance in that group.
 
-        abunCutoff: the cutoff below which to not collapse lineages
+        unfilteredData: a list of lists containing data for groups in the site. The lists contain group
+        names, lineages, and abundances.
+    """
 
-        sublinMap: a pandas dataframe linking lineages to parent names
-        for collapsing
+    # Grabs the samples for the given site (every sample if the site is 'All')
+    # and the position of their group within the list of groups.
+    siteMaster = master
+    if (site != 'All'):
+        siteMaster = master.loc[master['Site'] == site]
+    groupIndex = {g: i for i, g in enumerate(groups)}
+    siteSamples = pd.DataFrame({"Sample": siteMaster['Sample'].values, \
+        "group": siteMaster[groupCol].map(groupIndex).values, "row": range(len(siteMaster.index))})
+    siteSamples = siteSamples.dropna(subset=["group"])
+    siteSamples["group"] = siteSamples["group"].astype(int)
+
+    # The number of samples in each group (the average is taken over every sample
+    # in the group, including those where the lineage was not found).
+    groupSizes = np.bincount(siteSamples["group"].values, minlength=len(groups))
+
+    # Joins the samples with their lineages and abundances, and orders them by group, then
+    # sample, then lineage as they appeared in the sample's file. A sample listed more than
+    # once in a group, or a lineage listed more than once in a file, is only counted once.
+    siteData = siteSamples.merge(abundanceTable, on="Sample", how="inner")
+    siteData = siteData.sort_values(["group", "row", "position"], kind="stable")
+    siteData = siteData.drop_duplicates(subset=["group", "Sample", "lineage"], keep="first")
+
+    # Integer codes the lineages (in the order they are first found) and each
+    # (group, lineage) pair.
+    lineageCodes, lineages = pd.factorize(siteData["lineage"])
+    pairCodes, pairs = pd.factorize(siteData["group"].values * len(lineages) + lineageCodes)
+
+    # Sums the abundances of each (group, lineage) pair (bincount adds the values in sample
+    # order) and divides by the number of samples in the group to get the average.
+    sums = np.bincount(pairCodes, weights=siteData["abundance"].values, minlength=len(pairs))
+    pairGroups = pairs // max(len(lineages), 1)
+    pairLineages = pairs % max(len(lineages), 1)
+    averages = sums / groupSizes[pairGroups]
+
+    # Stores the average abundance of each lineage in each group (groups where the lineage
+    # was not found are left empty and are written as 0).
+    lngAbunds = data_manip_utils.LineageMatrix(groups)
+    for ln in lineages:
+        lngAbunds.addLineage(ln)
+    for g, ln, avg in zip(pairGroups, pairLineages, averages):
+        lngAbunds.setValue(lineages[ln], g, avg)
+
+    # Creates a data entry for each group's lineages containing the group, the lineage,
+    # the average abundance, and the site.
+    unfilteredData = [[groups[g], lineages[ln], avg, site] for g, ln, avg in zip(pairGroups, pairLineages, averages)]
+
+    return lngAbunds, unfilteredData
+
+def writeGroupedOutput(grouping, sites, master, demixData, abundanceTable, outdir, abunCutoff, sublinMap, outputFormat):
+    """ Writes the lineage matrix for each site and the unfiltered and filtered
+    dataframes with the data grouped by sample, date, or week.
 
-    Output:
-        lngAbunds: a dictionary linking lineage keys to a list of abundances.
-        The list contains a spot for each sample in the site. The abundance at a 
-        given position represents the lineages abundance in the sample at that same position
-        in the list of samples.
+    Parameters:
+        grouping: how to group the data ('Sample', 'Date', or 'Week')
 
-        unfilteredData: a list of lists containing data for samples in the site. The lists contain sample
-        names, lineages, and abundances.
+        sites: a list of sites to write data for (may include 'All')
+
+        master: a pandas dataframe containing the data from the masterfile.
+
+        demixData: a dictionary pairing sample names with the lineages and
+        abundances parsed from their files (see loadDemixFiles)
+
+        abundanceTable: a pandas dataframe containing the lineages and abundances
+        parsed from every sample (see buildAbundanceTable)
+
+        outdir: the directory to write the files to.
 
-        filteredData: a list of lists containing data for the samples in the site. This data contains lineages
-        that have been collapsed into their parents. The lists contain names, lineages, and abundances.
+        abunCutoff: the abundance below which lineages are collapsed into their group.
+
+        sublinMap: the sublineage map used to collapse lineages.
+
+        outputFormat: the format of the output files.
+
+    Output:
+        None
     """
-    # Defines lists/disctionaries to store processed data.
-    lngAbunds = {}
-    unfilteredData = []
-    filteredData = []
-    for g in groups:
-
-        # For each group, grab all of the samples found for the given site and group.
-        groupSamples = []
-        if (site == 'All'):
-            groupSamples = master.loc[(master[groupCol] == g)].Sample.tolist()
-        else:
-            groupSamples = master.loc[(master[groupCol] == g) & (master['Site'] == site)].Sample.tolist()
-
-        # For every sample in the group, parse the .demix file to grab lineages and
-        # abundances present in the file. Then adds the lineage to a dictionary pairing
-        # a lineage to a list of abundances.
-        groupLngAbunds = {}
-        for sample in groupSamples:
-            lngs, abunds = parseDemix(indir + sampleToFile[sample] + ".demix")
-            sampleUnfilteredData = []
-            # Loop over every lineage found in the file.
-            for ln in lngs:
-                # If the lineage is not already in the dictionary,
-                # create a new list to store abundances for that lineage.
-                # The list will be the length of the number of samples in the group
-                # and will initially be filled with zeroes.
-                if ln not in groupLngAbunds.keys():
-                    groupLngAbunds[ln] = [0 for i in range(0, len(groupSamples))]
-
-                # Grab the list of abundances associated with the given lineage
-                # and insert the current sample's abundance. The abundance's position in
-                # this list will matcht the sample's position in the list of samples
-                # for the given group.
-                groupLngAbunds[ln][groupSamples.index(sample)] = abunds[lngs.index(ln)]
-
-        # Now loop over each lineage found for the given group, and add the average 
-        # abundance for that week to the overall list of lineages.
-        for ln in groupLngAbunds.keys():
-            # If the lineage has not been added yet, create an empty list 
-            # of the same length as the number of groups in the site. The list will be filled
-            # with zeros.
-            if ln not in lngAbunds.keys():
-                lngAbunds[ln] = [0 for i in range(0, len(groups))]
-                    
-            # Grab the list of abundances associated with the given lineage
-            # and insert the average of the groups's abundances for that lineage into
-            # the list. The average abundance's position in this list will match the group's
-            # position in the list of groups.
-            lngAbunds[ln][groups.index(g)] = getAverage(groupLngAbunds[ln])
-
-            # Create a data entry for the week's lineage and add it to the unfiltered 
-            # dataframe data. The entry containst the group, the lineage, and the average abundance
-            data = [g, ln, getAverage(groupLngAbunds[ln]), site]
-            sampleUnfilteredData.append(data)
-
-        # Once all of the average abundances have been calculated for that group, collapses
-        # the lineages and adds that to the master filtered dataframe data. 
-        # Also, appends the unfiltered data for the given sample to the master unfiltered
-        # dataframe data. 
-        collapsedlngs = data_manip_utils.collapseLineages(g, sampleUnfilteredData, abunCutoff, sublinMap)
-        filteredData = filteredData + collapsedlngs
-        unfilteredData = unfilteredData + sampleUnfilteredData
-
-    return lngAbunds, unfilteredData, filteredData
+
+    # Opens the dataframe files, which are written as each site is processed:
+    # 1. An unfiltered dataframe, where rows contain fields for a sample/week, lienage,
+    #    and abundance
+    # 2. A filtered dataframe, which contains the same data as the unfiltered dataframe 
+    #    except that the lineages have been combined into thier parent lineage.
+    # The files only replace the previous output once every site has been processed, so a run that fails
+    # partway through does not leave partial dataframes behind.
+    dfHeader = "sample,lineage,abundance,site\n"
+    with data_manip_utils.DataFrameWriter(outdir + "Unfiltered-dataframe", dfHeader, outputFormat) as unfilteredWriter, \
+        data_manip_utils.CollapsedDataFrameWriter(outdir + "Filtered-dataframe", dfHeader, \
+        abunCutoff, sublinMap, outputFormat=outputFormat) as filteredWriter:
+
+        # Loops over all of the sites identified from the masterfile and
+        # creates the datafiles for each.
+        for site in sites:
+        
+            # If the data is grouped by week or date, follow this block.
+            if grouping != "Sample":
+
+                # Grabs all of the weeks/dates associated with the given site from the masterfile.
+                # If the site is 'All', then every unique week/date found in the masterfile is
+                # added to the list of groups.
+                groups = []
+                if (site == 'All'):
+                    groups = master[grouping].drop_duplicates().values.tolist()
+                else:
+                    groups = master.loc[master['Site'] == site][grouping].drop_duplicates().values.tolist()
+            
+                # Calculate lineage abundances and dataframe data for the weeks/dates
+                lngAbunds, unfiltered = parseByGroup(site, groups, grouping, master, abundanceTable)
+
+                unfilteredWriter.writeRows(unfiltered)
+                filteredWriter.writeRows(unfiltered)
+
+                # Write the lineage matrix for the weeks/dates
+                data_manip_utils.writeLineageMatrix(groups, lngAbunds, outdir + site + "-lineageMatrix", outputFormat)
+        
+            else:
+
+                samples = []
+                # Identifies all of the sample associated with a given site.
+                # If the site is 'All', add all of the samples to the list.
+                if (site == "All"):
+                    samples = master.Sample.tolist()
+                else:
+                    samples = master.loc[master['Site'] == site].Sample.tolist()
+
+                # Creates a matrix with a column for each sample. A sample listed more
+                # than once uses the column of its first occurence.
+                lngAbunds = data_manip_utils.LineageMatrix(samples)
+                sampleColumns = {}
+                for i, s in enumerate(samples):
+                    sampleColumns.setdefault(s, i)
+
+                for s in samples:
+                    lngs, abunds = demixData[s]
+                    unfiltered = []
+
+                    # Grabs the abundance of each lineage in the file (the first
+                    # abundance listed if the lineage is listed more than once).
+                    sampleAbunds = {}
+                    for ln, a in zip(lngs, abunds):
+                        sampleAbunds.setdefault(ln, a)
+
+                    # Loop over every lineage found in the file.
+                    for ln in lngs:
+                        # Insert the sample's abundance into the lineage's row of the
+                        # matrix, in the sample's column.
+                        lngAbunds.setValue(ln, sampleColumns[s], sampleAbunds[ln])
+                
+                        data = [s, ln, sampleAbunds[ln], site]
+                        unfiltered.append(data)
+
+                    # Writes the unfiltered data for the given sample. (The filtered writer
+                    # collapses the lineages of a batch of samples at once)
+                    unfilteredWriter.writeRows(unfiltered)
+                    filteredWriter.writeRows(unfiltered)
+
+                data_manip_utils.writeLineageMatrix(samples, lngAbunds, outdir + site + "-lineageMatrix", outputFormat)
 
 def main():
 
@@ -251,21 +491,42 @@ def main():
     parser.add_argument('--byWeek', required=False, \
         help='Groups samples by week and reports average lineage abundance percentages for those weeks', \
         action ='store_true', dest='byWeek')  
+    parser.add_argument('--allGroupings', required=False, \
+        help='Outputs data grouped by sample, by date, and by week (each in its own subdirectory) from a single run', \
+        action='store_true', dest='allGroupings')
     parser.add_argument('--combineAll', required=False, \
         help='Outputs data files containing average abundances for all samples present in the input file', \
         action='store_true', dest='combineAll') 
     parser.add_argument('--abundanceThreshold', required=False, type=float, \
         help = 'Abundance Percent Threshold below which the lineage will be combined with its parent. [Default = Collapse all Lineages]', \
         action = 'store', dest='abunCutoff')
+    parser.add_argument('-j', '--jobs', required=False, type=int, default=1, \
+        help = 'Number of processes to use when parsing .demix files [Default = 1]', \
+        action = 'store', dest='jobs')
+    parser.add_argument('--cache', required=False, \
+        help = 'Stores the parsed .demix files in a cache within the output directory so that later runs only parse new or changed files. Only the parsing of the .demix files is cached; lineages are collapsed and grouped from every sample on each run', \
+        action = 'store_true', dest='cache')
+    parser.add_argument('--outputFormat', required=False, type=str, default="csv", \
+        choices=data_manip_utils.OUTPUT_FORMATS, \
+        help = 'Format of the dataframe and lineage matrix files (parquet and feather require pyarrow) [Default = csv]', \
+        action = 'store', dest='outputFormat')
 
     # Grabs arguments entered by the user.
     args = parser.parse_args()
 
+    # Checks that a valid number of processes was provided.
+    if args.jobs < 1:
+        sys.exit("ERROR: The number of jobs provided, {0}, must be 1 or greater".format(args.jobs))
+
+    # Checks that --allGroupings is not combined with a single grouping.
+    if args.allGroupings and (args.byDate or args.byWeek):
+        sys.exit("ERROR: --allGroupings cannot be combined with --byDate or --byWeek")
+
     # Parses the input and output directories.
     indir = data_manip_utils.parseDirectory(args.indir)
     outdir = data_manip_utils.parseDirectory(args.outdir)
 
-    # Reads in the sublineage map into a dictionary.
+    # Reads in the sublineage map into an indexed SublineageMap (dictionary).
     sublinMap = data_manip_utils.parseSublinMap(args.sublin)
 
     # Abundance cutoff is >100% by default meaning that every lineage
@@ -301,6 +562,10 @@ def main():
         master = master[master['Sample'].isin(sampleToFile.keys())]
     else:
         sys.exit("ERROR: File {0} does not exist!".format(args.master))
+
+    # Every grouping requires both the date and week of each sample.
+    if args.allGroupings and not set(["Date", "Week"]).issubset(master.columns):
+        sys.exit("ERROR: The masterfile must contain Date and Week columns to use --allGroupings")
     
     # Creates a list of all of the unique sites to group the data
     # by. Additinoally, if the user has specified that they want to 
@@ -308,108 +573,38 @@ def main():
     sites = master.Site.unique().tolist()
     if args.combineAll:
         sites.append("All")
-    
-    # Loops over all of the sites identified from the masterfile and
-    # creates the datafiles for each.
-    masterUnfilteredData = []
-    masterFilteredData = []
-    for site in sites:
-        
-        # Defines lists/disctionaries to store processed data.
-        lngAbunds = {}
 
-        # If the user would like the data grouped by week, follow this block.
-        if args.byWeek:
+    # Parses the .demix file of every sample in the masterfile once. Every
+    # site, group, and the 'All' site is then calculated from this data.
+    # If the user requested the cache, files parsed by a previous run are loaded
+    # from the cache rather than parsed again.
+    cache = None
+    if args.cache:
+        cache = readDemixCache(outdir + DEMIX_CACHE_FILE)
 
-            # Grabs all of the weeks associated with the given site from the masterfile.
-            # If the site is 'All', then every unique week found in the masterfile is
-            # added to the list of weeks.
-            weeks = []
-            if (site == 'All'):
-                weeks = master['Week'].drop_duplicates().values.tolist()
-            else:
-                weeks = master.loc[master['Site'] == site]['Week'].drop_duplicates().values.tolist()
-            
-            # Calculate lineage abundances and dataframe data for the weeks
-            lngAbunds, unfiltered, filtered = parseByGroup(site, weeks, 'Week', master, indir, sampleToFile, abunCutoff, sublinMap)
+    demixData = loadDemixFiles(master.Sample.tolist(), indir, sampleToFile, args.jobs, cache)
 
-            masterUnfilteredData.extend(unfiltered)
-            masterFilteredData.extend(filtered)
-            # Write the lineage matrix for the weeks
-            data_manip_utils.writeLineageMatrix(weeks, lngAbunds, outdir + site + "-lineageMatrix")
-        
-        # The user did not specify that data to be grouped by weeks. Thus,
-        # it will be grouped by individual collection dates in each site.
+    if args.cache:
+        writeDemixCache(outdir + DEMIX_CACHE_FILE, cache)
+    abundanceTable = buildAbundanceTable(demixData)
+    
+    # Writes the output files for the grouping(s) requested by the user. With
+    # --allGroupings, every grouping is written to its own subdirectory from the same
+    # parsed data (and sublineage map, so lineage groups are only resolved once).
+    if args.allGroupings:
+        for grouping in ["Sample", "Date", "Week"]:
+            groupDir = outdir + GROUPING_DIRS[grouping] + "/"
+            os.makedirs(groupDir, exist_ok=True)
+            writeGroupedOutput(grouping, sites, master, demixData, abundanceTable, \
+                groupDir, abunCutoff, sublinMap, args.outputFormat)
+    else:
+        grouping = "Sample"
+        if args.byWeek:
+            grouping = "Week"
         elif args.byDate:
-            
-            # Grabs all of the dates associated with the gven site from the masterfile.
-            # If the site is 'All', then every unique date found in the masterfile is
-            # added to the list of dates.
-            dates = []
-            if (site == 'All'):
-                dates = master['Date'].drop_duplicates().values.tolist()
-            else:
-                dates = master.loc[master['Site'] == site]['Date'].drop_duplicates().values.tolist()
-
-            # Calculate lineage abundances and dataframe data for the dates
-            lngAbunds, unfiltered, filtered = parseByGroup(site, dates, 'Date', master, indir, sampleToFile, abunCutoff, sublinMap)
-
-            masterUnfilteredData.extend(unfiltered)
-            masterFilteredData.extend(filtered)
-            # Write the lineage matrix for the dates
-            data_manip_utils.writeLineageMatrix(dates, lngAbunds, outdir + site + "-lineageMatrix")
-        
-        else:
-
-            samples = []
-            # Identifies all of the sample associated with a given site.
-            # If the site is 'All', add all of the samples to the list.
-            if (site == "All"):
-                samples = master.Sample.tolist()
-            else:
-                samples = master.loc[master['Site'] == site].Sample.tolist()
-
-            for s in samples:
-                lngs, abunds = parseDemix(indir + sampleToFile[s] + ".demix")
-                unfiltered = []
-                filtered = []
-                # Loop over every lineage found in the file.
-                for ln in lngs:
-                    # If the lineage is not already in the dictionary,
-                    # create a new list to store abundances for that lineage.
-                    # The list will be the length of the number of samples in this week
-                    # and will initially be filled with zeroes.
-                    if ln not in lngAbunds.keys():
-                        lngAbunds[ln] = [0 for i in range(0, len(samples))]
-
-                    # Grab the list of abundances associated with the given lineage
-                    # and insert the current sample's abundance. The abundance's position in
-                    # this list will match the sample's position in the list of samples
-                    # for the given week.
-                    lngAbunds[ln][samples.index(s)] = abunds[lngs.index(ln)]
-                
-                    data = [s, ln, lngAbunds[ln][samples.index(s)], site]
-                    unfiltered.append(data)
-
-                # Once all of the average abundances have been calculated for that date, collapses
-                # the lineages and adds that to the master filtered dataframe data. 
-                # Also, appends the unfiltered data for the given sample to the master unfiltered
-                # dataframe data. 
-                filtered = data_manip_utils.collapseLineages(s, unfiltered, abunCutoff, sublinMap)
-                masterFilteredData.extend(filtered)
-                masterUnfilteredData.extend(unfiltered)
-
-            data_manip_utils.writeLineageMatrix(samples, lngAbunds, outdir + site + "-lineageMatrix")
-        
-
-        # Writes the following files 
-        # 1. An unfiltered dataframe, where rows contain fields for a sample/week, lienage,
-        #    and abundance
-        # 2. A filtered dataframe, which contains the same data as the unfiltered dataframe 
-        #    except that the lineages have been combined into thier parent lineage.
-    dfHeader = "sample,lineage,abundance,site\n"
-    data_manip_utils.writeDataFrame(masterUnfilteredData, outdir + "Unfiltered-dataframe", dfHeader)
-    data_manip_utils.writeDataFrame(masterFilteredData, outdir + "Filtered-dataframe", dfHeader)
+            grouping = "Date"
+        writeGroupedOutput(grouping, sites, master, demixData, abundanceTable, \
+            outdir, abunCutoff, sublinMap, args.outputFormat)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -3,8 +3,8 @@ import os
 import argparse
 import pandas as pd
 from datetime import datetime, timedelta
-from data_manip_utils import collapseLineages, writeDataFrame, \
-    parseCSVToDF, parseDate, parseSublinMap, parseDirectory
+from data_manip_utils import DataFrameWriter, CollapsedDataFrameWriter, \
+    parseCSVToDF, parseDate, parseSublinMap, parseDirectory, LineageMatrix, OUTPUT_FORMATS
 
 def main():
     # Creates an argument parser and defines the possible arguments
@@ -31,13 +31,18 @@ def main():
     parser.add_argument("--byWeek", required=False, \
         help="Produce data grouped by week rather than by week", \
             action='store_true', dest='byWeek')
+    parser.add_argument('--outputFormat', required=False, type=str, default="csv", \
+        choices=OUTPUT_FORMATS, \
+        help = 'Format of the dataframe files (parquet and feather require pyarrow) [Default = csv]', \
+        action = 'store', dest='outputFormat')
 
     # Grabs arguments entered by the user.
     args = parser.parse_args()
 
     outdir = parseDirectory(args.outdir)
 
-    # Uses pandas to read in the metadata and sublineage map files.
+    # Uses pandas to read in the metadata file and reads the sublineage map
+    # into an indexed SublineageMap (dictionary).
     MD = parseCSVToDF(args.infile, '\t', header=True)
     sublinMap = parseSublinMap(args.sublin)
 
@@ -96,54 +101,45 @@ def main():
     # Grabs a list of all f the unique dates/weeks present in the data.
     dates = filteredMD['DateToUse'].unique().tolist()
 
-    # Defines lists/dictionaries to store processed data.
-    lngAbunds = {}
-    unfilteredData = []
-    filteredData = []
+    # Defines a matrix to store processed data.
+    lngAbunds = LineageMatrix(dates)
 
-    # Loops over the set of dates to process the data for each date
-    for d in dates:
-        
-        # Counts the number of Gisaid entries on the given date
-        samplesInDate = len(filteredMD[filteredMD['DateToUse'] == d]['Accession ID'].tolist())
-        # Grabs a list of all unique lineages from samples in the given date range
-        lngs = filteredMD[filteredMD['DateToUse'] == d]['Pango lineage'].unique().tolist()
-        dateData = []
-
-        # Loops over each of the lineages found on that date to 
-        # calculate the percent abundance.
-        for ln in lngs:
-
-            # Calculates the percent abundance by dividing the number of samples
-            # assigned that lingeage on the given date by the total number of samples
-            # collected that date.
-            lngPct = len(filteredMD[(filteredMD['Pango lineage'] == ln) & (filteredMD['DateToUse'] == d)]['Pango lineage'].tolist()) / samplesInDate
-
-            # Checks to see if the lineage has been added to the master list
-            # previously
-            if ln not in lngAbunds.keys():
-                # If not, creates a list containing 0s for each of the dates
-                # present in the data
-                lngAbunds[ln] = [0 for i in range(0, len(dates))]
-
-            # Accesses the list associated with the lineage and sets the value at the
-            # same position as the date in the dates list to the abundance.
-            lngAbunds[ln][dates.index(d)] = lngPct
-            # Adds the data to a list containing rows of data
-            dateData.append([d, ln, lngPct, "Clinical-Data"])
+    # Opens the dataframe files, which are written as each date is processed.
+    # The filtered writer collapses the lineages based on the sublineage map
+    # and cutoff specified by the user. The files only replace the previous output once every date has
+    # been processed, so a run that fails partway through does not leave partial dataframes behind.
+    dfHeader = "sample,lineage,abundance,site\n"
+    with DataFrameWriter(outdir + "Unfiltered-dataframe", dfHeader, args.outputFormat) as unfilteredWriter, \
+        CollapsedDataFrameWriter(outdir + "Filtered-dataframe", dfHeader, cutoff, sublinMap, \
+        outputFormat=args.outputFormat) as filteredWriter:
+
+        # Loops over the set of dates to process the data for each date
+        for dateIndex, d in enumerate(dates):
         
-        # Collapses the lineages for the given date based on the sublineage map
-        # and cutoff specified by the user
-        collapsedlngs = collapseLineages(d, dateData, cutoff, sublinMap)
+            # Counts the number of Gisaid entries on the given date
+            samplesInDate = len(filteredMD[filteredMD['DateToUse'] == d]['Accession ID'].tolist())
+            # Grabs a list of all unique lineages from samples in the given date range
+            lngs = filteredMD[filteredMD['DateToUse'] == d]['Pango lineage'].unique().tolist()
+            dateData = []
+
+            # Loops over each of the lineages found on that date to 
+            # calculate the percent abundance.
+            for ln in lngs:
+
+                # Calculates the percent abundance by dividing the number of samples
+                # assigned that lingeage on the given date by the total number of samples
+                # collected that date.
+                lngPct = len(filteredMD[(filteredMD['Pango lineage'] == ln) & (filteredMD['DateToUse'] == d)]['Pango lineage'].tolist()) / samplesInDate
+
+                # Sets the lineage's abundance in the date's column of the matrix (the
+                # lineage is added to the matrix if it has not been found previously).
+                lngAbunds.setValue(ln, dateIndex, lngPct)
+                # Adds the data to a list containing rows of data
+                dateData.append([d, ln, lngPct, "Clinical-Data"])
         
-        # Adds the filtered and unfiltered data to the master list
-        filteredData = filteredData + collapsedlngs
-        unfilteredData = unfilteredData + dateData
-
-    # Writes the data to dataframe files
-    dfHeader = "sample,lineage,abundance,site\n"
-    writeDataFrame(unfilteredData, outdir + "Unfiltered-dataframe", dfHeader)
-    writeDataFrame(filteredData, outdir + "Filtered-dataframe", dfHeader)
+            # Writes the data for the date to the dataframe files
+            unfilteredWriter.writeRows(dateData)
+            filteredWriter.writeRows(dateData)
 
 
 if __name__ == "__main__":
@@ -1,11 +1,787 @@
 import sys
 import os
+from array import array
+import numpy as np
+import pandas as pd
 from treelib import Node, Tree
 import urllib.request as ur
 import json
 import math
 import re
 
+class LineageTree:
+    """ A compact tree of SARS-CoV-2 lineages. Rather than storing a node
+    object per lineage (as a treelib Tree does), each lineage name is given an 
+    integer id and the tree is stored in arrays indexed by those ids: the parent,
+    depth, first child, last child, and next sibling of each lineage. Children
+    are kept in the order they were added.
+
+    For descendant queries, the lineages are also numbered in depth-first
+    (preorder) order. Because every subtree occupies a contiguous run of this
+    order, a lineage's descendants are a slice of the preorder array and checking
+    whether one lineage descends from another takes two integer comparisons. The
+    numbering is computed the first time it is needed and is reset whenever a
+    lineage is added.
+
+    The tree also has an invalid attribute, which lists any lineages that could
+    not be placed when the tree was built (see buildLineageTree()).
+
+    The tree starts with a single root node (named 'root' by default). The module
+    functions (checkLineageExists, getParentLineage, getSubLineages, iterSubLineages,
+    getLineagesInTree, and commonAncestor) accept either a LineageTree or a treelib Tree.
+
+    Parameters:
+        root: the name of the root node.
+    """
+
+    def __init__(self, root="root"):
+        self.names = []
+        self.ids = {}
+        self.parents = array('i')
+        self.depths = array('i')
+        self.firstChild = array('i')
+        self.lastChild = array('i')
+        self.nextSibling = array('i')
+
+        # Preorder numbering (see numberLineages())
+        self.preorder = None
+        self.enter = None
+        self.exit = None
+
+        self.invalid = []
+
+        self.root = self.addLineage(root, None)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, lin):
+        return lin in self.ids
+
+    def addLineage(self, lin, parent):
+        """ Adds a lineage to the tree under a given parent lineage.
+
+        Parameters:
+            lin: the lineage to be added.
+
+            parent: the parent lineage (must already exist in the tree). None
+            is only allowed for the root node.
+
+        Output:
+            The integer id of the new lineage.
+        """
+        if lin in self.ids:
+            raise ValueError("Lineage '{0}' already exists in the tree".format(lin))
+
+        parentId = -1
+        if parent != None or len(self.names) > 0:
+            if parent not in self.ids:
+                raise ValueError("Parent lineage '{0}' is not in the tree".format(parent))
+            parentId = self.ids[parent]
+
+        # Interns the lineage name and stores its links. Any previous
+        # preorder numbering no longer covers the whole tree, so it is reset.
+        self.preorder = None
+        linId = len(self.names)
+        self.ids[lin] = linId
+        self.names.append(lin)
+        self.parents.append(parentId)
+        self.depths.append(self.depths[parentId] + 1 if parentId != -1 else 0)
+        self.firstChild.append(-1)
+        self.lastChild.append(-1)
+        self.nextSibling.append(-1)
+
+        # Appends the lineage to the end of its parent's children.
+        if parentId != -1:
+            if self.firstChild[parentId] == -1:
+                self.firstChild[parentId] = linId
+            else:
+                self.nextSibling[self.lastChild[parentId]] = linId
+            self.lastChild[parentId] = linId
+
+        return linId
+
+    def moveLineage(self, lin, parent):
+        """ Moves a lineage (along with its sublineages) under a different
+        parent lineage. The lineage is placed after the parent's existing children.
+
+        Parameters:
+            lin: the lineage to be moved.
+
+            parent: the new parent lineage (must already exist in the tree and
+            must not be the lineage or one of its sublineages).
+
+        Output:
+            None
+        """
+        if lin not in self.ids or parent not in self.ids:
+            raise ValueError("Lineage '{0}' or parent lineage '{1}' is not in the tree".format(lin, parent))
+
+        linId = self.ids[lin]
+        parentId = self.ids[parent]
+
+        # Checks that the new parent is not within the lineage's own subtree.
+        ancestor = parentId
+        while ancestor != -1:
+            if ancestor == linId:
+                raise ValueError("Lineage '{0}' cannot be moved under its own sublineage '{1}'".format(lin, parent))
+            ancestor = self.parents[ancestor]
+
+        self.detachLineage(linId)
+
+        self.parents[linId] = parentId
+        if self.firstChild[parentId] == -1:
+            self.firstChild[parentId] = linId
+        else:
+            self.nextSibling[self.lastChild[parentId]] = linId
+        self.lastChild[parentId] = linId
+
+        # Updates the depth of the lineage and its sublineages.
+        stack = [linId]
+        while stack:
+            subId = stack.pop()
+            self.depths[subId] = self.depths[self.parents[subId]] + 1
+            stack.extend(self.childIds(subId))
+
+        self.preorder = None
+
+    def removeLineage(self, lin):
+        """ Removes a lineage without any sublineages from the tree.
+
+        Parameters:
+            lin: the lineage to be removed.
+
+        Output:
+            None
+        """
+        if lin not in self.ids or self.ids[lin] == self.root:
+            raise ValueError("Lineage '{0}' is not in the tree".format(lin))
+
+        linId = self.ids[lin]
+        if self.firstChild[linId] != -1:
+            raise ValueError("Lineage '{0}' still has sublineages".format(lin))
+
+        self.detachLineage(linId)
+
+        # The id is not reused, so the name is cleared to mark it
+        # as removed.
+        del self.ids[lin]
+        self.names[linId] = None
+        self.parents[linId] = -1
+
+        self.preorder = None
+
+    def detachLineage(self, linId):
+        """ Unlinks a lineage from its parent's list of children.
+
+        Parameters:
+            linId: the id of the lineage.
+
+        Output:
+            None
+        """
+        parentId = self.parents[linId]
+
+        previous = -1
+        child = self.firstChild[parentId]
+        while child != linId:
+            previous = child
+            child = self.nextSibling[child]
+
+        if previous == -1:
+            self.firstChild[parentId] = self.nextSibling[linId]
+        else:
+            self.nextSibling[previous] = self.nextSibling[linId]
+        if self.lastChild[parentId] == linId:
+            self.lastChild[parentId] = previous
+
+        self.nextSibling[linId] = -1
+
+    def sortChildren(self, lin, key):
+        """ Reorders a lineage's children.
+
+        Parameters:
+            lin: the lineage whose children are reordered.
+
+            key: a function which takes a child lineage and returns the
+            value to sort it by.
+
+        Output:
+            None
+        """
+        linId = self.ids[lin]
+        children = sorted(self.childIds(linId), key=lambda childId: key(self.names[childId]))
+        if len(children) < 2:
+            return
+
+        # Relinks the children in their new order.
+        self.firstChild[linId] = children[0]
+        for previous, child in zip(children, children[1:]):
+            self.nextSibling[previous] = child
+        self.nextSibling[children[-1]] = -1
+        self.lastChild[linId] = children[-1]
+
+        self.preorder = None
+
+    def toBytes(self):
+        """ Serializes the tree into a compact binary form which can be
+        restored with LineageTree.fromBytes(). The lineage names are stored
+        as newline separated text in depth-first order (children in the order they
+        were added, so they keep their order when restored), followed by the
+        position of each lineage's parent in that order.
+
+        Parameters:
+            None
+
+        Output:
+            A bytes object containing the tree.
+        """
+        if self.preorder == None:
+            self.numberLineages()
+
+        names = "\n".join(self.names[i] for i in self.preorder).encode("utf-8")
+        parents = array('i', [self.enter[self.parents[i]] if self.parents[i] != -1 else -1 for i in self.preorder])
+        if sys.byteorder != "little":
+            parents.byteswap()
+
+        header = array('i', [len(self.preorder), len(names)])
+        if sys.byteorder != "little":
+            header.byteswap()
+
+        return header.tobytes() + names + parents.tobytes()
+
+    @classmethod
+    def fromBytes(cls, data):
+        """ Restores a tree serialized by toBytes().
+
+        Parameters:
+            data: the bytes returned by toBytes().
+
+        Output:
+            A LineageTree. A ValueError is raised if the data is not
+            a valid tree.
+        """
+        itemSize = array('i').itemsize
+
+        header = array('i')
+        header.frombytes(data[:2 * itemSize])
+        if sys.byteorder != "little":
+            header.byteswap()
+        count, namesLength = header
+
+        names = data[2 * itemSize:2 * itemSize + namesLength].decode("utf-8").split("\n")
+        parents = array('i')
+        parents.frombytes(data[2 * itemSize + namesLength:])
+        if sys.byteorder != "little":
+            parents.byteswap()
+
+        if len(names) != count or len(parents) != count or count == 0 or parents[0] != -1:
+            raise ValueError("Invalid lineage tree data")
+
+        tree = cls(names[0])
+        for i in range(1, count):
+            tree.addLineage(names[i], names[parents[i]])
+
+        return tree
+
+    def create_node(self, tag, identifier=None, parent=None):
+        """ Adds a lineage to the tree using the same arguments as treelib's
+        Tree.create_node() (the lineage name is used as both the tag and identifier),
+        so that a LineageTree can be built by the same code as a treelib Tree.
+
+        Parameters:
+            tag: the lineage name.
+
+            identifier: the lineage name (if different from the tag).
+
+            parent: the parent lineage.
+
+        Output:
+            The integer id of the new lineage.
+        """
+        return self.addLineage(identifier if identifier != None else tag, parent)
+
+    def childIds(self, linId):
+        """ Grabs the ids of a lineage's children in the order they were added.
+
+        Parameters:
+            linId: the id of the lineage.
+
+        Output:
+            A list of the children's ids.
+        """
+        children = []
+        child = self.firstChild[linId]
+        while child != -1:
+            children.append(child)
+            child = self.nextSibling[child]
+        return children
+
+    def numberLineages(self):
+        """ Numbers the lineages in depth-first (preorder) order, with children
+        visited in the order they were added. For each lineage, enter holds its
+        position in the preorder array and exit holds the position of its last
+        descendant, so its descendants are preorder[enter + 1:exit + 1].
+
+        Parameters:
+            None
+
+        Output:
+            None (the preorder, enter, and exit arrays are stored on the tree)
+        """
+        preorder = array('i')
+        enter = array('i', [0] * len(self.names))
+        exit = array('i', [0] * len(self.names))
+
+        stack = [self.root]
+        while stack:
+            linId = stack.pop()
+            enter[linId] = len(preorder)
+            preorder.append(linId)
+            stack.extend(self.childIds(linId)[::-1])
+
+        # Walks the preorder array backwards (children before parents),
+        # adding each lineage's subtree size onto its parent's. The position
+        # of the last descendant is then the entry position plus the number
+        # of descendants.
+        sizes = array('i', [1] * len(self.names))
+        for linId in reversed(preorder):
+            exit[linId] = enter[linId] + sizes[linId] - 1
+            if self.parents[linId] != -1:
+                sizes[self.parents[linId]] += sizes[linId]
+
+        self.preorder = preorder
+        self.enter = enter
+        self.exit = exit
+
+    def isDescendant(self, lin, ancestor):
+        """ Determines whether a lineage is a descendant of another
+        lineage (a lineage is not considered a descendant of itself).
+
+        Parameters:
+            lin: the lineage which may be a descendant.
+
+            ancestor: the lineage which may be an ancestor.
+
+        Output:
+            True if lin is a descendant of ancestor, otherwise False
+            (including when either lineage is not in the tree).
+        """
+        if lin not in self.ids or ancestor not in self.ids:
+            return False
+
+        if self.preorder == None:
+            self.numberLineages()
+
+        linId = self.ids[lin]
+        ancestorId = self.ids[ancestor]
+        return self.enter[ancestorId] < self.enter[linId] <= self.exit[ancestorId]
+
+    def checkLineageExists(self, lin):
+        """ Determines whether a lineage exists in the tree.
+
+        Parameters:
+            lin: the desired lineage to be searched
+
+        Output:
+            True if the lineage is in the tree, otherwise False
+        """
+        return lin in self.ids
+
+    def getParentLineage(self, lin):
+        """ Grabs the parent lineage of a given lineage.
+
+        Parameters:
+            lin: a SARS-CoV-2 lineage
+
+        Output:
+            The parent lineage of the provided lineage. None if the lineage
+            does not exist in the tree (or is the root).
+        """
+        if lin not in self.ids:
+            return None
+
+        parentId = self.parents[self.ids[lin]]
+        return self.names[parentId] if parentId != -1 else None
+
+    def getDepth(self, lin):
+        """ Grabs the depth of a lineage (the root has a depth of 0).
+
+        Parameters:
+            lin: a SARS-CoV-2 lineage in the tree
+
+        Output:
+            The depth of the lineage.
+        """
+        return self.depths[self.ids[lin]]
+
+    def getSubLineages(self, lin):
+        """ Retrieves all of the sublineages of a given lineage. The sublineages
+        are ordered depth-first with children in the order they were added (the same
+        order as the getSubLineages function for a treelib Tree).
+
+        Parameters:
+            lin: a lineage whose sublineages are desired.
+
+        Output:
+            A list containing the lineage's sublineages. None if the lineage does
+            not exist or has no children.
+        """
+        if lin not in self.ids or self.firstChild[self.ids[lin]] == -1:
+            return None
+
+        if self.preorder == None:
+            self.numberLineages()
+
+        # The descendants directly follow the lineage in the preorder array.
+        linId = self.ids[lin]
+        return [self.names[i] for i in self.preorder[self.enter[linId] + 1:self.exit[linId] + 1]]
+
+    def iterSubLineages(self, lin, maxDepth=None, includeRoot=False):
+        """ Lazily yields the sublineages of a given lineage in the same order
+        as getSubLineages. The traversal follows the child and sibling links with an
+        explicit stack, so it does not recurse or build intermediate lists.
+
+        Parameters:
+            lin: a lineage whose sublineages are desired.
+
+            maxDepth: (optional) the number of levels below the lineage to
+            traverse (1 yields only the children). By default all levels are traversed.
+
+            includeRoot: (optional) whether to yield the lineage itself first.
+
+        Output:
+            A generator of sublineages. Nothing is yielded if the lineage
+            does not exist.
+        """
+        if lin not in self.ids:
+            return
+
+        linId = self.ids[lin]
+        if includeRoot:
+            yield lin
+        if maxDepth != None and maxDepth < 1:
+            return
+
+        # The depth a lineage can be at and still have its children visited.
+        maxParentDepth = None if maxDepth == None else self.depths[linId] + maxDepth - 1
+
+        # Each entry on the stack is the next lineage to visit at its level. When a lineage
+        # is visited, its next sibling is pushed before its first child so that the child's
+        # subtree is visited first. The lineage's own siblings are never pushed, since only
+        # its first child is placed on the stack to start.
+        stack = [self.firstChild[linId]] if self.firstChild[linId] != -1 else []
+        while stack:
+            childId = stack.pop()
+            yield self.names[childId]
+
+            if self.nextSibling[childId] != -1:
+                stack.append(self.nextSibling[childId])
+            if self.firstChild[childId] != -1 and (maxParentDepth == None or self.depths[childId] <= maxParentDepth):
+                stack.append(self.firstChild[childId])
+
+    def getLineagesInTree(self):
+        """ Grabs a list of all lineages present in the tree. The lineages are
+        ordered depth-first with children sorted by name (the same order as
+        treelib's expand_tree()).
+
+        Parameters:
+            None
+
+        Output:
+            A list containing lineages present in the tree
+        """
+        lineages = []
+        stack = [self.root]
+        while stack:
+            linId = stack.pop()
+            lineages.append(self.names[linId])
+            stack.extend(sorted(self.childIds(linId), key=lambda c: self.names[c], reverse=True))
+
+        return lineages
+
+    def commonAncestor(self, lin1, lin2):
+        """ Identifies the common parent of two lineages in the tree by climbing
+        from the deeper lineage to the depth of the other and then climbing both
+        until they meet.
+
+        Parameters:
+            lin1: one of the lineages to be compared.
+            lin2: one of the lineages to be compared.
+
+        Output:
+            The name of the common parent lineage.
+        """
+        n1 = self.ids[lin1]
+        n2 = self.ids[lin2]
+
+        while self.depths[n1] > self.depths[n2]:
+            n1 = self.parents[n1]
+        while self.depths[n2] > self.depths[n1]:
+            n2 = self.parents[n2]
+
+        while n1 != n2:
+            n1 = self.parents[n1]
+            n2 = self.parents[n2]
+
+        return self.names[n1]
+
+class LineageLCAIndex:
+    """ An index for answering lowest common ancestor (LCA) queries on a lineage
+    tree in constant time. The tree is walked once to produce an Euler tour (the
+    order nodes are visited when walking down and back up every edge), and a
+    sparse table is built over the tour storing the shallowest node within
+    every power-of-two sized window. The common ancestor of two lineages is the
+    shallowest node visited between their first appearances in the tour, which
+    can be found by comparing two overlapping windows.
+
+    The index is a snapshot of the tree at the time it is built, so it should be
+    created after the tree is finished (i.e. after buildLineageTree).
+
+    Parameters:
+        tree: a LineageTree or treelib Tree containing SARS-CoV-2 lineages.
+    """
+
+    def __init__(self, tree):
+        # Grabs the lineages in depth-first order so that every parent
+        # is seen before its children (the root is always first).
+        lineages = getLineagesInTree(tree)
+
+        self.names = lineages
+        self.ids = {lin: i for i, lin in enumerate(lineages)}
+        self.depths = array('i', [0] * len(lineages))
+
+        children = [[] for i in range(len(lineages))]
+        for i in range(1, len(lineages)):
+            parentId = self.ids[getParentLineage(tree, lineages[i])]
+            children[parentId].append(i)
+            self.depths[i] = self.depths[parentId] + 1
+
+        # Walks the tree to build the Euler tour, recording the position
+        # where each lineage first appears. A stack of [node, next child index]
+        # pairs is used in place of recursion so that deep trees do not
+        # reach Python's recursion limit.
+        euler = array('i', [0])
+        self.first = array('i', [0] * len(lineages))
+        stack = [[0, 0]]
+        while stack:
+            top = stack[-1]
+            kids = children[top[0]]
+            if top[1] < len(kids):
+                child = kids[top[1]]
+                top[1] += 1
+                self.first[child] = len(euler)
+                euler.append(child)
+                stack.append([child, 0])
+            else:
+                stack.pop()
+                if stack:
+                    euler.append(stack[-1][0])
+
+        # Builds the sparse table. Level k stores, for each position i, the
+        # shallowest node in the tour between i and i + 2^k - 1.
+        depths = self.depths
+        self.sparse = [euler]
+        half = 1
+        while 2 * half <= len(euler):
+            prev = self.sparse[-1]
+            self.sparse.append(array('i', (prev[i] if depths[prev[i]] <= depths[prev[i + half]] else prev[i + half] \
+                for i in range(len(euler) - 2 * half + 1))))
+            half *= 2
+
+    def __contains__(self, lin):
+        return lin in self.ids
+
+    def commonAncestor(self, lin1, lin2):
+        """ Identifies the common parent of two lineages in the tree.
+
+        Parameters:
+            lin1: one of the lineages to be compared.
+            lin2: one of the lineages to be compared.
+
+        Output:
+            The name of the common parent lineage.
+        """
+        left = self.first[self.ids[lin1]]
+        right = self.first[self.ids[lin2]]
+        if left > right:
+            left, right = right, left
+
+        # Compares the two (possibly overlapping) windows that
+        # together cover the range between the lineages.
+        level = (right - left + 1).bit_length() - 1
+        n1 = self.sparse[level][left]
+        n2 = self.sparse[level][right - (1 << level) + 1]
+
+        return self.names[n1] if self.depths[n1] <= self.depths[n2] else self.names[n2]
+
+    def getCommonLineageParent(self, lins):
+        """ Identifies the common parent of all lineages present in a list.
+        Lineages that are not in the tree are skipped.
+
+        Parameters:
+            lins: a list of lineages
+
+        Output:
+            The common parent of the lineages. "None" if none of
+            the lineages exist in the tree.
+        """
+        parent = "None"
+        for lin in reversed(lins):
+            if lin not in self.ids:
+                continue
+            parent = lin if parent == "None" else self.commonAncestor(lin, parent)
+
+        return parent
+
+class AliasResolver:
+    """ Resolves Pango lineage aliases using the alias_key.json dictionary
+    (mapping each alias to its unaliased lineage). Rather than searching the whole
+    dictionary for every lineage, the resolver is built once and stores:
+
+        - a reverse map from each unaliased lineage to its alias (if multiple aliases
+          share the same unaliased lineage, the last one in the file is used,
+          matching convertLongAlias())
+        - whether each alias is a sublineage of a recombinant
+
+    Results for individual lineages (recombinant checks, re-aliased names, parents,
+    and dealiased names) are cached as they are computed. A resolver can be passed
+    in place of the alias dictionary to any function in this module that takes aliases.
+
+    Parameters:
+        aliases: a dictionary mapping an alias to a given lineage
+    """
+
+    def __init__(self, aliases):
+        self.aliases = aliases
+
+        self.reverse = {}
+        self.recombinantAliases = {}
+        for alias, unaliased in aliases.items():
+            # Recombinant aliases map to a list of parent lineages,
+            # which cannot be re-aliased.
+            if type(unaliased) is str:
+                self.reverse[unaliased] = alias
+            self.recombinantAliases[alias] = unaliased != "" and unaliased[0] == "X"
+
+        self.recombinantCache = {}
+        self.realiasCache = {}
+        self.parentCache = {}
+        self.dealiasCache = {}
+
+    def isRecombinant(self, lin):
+        """ Identifies whether a lineage is a recombinant (see checkIfRecombinant()).
+
+        Parameters:
+            lin: a lineage to be checked
+
+        Output:
+            A boolean value denoting whether the lineage is
+            a recombinant.
+        """
+        if lin not in self.recombinantCache:
+            self.recombinantCache[lin] = lin[0] == "X" or self.recombinantAliases.get(lin.split(".")[0], False)
+
+        return self.recombinantCache[lin]
+
+    def realias(self, lin):
+        """ Converts a lineage to its shortest aliased form
+        (see convertLongAlias()).
+
+        Parameters:
+            lin: the lineage to be aliased
+
+        Output:
+            The aliased equivalent of the provided lineage. None if the
+            lineage could not be aliased.
+        """
+        if lin not in self.realiasCache:
+            split = lin.split(".")
+            aliasLevels = math.ceil((len(split) - 1) / 3)
+
+            if aliasLevels == 1:
+                aliasedLineage = lin
+            else:
+                pointToAlias = ((aliasLevels - 1) * 3) + 1
+                alias = self.reverse.get(".".join(split[:pointToAlias]))
+                aliasedLineage = alias + "." + ".".join(split[pointToAlias:]) if alias != None else None
+
+            self.realiasCache[lin] = aliasedLineage
+
+        return self.realiasCache[lin]
+
+    def parent(self, l):
+        """ Determines the parent of a given lineage based on the
+        lineage's name (see parseParentFromLineage()).
+
+        Parameters:
+            l: a SARS-CoV-2 lineage
+
+        Output:
+            The parent lineage name ("root" for top-level lineages and
+            "invalid" if the lineage's alias is unknown).
+        """
+        if l not in self.parentCache:
+            splitLineage = l.split(".")
+
+            if l == "B" or l =='A' or (l[0] == "X" and len(splitLineage) == 1):
+                parent = "root"
+            elif len(splitLineage) == 2:
+                alias = splitLineage[0]
+                if alias in self.aliases:
+                    dealiased = self.aliases[alias]
+                    if dealiased == "" or type(dealiased) is list:
+                        parent = alias
+                    else:
+                        parent = self.realias(dealiased)
+                else:
+                    parent = "invalid"
+            else:
+                parent = ".".join(splitLineage[:-1])
+
+            self.parentCache[l] = parent
+
+        return self.parentCache[l]
+
+    def dealias(self, lin):
+        """ Converts a lineage to its fully unaliased form
+        (Ex: BA.5.1 -> B.1.1.529.5.1). Recombinant lineages, lineages
+        with unknown aliases, and lineages that are not aliased (such as B.1)
+        are returned unchanged.
+
+        Parameters:
+            lin: the lineage to be dealiased
+
+        Output:
+            The fully unaliased lineage name.
+        """
+        if lin not in self.dealiasCache:
+            split = lin.split(".", 1)
+            unaliased = self.aliases.get(split[0], "")
+
+            if type(unaliased) is str and unaliased != "":
+                self.dealiasCache[lin] = unaliased + ("." + split[1] if len(split) > 1 else "")
+            else:
+                self.dealiasCache[lin] = lin
+
+        return self.dealiasCache[lin]
+
+def getAliasResolver(aliases):
+    """ Grabs an AliasResolver for the given aliases, building one if
+    an alias dictionary was provided.
+
+    Parameters:
+        aliases: a dictionary mapping an alias to a given lineage, or
+            an existing AliasResolver.
+
+    Output:
+        An AliasResolver for the aliases.
+    """
+    if isinstance(aliases, AliasResolver):
+        return aliases
+
+    return AliasResolver(aliases)
+
 def checkLineageExists(tree, lin):
     """ Determines whether a lineage exists in
     a given tree
@@ -19,6 +795,9 @@ def checkLineageExists(tree, lin):
         If the lineage is not found in the tree, False
     """
 
+    if isinstance(tree, LineageTree):
+        return tree.checkLineageExists(lin)
+
     # Uses the get_node method of the tree 
     # to search for a node with the id
     # matching the given lineage
@@ -42,6 +821,9 @@ def getParentLineage(tree, lin):
         in the tree. None if the provided lineage does not exist
         in the tree
     """
+
+    if isinstance(tree, LineageTree):
+        return tree.getParentLineage(lin)
     
     parent = None
     
@@ -59,9 +841,32 @@ def getParentLineage(tree, lin):
     # if the lineage existed, or None if it does not
     return parent
 
+def isDescendant(tree, lin, ancestor):
+    """ Determines whether a lineage is a descendant
+    of another lineage in a given tree.
+
+    Parameters:
+        tree: a tree containing SARS-CoV-2 lineages
+        lin: the lineage which may be a descendant
+        ancestor: the lineage which may be an ancestor
+
+    Output:
+        True if lin is a descendant of ancestor, otherwise False.
+        A lineage is not a descendant of itself, and lineages not
+        in the tree are not descendants of anything.
+    """
+
+    if isinstance(tree, LineageTree):
+        return tree.isDescendant(lin, ancestor)
+
+    if lin == ancestor or not checkLineageExists(tree, lin) or not checkLineageExists(tree, ancestor):
+        return False
+
+    return tree.is_ancestor(ancestor, lin)
+
 def getSubLineages(tree, lin):
-    """ A recursive method that retrieves
-    all of the sublineages of a given lineage.
+    """ Retrieves all of the sublineages of a given lineage
+    (see iterSubLineages).
 
     Parameters:
         tree: a tree containing SARS-CoV-2 lineages
@@ -73,57 +878,63 @@ def getSubLineages(tree, lin):
         does not exist or has no children
     """
 
-    # Creates an empty list to store the sublineages
-    subLins = []
+    if isinstance(tree, LineageTree):
+        return tree.getSubLineages(lin)
 
-    # First, checks whether the provided lineage exists
-    # within the tree.
-    if checkLineageExists(tree, lin):
+    # Collects the sublineages yielded by the traversal. If there are
+    # none (the lineage does not exist or has no children), None is returned.
+    subLins = list(iterSubLineages(tree, lin))
+    if len(subLins) == 0:
+        subLins = None
 
-        # If the lineage does exist, find its children
+    # Return the list of sublineages
+    return subLins
 
-        # Uses the get_node() to grab the 
-        # node corresponding to the provided lineage
-        # on the tree.
-        n = tree.get_node(lin)
+def iterSubLineages(tree, lin, maxDepth=None, includeRoot=False):
+    """ Lazily yields the sublineages of a given lineage, depth-first with
+    children in the order they were added.
 
-        # Uses the children() function to grab
-        # the children of the node.
-        childNodes = tree.children(n.identifier)
+    The sublineages used to be gathered recursively, building a list for every
+    lineage and copying it into its parent's list. Deep lineages (such as long
+    chains of BA.2, BA.5, or XBB sublineages) made this slow and could exceed
+    python's recursion limit. Instead, the tree is walked with an explicit stack
+    and the sublineages are yielded as they are reached.
 
-        # Because of the structure of a tree,
-        # the children method only grabs the immediate children of
-        # the node, but the complete list of sublineages also
-        # considers the sublineages of those children. 
-        # 
-        # Thus, if there are children nodes, we need to grab their sublineages as well.
-        if len(childNodes) > 0:
+    Parameters:
+        tree: a tree containing SARS-CoV-2 lineages
+        lin: a lineage whose sublineages are desired.
+        maxDepth: (optional) the number of levels below the lineage to
+            traverse (1 yields only the children). By default all levels are traversed.
+        includeRoot: (optional) whether to yield the lineage itself first.
 
-            # Loops over the child nodes.
-            for c in childNodes:
+    Output:
+        A generator of sublineages. Nothing is yielded if the lineage
+        does not exist within the tree.
+    """
 
-                # Adds the child's lineages to the list of sublineages
-                subLins.append(c.identifier)
+    if isinstance(tree, LineageTree):
+        yield from tree.iterSubLineages(lin, maxDepth, includeRoot)
+        return
 
-                # Grabs the sublineages of the child
-                cChildren = getSubLineages(tree, c.identifier)
+    if not checkLineageExists(tree, lin):
+        return
 
-                # Checks whether the sublineages of the
-                # child contains any lineages.
-                if cChildren != None:
-                    # If so, extend the list of sublineages to
-                    # include the child's sublineages
-                    subLins.extend(cChildren)
+    if includeRoot:
+        yield lin
 
-        # If there are no child nodes, set the list of sublineages
-        # to "None"
-        else:
-            subLins = None
-    else:
-        subLins = None
+    # Each entry on the stack holds a lineage and its depth below the
+    # given lineage. Children are pushed in reverse so that they are popped
+    # (and yielded) in the order they were added.
+    stack = [(lin, 0)]
+    while stack:
+        parent, depth = stack.pop()
 
-    # Return the list of sublineages
-    return subLins
+        if depth > 0:
+            yield parent
+
+        if maxDepth == None or depth < maxDepth:
+            for c in reversed(tree.children(parent)):
+                stack.append((c.identifier, depth + 1))
 
 def getLineagesInTree(tree):
     """ Grabs a list of all lineages present in a given tree
@@ -136,6 +947,9 @@ def getLineagesInTree(tree):
 
     """
 
+    if isinstance(tree, LineageTree):
+        return tree.getLineagesInTree()
+
     # Use the expand_tree function to get a list
     # of all nodes in the tree
     nodes = tree.expand_tree(mode=Tree.DEPTH)
@@ -166,6 +980,9 @@ def commonAncestor(tree, lin1, lin2):
         lin2: one of the lineages to be compared.
     """
 
+    if isinstance(tree, LineageTree):
+        return tree.commonAncestor(lin1, lin2)
+
     # Uses the get_node() method to grab
     # the tree node for the lineages provided.
     n1 = tree.get_node(lin1)
@@ -177,8 +994,11 @@ def commonAncestor(tree, lin1, lin2):
     higher = ''
 
     # Uses the depth() function to identify which
-    # node is lower down on the tree.
-    if tree.depth(n1) > tree.depth(n2):
+    # node is lower down on the tree. The depths are only
+    # computed once (depth() walks all the way up to the root).
+    d1 = tree.depth(n1)
+    d2 = tree.depth(n2)
+    if d1 > d2:
         lower = n1
         higher = n2
     else:
@@ -189,7 +1009,7 @@ def commonAncestor(tree, lin1, lin2):
     # Traverses up the parents of the lineage lower
     # down on the tree until it has the same depth as
     # the higher one.
-    while tree.depth(lower) != tree.depth(higher):
+    for i in range(abs(d1 - d2)):
         lower = tree.parent(lower.identifier)
 
     # Traverse up the parents of both lineages until
@@ -203,65 +1023,44 @@ def commonAncestor(tree, lin1, lin2):
     # common parent node.
     return lower.identifier
 
-def getCommonLineageParent(tree, lins):
+def getCommonLineageParent(tree, lins, lcaIndex=None):
     """ Identifies the common parent of
-    all lineages present in a list by recursively 
-    truncating the list until only two lineages remain.
+    all lineages present in a list by folding over the
+    list (from the last lineage to the first), finding the
+    common parent of each lineage and the parent found so far.
+    Lineages that do not exist in the tree are skipped.
 
     Parameters:
         tree: a tree containing SARS-CoV-2 lineages
         lins: a list of lineages
-        unknownLins: a list of lineages not found on the tree.
+        lcaIndex: (optional) a LineageLCAIndex built from the tree,
+            used to find the common parent of each pair in constant time.
 
     Output:
-        The common parent of the sublineages.
+        The common parent of the sublineages. "None" if none of the
+        lineages exist in the tree.
     """
 
-    parent = ''
-
-    # If there are only two lineages provided,
-    # we need to check whether one or both lineages exists in 
-    # the tree.
-    if len(lins) == 2:
-
-        # If both lineages do not exist,set the parent to None
-        if checkLineageExists(tree, lins[0]) == False and checkLineageExists(tree, lins[1]) == False:
-            parent = "None"
-        # If the first lineage does not exist, but the second does, set the parent to
-        # the second lineage
-        elif checkLineageExists(tree, lins[0]) == False and checkLineageExists(tree, lins[1]) == True:
-            parent = lins[1]
-        # If the second lineage does not exist, but the first does, set the parent to
-        # the first lineage
-        elif checkLineageExists(tree, lins[0]) == True and checkLineageExists(tree, lins[1]) == False:
-            parent = lins[0]
-        # If both lineages exist, set the parent to the common ancestor.
-        else:
-            parent = commonAncestor(tree, lins[0], lins[1])
-    
-    # If there are more than two lineages in the list.
-    else:
+    # If an index was provided, it can answer the whole query.
+    if lcaIndex != None:
+        return lcaIndex.getCommonLineageParent(lins)
 
-        # Find the common parent lineage of the list without the first value.
-        previousParent = getCommonLineageParent(tree, lins[1:])
-
-        # If both the parent of the previous two lineages was "None" and the
-        # current lineage do not exist in the tree, set the parent
-        # to "None" 
-        if checkLineageExists(tree, lins[0]) == False and previousParent == "None":
-            parent = "None"
-        # If the current lineage does not exist in the tree, and the previous parent is
-        # not "None" (it was a valid lineage), set the parent to the previous parent 
-        elif checkLineageExists(tree, lins[0]) == False and previousParent != "None":
-            parent = previousParent
-        # If the current lineage exists and the previous parent equals "None", set
-        # the parent to the current lineage
-        elif checkLineageExists(tree, lins[0]) == True and previousParent == "None":
-            parent = lins[0]
-        # Both the previous parent and the current lineage exist in the tree, so find the
-        # common parent
+    parent = "None"
+
+    for lin in reversed(lins):
+
+        # If the current lineage does not exist in the tree,
+        # the parent found so far is kept.
+        if checkLineageExists(tree, lin) == False:
+            continue
+
+        # If no valid lineage has been found yet, the current lineage
+        # becomes the parent. Otherwise, find the common parent of the current
+        # lineage and the parent found so far.
+        if parent == "None":
+            parent = lin
         else:
-            parent = commonAncestor(tree, lins[0], previousParent)
+            parent = commonAncestor(tree, lin, parent)
 
     # Return the parent lineage.
     return parent
@@ -281,6 +1080,9 @@ def checkIfRecombinant(lin, aliases):
         A boolean value denoting whether the lineage is
         a recombinant.
     """
+
+    if isinstance(aliases, AliasResolver):
+        return aliases.isRecombinant(lin)
      
     # Create a boolean value representing whether
     # a lineage is a recombinant with a default value if False.
@@ -326,6 +1128,38 @@ def checkIfRecombinant(lin, aliases):
     # Return the boolean value
     return isRecombinant
 
+def checkIfRecombinants(lins, aliases):
+    """ Identifies which lineages in a list (or pandas Series) are recombinants
+    (see checkIfRecombinant()), so that a whole column of barcode lineages can be
+    classified in a single call.
+
+    The column is factorized into its unique lineages and an integer code per row.
+    Each unique lineage is classified once by looking its alias (the first component of
+    its name) up in the alias to recombinant table of the AliasResolver, and the
+    results are gathered back onto the rows with the codes.
+
+    Parameters:
+        lins: a list or pandas Series of lineages to be checked
+        aliases: a dictionary mapping an alias to a given lineage (or an AliasResolver)
+
+    Output:
+        A numpy array of boolean values denoting whether
+        each lineage is a recombinant.
+    """
+
+    recombinantAliases = getAliasResolver(aliases).recombinantAliases
+
+    # Missing values are given a code of -1.
+    codes, uniqueLins = pd.factorize(pd.Series(lins, dtype=object))
+
+    # A lineage is a recombinant if it begins with X or its alias
+    # stands for a lineage beginning with X.
+    isRecombinant = np.fromiter((lin[:1] == "X" or recombinantAliases.get(lin.split(".", 1)[0], False) \
+        for lin in uniqueLins), dtype=bool, count=len(uniqueLins))
+
+    # Appends a False value for missing values to pick up (through the -1 code).
+    return np.append(isRecombinant, False)[codes]
+
 
 def convertLongAlias(lin, aliases):
     """ Within the alias_key file, aliases are mapped directly to their unaliased equivalents.
@@ -345,6 +1179,9 @@ def convertLongAlias(lin, aliases):
         The aliased equivalent of the provided lineage
     """
 
+    if isinstance(aliases, AliasResolver):
+        return aliases.realias(lin)
+
     # Splits the given lineage into a list at each '.' character
     split = lin.split(".")
 
@@ -405,6 +1242,9 @@ def parseParentFromLineage(l, aliases):
         The parent lineage name
     """
 
+    if isinstance(aliases, AliasResolver):
+        return aliases.parent(l)
+
     # Splits the lineage into a list of component characters
     # at the '.' characters.
     splitLineage = l.split(".")
@@ -462,118 +1302,220 @@ def parseParentFromLineage(l, aliases):
     # Return the parent.
     return parent
 
+def getInsertionOrder(tree, lineages, parents, exists=None):
+    """ Determines an order in which a list of lineages can be added to a
+    tree so that every lineage's parent is already present when it is added.
+
+    Lineages used to be added by looping over the list and moving any lineage whose
+    parent was not in the tree yet to the end of the list. That produces a series
+    of passes over the remaining lineages (each in the original list order), where
+    a lineage is added in the same pass as its parent if it comes after its parent
+    in the list, and in the following pass otherwise. This function computes the
+    pass for every lineage directly from its parent, so the lineages are returned in
+    the same order the loop would have added them, in linear time. Unlike the loop,
+    lineages whose parent can never be placed are reported rather than retried forever.
+
+    Parameters:
+        tree: a tree containing SARS-CoV-2 lineages
+        lineages: a list of lineages to be added
+        parents: a list containing the parent of each lineage
+        exists: (optional) a function which returns whether a lineage can already
+            be used as a parent (by default, whether it is in the tree)
+
+    Output:
+        A list of (lineage, parent) tuples in the order they should be added,
+        and a list of lineages that could not be placed (their parent is neither
+        in the tree nor placeable itself) in their original order.
+    """
+
+    if exists == None:
+        exists = lambda lin: checkLineageExists(tree, lin)
+
+    # The pass in which each lineage would be added (0 if it cannot be placed).
+    passes = [0] * len(lineages)
+
+    # Lineages whose parent already exists are added in the first pass. The
+    # others wait for their parent to be placed.
+    waiting = {}
+    placed = []
+    for i in range(len(lineages)):
+        if exists(parents[i]):
+            passes[i] = 1
+            placed.append(i)
+        else:
+            waiting.setdefault(parents[i], []).append(i)
+
+    # Once a lineage is placed, the lineages waiting on it can be placed as well.
+    while placed:
+        i = placed.pop()
+        for child in waiting.pop(lineages[i], []):
+            passes[child] = passes[i] if child > i else passes[i] + 1
+            placed.append(child)
+
+    # Groups the lineages by pass (keeping the list order within each pass).
+    byPass = [[] for p in range(max(passes, default=0) + 1)]
+    for i in range(len(lineages)):
+        byPass[passes[i]].append(i)
+
+    order = [(lineages[i], parents[i]) for p in byPass[1:] for i in p]
+    unplaceable = [lineages[i] for i in byPass[0]]
+
+    return order, unplaceable
+
 def addLineagesToTree(tree, lineages, aliases):
-    # Create a list to store invalid lineages (those that do not have a valid parent lineage)
-    invalid = []
+    """ Adds a list of lineages to a tree, placing each lineage under
+    the parent determined from its name.
+
+    Parameters:
+        tree: a tree containing SARS-CoV-2 lineages
+        lineages: a list of lineages to be added (in any order)
+        aliases: a dictionary mapping an alias to a given lineage (or an AliasResolver)
+
+    Output:
+        The tree and a list of invalid lineages. Invalid lineages are those without
+        a valid parent lineage (unknown aliases), followed by those whose parent
+        is valid but is not in the tree or the list (and so could not be placed).
+    """
 
-    # Loop over the list of lineages, removing those that were added to the tree or deemed invalid.
-    while len(lineages) > 0:
+    # Builds the alias lookups once for all of the lineages.
+    aliases = getAliasResolver(aliases)
 
-        # Grab the lineage at the start of the list.
-        l = lineages[0]
+    # Create a list to store invalid lineages (those that do not have a valid parent lineage)
+    invalid = []
 
-        # First, we identify the lineage's parent.
+    # First, we identify each lineage's parent. If the function returned 'invalid'
+    # as the parent, add the lineage to the list of invalid lineages.
+    toAdd = []
+    parents = []
+    for l in lineages:
         parent = parseParentFromLineage(l, aliases)
-
-        # If the function returned 'invalid' as the parent,
-        # add the lineage to the list of invalid lineages.
         if parent == "invalid":
             invalid.append(l)
-        # If the parent is valid, we then need to see if check if the parent lineage is
-        # already placed in the tree.
-        elif checkLineageExists(tree, parent) == False:
-                
-            # If the parent is not in the tree, there are two potentials:
-            # The lineage could be invalid or the parent is present in the list of lineages
-            # has not been added to the tree yet.
-
-            # If the lineage is not invalid, then the parent likely has not been added
-            # yet. So we can simply add the lineage to the end of the list and
-            # return to it later.
-            if l not in invalid:
-                lineages.append(l)
-        # If the parent lineage is already present in the tree, we 
-        # can add the lineage.
         else:
-            tree.create_node(l, l, parent)
+            toAdd.append(l)
+            parents.append(parent)
+
+    # Then, the lineages are added so that each parent is placed before its children.
+    order, unplaceable = getInsertionOrder(tree, toAdd, parents)
+    for l, parent in order:
+        tree.create_node(l, l, parent)
 
-        # Removes the lineage from the front of the list.
-        lineages.pop(0)
+    invalid.extend(unplaceable)
 
     return tree, invalid
 
 
-def addWithdrawnLineagesToTree(tree, withdrawnLines, aliases, filterRecombinants):
-    # For the withdrawn lineages, there are cases when the lineage
-    # does not have an existing parent (even among the withdrawn lineage).
-    # Instead of just removing these linages we can grab the lineage that it
-    # was reclassified as or an alias of from the description and place
-    # the withdrawn lineage under that on the tree.
-    #
+def parseWithdrawnLine(w):
+    """ Separates a withdrawn lineage line from the lineages file into the
+    lineage and its description.
+
+    Parameters:
+        w: a withdrawn lineage line (Ex: *B.1.1.7.1\tWithdrawn: ...)
+
+    Output:
+        The lineage (with the '*' character removed) and its description.
+    """
+    # Because the withdrawn lineages still have the information
+    # associated with them. We need to separate the two. As well,
+    # we need to remove the '*' character from the lineage.
+    lineage = w.split("\t")[0].replace("*", "")
+    info = w.split("\t")[1]
+
+    return lineage, info
+
+def getWithdrawnLineageParent(lineage, info, aliases, filterRecombinants, exists):
+    """ Determines where a withdrawn lineage should be placed on the tree. For the 
+    withdrawn lineages, there are cases when the lineage does not have an existing
+    parent (even among the withdrawn lineage). Instead of just removing these linages
+    we can grab the lineage that it was reclassified as or an alias of from the description
+    and place the withdrawn lineage under that on the tree.
+
+    Parameters:
+        lineage: the withdrawn lineage
+        info: the description of the withdrawn lineage
+        aliases: a dictionary mapping an alias to a given lineage (or an AliasResolver)
+        filterRecombinants: a boolean value denoting whether recombinant lineages are
+            being filtered.
+        exists: a function which returns whether a lineage is already on the tree.
+
+    Output:
+        The parent lineage. "invalid" if no parent could be found in the description,
+        and None if the lineage is a filtered recombinant.
+    """
+
     # This regex pattern matches the format of a lineage.
     lineageRegexPattern = r"(\w{1,3}(?:\.\d+)+)"
-    
+
+    # Now, we can try to grab the parent given the lineage.
+    parent = parseParentFromLineage(lineage, aliases)
+
+    # If the parent exists, the withdrawn lineage can be placed directly under it.
+    if exists(parent):
+        return parent
+
+    # If not, we can check whether a related lineage is present in the description,
+    # by searching for a match for the lineage regex pattern in the lineage information.
+    lineageResult = re.search(lineageRegexPattern, info)
+
+    # If the regex pattern did not match, the withdrawn lineage is invalid.
+    if not lineageResult:
+        return "invalid"
+
+    # If a match was found, check whether the linage in the description
+    # is already present in the tree. If so, we can use this as the parent for
+    # the withdrawn lineage.
+    if exists(lineageResult.group(1)):
+        return lineageResult.group(1)
+
+    if checkIfRecombinant(lineage, aliases) and filterRecombinants:
+        return None
+
+    # If the lineage was not found in the tree, we can find what would
+    # be the parent of that lineage and add the withdrawn lineage under that.
+    return parseParentFromLineage(lineageResult.group(1), aliases)
+
+def addWithdrawnLineagesToTree(tree, withdrawnLines, aliases, filterRecombinants):
+    """ Adds the withdrawn lineages to a tree (see getWithdrawnLineageParent()).
+
+    Parameters:
+        tree: a tree containing SARS-CoV-2 lineages
+        withdrawnLines: a list of withdrawn lineage lines from the lineages file
+        aliases: a dictionary mapping an alias to a given lineage (or an AliasResolver)
+        filterRecombinants: a boolean value denoting whether recombinant lineages should
+            be left off the tree.
+
+    Output:
+        The tree and a list of withdrawn lineages that could not be placed.
+    """
+
+    # Builds the alias lookups once for all of the lineages.
+    aliases = getAliasResolver(aliases)
+
     invalid = []
 
     # Loops over the list of withdrawn lineages
     for w in withdrawnLines:
-        # Because the withdrawn lineages still have the information
-        # associated with them. We need to separate the two. As well,
-        # we need to remove the '*' character from the lineage.
         lineage = w.split("\t")[0].replace("*", "")
 
         if filterRecombinants and checkIfRecombinant(lineage, aliases):
             pass
 
         else: 
-            info = w.split("\t")[1]
-
-            # Now, we can try to grab the parent given the lineage.
-            parent = parseParentFromLineage(lineage, aliases)
+            lineage, info = parseWithdrawnLine(w)
 
             # There are cases where a lineage is listed both as existing and withdrawn.
             # Thus, if the lineage exists, we need to skip this.
             if checkLineageExists(tree, lineage):
                 pass # Do nothing - left this case if future addition is needed
+            else:
+                parent = getWithdrawnLineageParent(lineage, info, aliases, filterRecombinants, \
+                    lambda l: checkLineageExists(tree, l))
 
-            # We also need to check whether the parent lineage exists.
-            #
-            # If not, we can check whether a related lineage is present in the description,
-            elif checkLineageExists(tree, parent) == False:
-                
-                # searches for a match for the lineage regex pattern in the
-                # lineage information.
-                lineageResult = re.search(lineageRegexPattern, info)
-                
-                # Check whether the regex found a match
-                if lineageResult:
-                    
-                    # If a match was found, check whether the linage in the description
-                    # is already present in the tree.
-                    if checkLineageExists(tree, lineageResult.group(1)):
-                        
-                        # If the lineage was found, we can use this as the parent for
-                        # the withdrawn lineage.
-                        parent = lineageResult.group(1)
-                        tree.create_node(lineage, lineage, parent)
-                    else:
-                        
-                        if checkIfRecombinant(lineage, aliases) and filterRecombinants:
-                            pass
-                        else:
-                            # If the lineage was not found in the tree, we can find what would
-                            # be the parent of that lineage and add the withdrawn lineage under that.
-                            equivalentParent = parseParentFromLineage(lineageResult.group(1), aliases)
-                            tree.create_node(lineage, lineage, equivalentParent)
-            
-                # If the regex pattern did not match, add the withdrawn lineage to the 
+                # If no parent could be found, add the withdrawn lineage to the 
                 # list of invalid lineages.
-                else:
+                if parent == "invalid":
                     invalid.append(lineage)
-            
-            # If the parent lineage obtained from the withdrawn lineage does exist,
-            # we can add the withdrawn lineage directly to the tree.
-            else:
-                tree.create_node(lineage, lineage, parent)
+                elif parent != None:
+                    tree.create_node(lineage, lineage, parent)
 
     return tree, invalid
\ No newline at end of file
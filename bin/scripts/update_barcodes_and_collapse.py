@@ -2,14 +2,24 @@ from distutils.command import build
 import sys
 import os
 import argparse
+import numpy as np
 import pandas as pd
 import subprocess as sp
-from treelib import Node, Tree
 import urllib.request as ur
 import json
 import re
-from data_manip_utils import parseCSVToDF, parseDirectory
-from tree_utils import addLineagesToTree, addWithdrawnLineagesToTree, checkLineageExists, checkIfRecombinant, getCommonLineageParent, getSubLineages, parseParentFromLineage
+import hashlib
+from data_manip_utils import parseDirectory, parseBarcodeCSV, BarcodeMatrix
+from tree_utils import addLineagesToTree, addWithdrawnLineagesToTree, checkLineageExists, getWithdrawnLineageParent, parseWithdrawnLine, checkIfRecombinant, checkIfRecombinants, getCommonLineageParent, iterSubLineages, parseParentFromLineage, \
+    getLineagesInTree, getInsertionOrder, isDescendant, AliasResolver, getAliasResolver, LineageTree, LineageLCAIndex
+
+# The name of the lineage tree cache file and the version of its format.
+LINEAGE_TREE_CACHE_FILE = "lineage-tree.cache"
+LINEAGE_TREE_CACHE_VERSION = 1
+
+# The start and end positions of the SARS-CoV-2 S gene.
+S_GENE_START = 21563
+S_GENE_END = 25384
 
 def parseCladeName(tree, clade):
     """ The nextstrain clades pulled from the USHER phylogenetic
@@ -194,24 +204,21 @@ def parseNSCladeFile(tree, clade):
     # Returns the dictionary.
     return cladeRelationships
 
-def buildLineageTree(lineageFile, aliases, nsclades, filterRecombinants):
-    """ Builds a tree data structure containing SARS-CoV-2 lineages.
-    This is useful when creating the groups to collapse the individual sublineages
-    into as well as when combining groups that have identical S-gene profiles.
-
-    A tree data structure consists of individual nodes which map to children.
+def readLineageNotes(lineageFile, aliases, filterRecombinants):
+    """ Reads the lineages and withdrawn lineages from the pango-designation
+    lineages file (lineage_notes.txt).
 
     Parameters:
-        lineageFile - A file containing a list of updated lineages
-        aliases - a json file containing aliases and their corresponding
-                  lineage
-        nsclades - a json file containing the hierarchial structure of
-                   nextstrain SARS-CoV-2 clade definitions.
+        lineageFile - A file (or list of lines) containing a list of updated lineages,
+                      with the header line already removed
+        aliases - a dictionary mapping aliases to their corresponding
+                  lineage (or an AliasResolver)
         filterRecombinants - a boolean value denoting whether recombinant
-                             lineages should be included in the analysis.
+                             lineages should be left out of the list of lineages.
 
     Output:
-        A tree containing SARS-CoV-2 lineages
+        A list of lineages and a list of withdrawn lineage lines (each
+        containing the lineage and its description separated by a tab)
     """
 
     # We first need to read through the lineages file and separate the viable from the 
@@ -224,7 +231,7 @@ def buildLineageTree(lineageFile, aliases, nsclades, filterRecombinants):
     lineages = []
     withdrawnLines = []
     notAdded = [] # No use implemented yet
-    
+
     for line in lineageFile:
 
         # Withdrawn lineage begin with a '* character'
@@ -242,29 +249,78 @@ def buildLineageTree(lineageFile, aliases, nsclades, filterRecombinants):
             lin = line.strip().replace(" Alias", "\tAlias").split("\t")[0]
 
             if lin != "":
+                lineages.append(lin)
 
-                # Checks whether the user would like to filter recombinant lineages
-                if filterRecombinants:
-                    # If yes, check whether the lineage is a recombinant before
-                    # placing it into the list containing lineages to be 
-                    # placed on the tree.
-                    if checkIfRecombinant(lin, aliases):
-                        # If the lineage is a recombinant, append it to 
-                        # the list of lineages ignored.
-                        notAdded.append(lin)
-                    else:
-                        # If the lineage is not a recombinant, append it 
-                        # to the list of lineages that will be added
-                        # to the tree.
-                        lineages.append(lin)
-                else:
-                    # If the user did not filter recombinants, simply add all
-                    # lineages to the list of lineages that will be added to the tree.
-                    lineages.append(lin)
+    # Checks whether the user would like to filter recombinant lineages
+    if filterRecombinants:
+        # If yes, the lineages are classified all at once and the recombinant
+        # lineages are moved to the list of lineages ignored. The lineages
+        # that are not recombinants will be added to the tree.
+        isRecombinant = checkIfRecombinants(lineages, aliases)
+        notAdded = [lin for lin, r in zip(lineages, isRecombinant) if r]
+        lineages = [lin for lin, r in zip(lineages, isRecombinant) if not r]
+
+    return lineages, withdrawnLines
 
-    # Create an empty tree with a node labeled root.
-    t = Tree()
-    t.create_node("root", "root")
+def addNSCladesToTree(tree, nsclades):
+    """ Adds the Nextstrain clades to a tree of pango lineages.
+
+    Parameters:
+        tree - A LineageTree containing SARS-CoV-2 lineages
+        nsclades - a json file containing the hierarchial structure of
+                   nextstrain SARS-CoV-2 clade definitions.
+
+    Output:
+        A list of clades whose parent lineage could not be found (these
+        are left off the tree).
+    """
+
+    # Parse the file to create a dictionary mapping the
+    # clade to a parent lineage.
+    cladeToParentLineage = parseNSCladeFile(tree, nsclades)
+
+    # Orders the clades so that each is added after its parent
+    # lineage (which may be another clade).
+    clades = list(cladeToParentLineage.keys())
+    cladeOrder, unplaceableClades = getInsertionOrder(tree, clades, [cladeToParentLineage[c] for c in clades])
+
+    for clade, parent in cladeOrder:
+        tree.create_node(clade, clade, parent=parent)
+
+    # Clades whose parent lineage could not be found are left off the tree.
+    if len(unplaceableClades) > 0:
+        print("WARNING: The following Nextstrain clades could not be placed on the lineage tree: {0}\n".format(", ".join(unplaceableClades)))
+
+    return unplaceableClades
+
+def buildLineageTree(lineageFile, aliases, nsclades, filterRecombinants):
+    """ Builds a tree data structure containing SARS-CoV-2 lineages.
+    This is useful when creating the groups to collapse the individual sublineages
+    into as well as when combining groups that have identical S-gene profiles.
+
+    A tree data structure consists of individual nodes which map to children.
+
+    Parameters:
+        lineageFile - A file containing a list of updated lineages
+        aliases - a json file containing aliases and their corresponding
+                  lineage (or an AliasResolver built from it)
+        nsclades - a json file containing the hierarchial structure of
+                   nextstrain SARS-CoV-2 clade definitions.
+        filterRecombinants - a boolean value denoting whether recombinant
+                             lineages should be included in the analysis.
+
+    Output:
+        A LineageTree containing SARS-CoV-2 lineages
+    """
+
+    # Builds the alias lookups once for the whole tree.
+    aliases = getAliasResolver(aliases)
+
+    # Reads the viable and withdrawn lineages from the lineages file.
+    lineages, withdrawnLines = readLineageNotes(lineageFile, aliases, filterRecombinants)
+
+    # Create an empty (array-backed) tree with a node labeled root.
+    t = LineageTree()
 
     # Create a list to store invalid lineages (those that do not have a valid parent lineage)
     # and recombinant lineages
@@ -278,42 +334,315 @@ def buildLineageTree(lineageFile, aliases, nsclades, filterRecombinants):
 
     # Append any invalid withdrawn lineages to the existing list of invalid
     # lineages.
-    invalid.append(invalidWithdrawn)
+    invalid.extend(invalidWithdrawn)
     
     # Finally, we need to add the Nextstrain clades to the tree
+    unplaceableClades = addNSCladesToTree(t, nsclades)
 
-    # Parse the file to create a dictionary mapping the
-    # clade to a parent lineage.
-    cladeToParentLineage = parseNSCladeFile(t, nsclades)
+    # Keeps the lineages and clades that could not be placed with the tree.
+    t.invalid = invalid + unplaceableClades
 
-    # Create a list of clades to add by grabbing
-    # the dictionary keys.
-    cladesToAdd = list(cladeToParentLineage.keys())
+    # The tree is now complete, so we can return it.
+    return t
 
-    # Loop over the list of clades until all are added to the tree.
-    while len(cladesToAdd) > 0:
+def updateLineageTree(tree, oldLineageFile, newLineageFile, oldAliases, newAliases, nsclades, filterRecombinants):
+    """ Updates a previously built lineage tree to match a new lineages file and
+    alias key, rather than building the tree again from scratch. 
 
-        # Grab the first clade in the list.
-        clade = cladesToAdd[0]
+    The lineages are compared between the old and new files and only the lineages 
+    that could have moved are placed again: lineages that were added, lineages whose
+    alias changed, lineages that previously could not be placed, and the sublineages
+    of any lineage that was removed or moved. All other lineages keep their place on the
+    tree. The withdrawn lineages and Nextstrain clades (which depend on which lineages
+    exist) are then placed again.
 
-        # Check whether the parent lineage tied to that clade exists in the tree
-        if checkLineageExists(t, cladeToParentLineage[clade]) == False:
-        #if cladeToParentLineage[clade] not in existingNodes:
-            
-            # If the parent does not exist, it is likely present in the 
-            # list of clades to add and has not been reached yet. Append the
-            # clade to the end of the list and come back to it.
-            cladesToAdd.append(clade)
+    The updated tree has the same lineages, parents, and order of children as a tree
+    built from the new files.
+
+    Parameters:
+        tree - A LineageTree built from the old files (see buildLineageTree)
+        oldLineageFile - The lineages file (or list of lines) the tree was built from,
+                         with the header line already removed
+        newLineageFile - The new lineages file (or list of lines), with the header line
+                         already removed
+        oldAliases - the alias dictionary the tree was built from
+        newAliases - the new alias dictionary (or an AliasResolver built from it)
+        nsclades - a json file containing the hierarchial structure of
+                   nextstrain SARS-CoV-2 clade definitions.
+        filterRecombinants - a boolean value denoting whether recombinant
+                             lineages were filtered from the tree.
+
+    Output:
+        The updated tree and a list of changes. Each change is a tuple containing the
+        type of change ('added', 'removed', 'withdrawn', or 'reparented'), the lineage,
+        its previous parent, and its new parent (None where there is no parent).
+    """
+
+    oldAliases = getAliasResolver(oldAliases)
+    newAliases = getAliasResolver(newAliases)
+
+    # Aliases that were added, removed, or changed.
+    changedAliases = set(a for a in set(oldAliases.aliases) | set(newAliases.aliases) \
+        if oldAliases.aliases.get(a) != newAliases.aliases.get(a))
+
+    # Reads the new lineages.
+    oldLines = list(oldLineageFile)
+    newLines = list(newLineageFile)
+    lineages, withdrawnLines = readLineageNotes(newLines, newAliases, filterRecombinants)
+    newActive = set(lineages)
+
+    # Finds the lineages in the old file. If the aliases did not change, lines that appear in both
+    # files contain the same lineages, so only the lines that differ need to be read.
+    if len(changedAliases) == 0:
+        oldLineSet = set(oldLines)
+        newLineSet = set(newLines)
+        oldOnlyLineages, oldOnlyWithdrawn = readLineageNotes([l for l in oldLines if l not in newLineSet], oldAliases, filterRecombinants)
+        newOnlyLineages, newOnlyWithdrawn = readLineageNotes([l for l in newLines if l not in oldLineSet], newAliases, filterRecombinants)
+        oldActive = (newActive - set(newOnlyLineages)) | set(oldOnlyLineages)
+    else:
+        oldLineages, oldWithdrawnLines = readLineageNotes(oldLines, oldAliases, filterRecombinants)
+        oldActive = set(oldLineages)
+
+    rootName = tree.names[tree.root]
+
+    # Records the lineages on the tree before the update, and the previous parent
+    # of each lineage that is moved or removed.
+    previousLineages = set(tree.ids)
+    previousParents = {}
+
+    # First, we determine which lineages need to be placed again.
+    #
+    # Lineages that were added or could not be placed previously (their parent may now exist).
+    candidates = (newActive - oldActive) | (set(tree.invalid) & newActive)
+
+    # The parent of a lineage is determined by its alias. Lineages with a single number after
+    # their alias (Ex: BE.1) are placed under the re-aliased parent, which depends on the other
+    # aliases, so they are placed again whenever any alias changes.
+    if len(changedAliases) > 0:
+        for lin in lineages:
+            splitLineage = lin.split(".")
+            if splitLineage[0] in changedAliases or len(splitLineage) == 2:
+                candidates.add(lin)
+
+    # Lineages that were removed (or withdrawn) from the lineages file, along with candidates
+    # already on the tree, may have sublineages that are affected. The lineages within their subtrees 
+    # are placed again as well, as they may no longer be placeable.
+    removedActive = oldActive - newActive
+    affected = set()
+    stack = [tree.ids[lin] for lin in (removedActive | candidates) if lin in tree]
+    while stack:
+        linId = stack.pop()
+        for childId in tree.childIds(linId):
+            if tree.names[childId] in newActive and tree.names[childId] not in affected:
+                affected.add(tree.names[childId])
+                stack.append(childId)
+    toPlace = candidates | affected
+
+    # Every other lineage in the new file keeps its parent, so those lineages
+    # can be used as parents straight away.
+    def isStable(lin):
+        return lin == rootName or (lin in tree and lin in newActive and lin not in toPlace)
+
+    # Now, the lineages are placed (in the order of the lineages file). Candidates have their 
+    # parent determined from their name, while affected lineages keep their current parent.
+    invalidParent = set()
+    placeLins = []
+    parents = []
+    for lin in lineages:
+        if lin not in toPlace:
+            continue
+
+        if lin in candidates:
+            parent = parseParentFromLineage(lin, newAliases)
         else:
-            
-            # If the parent does exist, add the clade to the tree.
-            t.create_node(clade, clade, parent=cladeToParentLineage[clade]) 
+            parent = tree.getParentLineage(lin)
 
-        # Remove the clade at the start of the list.
-        cladesToAdd.pop(0)
+        if parent == "invalid":
+            invalidParent.add(lin)
+        else:
+            placeLins.append(lin)
+            parents.append(parent)
+
+    order, unplaceable = getInsertionOrder(tree, placeLins, parents, exists=isStable)
+
+    for lin, parent in order:
+        if lin not in tree:
+            tree.addLineage(lin, parent)
+        elif tree.getParentLineage(lin) != parent:
+            previousParents[lin] = tree.getParentLineage(lin)
+            tree.moveLineage(lin, parent)
+
+    # The lineages that remain on the tree (the root and the placed lineages).
+    kept = newActive - invalidParent - set(unplaceable)
+    kept.add(rootName)
+
+    # Next, the withdrawn lineages are placed in the order they appear in the file. When 
+    # building the tree, a withdrawn lineage can only be placed under lineages added before
+    # it, so only the lineages placed so far are considered to exist.
+    invalidWithdrawn = []
+    for w in withdrawnLines:
+        lineage, info = parseWithdrawnLine(w)
+
+        if (filterRecombinants and checkIfRecombinant(lineage, newAliases)) or lineage in kept:
+            continue
+
+        parent = getWithdrawnLineageParent(lineage, info, newAliases, filterRecombinants, lambda l: l in kept)
+
+        if parent == None:
+            continue
+        elif parent == "invalid" or parent not in kept:
+            invalidWithdrawn.append(lineage)
+            continue
+
+        if lineage not in tree:
+            tree.addLineage(lineage, parent)
+        elif tree.getParentLineage(lineage) != parent:
+            previousParents[lineage] = tree.getParentLineage(lineage)
+            tree.moveLineage(lineage, parent)
+        kept.add(lineage)
+
+    # Removes the lineages that are no longer on the tree, along with the clades (which
+    # are placed again below). Every lineage that was kept has been placed under another
+    # kept lineage, so removing the deepest lineages first removes children before
+    # their parents.
+    toRemove = sorted(set(tree.ids) - kept, key=lambda lin: tree.getDepth(lin), reverse=True)
+    for lin in toRemove:
+        previousParents[lin] = tree.getParentLineage(lin)
+        tree.removeLineage(lin)
+
+    # Lineages that were added or moved were placed after their new parent's existing children,
+    # so the children are put back in the order they would be added when building the tree.
+    # Lineages are added in passes over the lineages file (see getInsertionOrder()), so a lineage
+    # listed after its parent is added before one listed before its parent, and lineages in the
+    # same pass are added in the order of the file. The withdrawn lineages are added after
+    # them, in the order of the file.
+    position = {lin: i for i, lin in enumerate(lineages)}
+    withdrawnPosition = {}
+    for i, w in enumerate(withdrawnLines):
+        withdrawnPosition.setdefault(parseWithdrawnLine(w)[0], i)
+
+    for parent in list(tree.ids):
+        parentPosition = position.get(parent, -1)
+        tree.sortChildren(parent, lambda lin: (int(position[lin] < parentPosition), position[lin]) \
+            if lin in position else (2, withdrawnPosition[lin]))
+
+    # Finally, the Nextstrain clades are placed on the updated tree.
+    unplaceableClades = addNSCladesToTree(tree, nsclades)
+
+    tree.invalid = [lin for lin in lineages if lin in invalidParent] + unplaceable + invalidWithdrawn + unplaceableClades
+
+    # Creates the change log from the lineages that were added to, moved on, or
+    # removed from the tree, along with the lineages that were withdrawn.
+    added = set(tree.ids) - previousLineages
+    changes = []
+    for lin in sorted(added | set(previousParents) | (removedActive & set(tree.ids))):
+        if lin not in tree:
+            changes.append(("removed", lin, previousParents[lin], None))
+        elif lin in added:
+            changes.append(("added", lin, None, tree.getParentLineage(lin)))
+        elif lin in removedActive:
+            changes.append(("withdrawn", lin, previousParents.get(lin, tree.getParentLineage(lin)), tree.getParentLineage(lin)))
+        elif previousParents[lin] != tree.getParentLineage(lin):
+            changes.append(("reparented", lin, previousParents[lin], tree.getParentLineage(lin)))
+
+    changeOrder = ["added", "withdrawn", "reparented", "removed"]
+    changes.sort(key=lambda change: changeOrder.index(change[0]))
+
+    return tree, changes
+
+def writeLineageTreeChanges(changeFile, changes):
+    """ Writes the changes made by updateLineageTree to a tab separated file.
 
-    # The tree is now complete, so we can return it.
-    return t
+    Parameters:
+        changeFile: path to the output file.
+
+        changes: a list of changes returned by updateLineageTree
+
+    Output:
+        None
+    """
+    with open(changeFile, "w") as f:
+        f.write("Change\tLineage\tPrevious Parent\tNew Parent\n")
+        for change, lin, previousParent, parent in changes:
+            f.write("{0}\t{1}\t{2}\t{3}\n".format(change, lin, previousParent if previousParent != None else "", parent if parent != None else ""))
+
+def getLineageTreeCacheKey(inputFiles, filterRecombinants):
+    """ Creates the key used to identify a cached lineage tree. The key is
+    a SHA-256 hash of the contents of the files used to build the tree and
+    the recombinant filter option, so that the cache is ignored whenever any of 
+    them change.
+
+    Parameters:
+        inputFiles: a list of paths to the files used to build the tree (the
+            lineages file, alias key, and nextstrain clade file)
+
+        filterRecombinants: a boolean value denoting whether recombinant
+            lineages were filtered from the tree.
+
+    Output:
+        The key as a hexadecimal string.
+    """
+    sha = hashlib.sha256()
+    for inputFile in inputFiles:
+        with open(inputFile, "rb") as f:
+            sha.update(hashlib.sha256(f.read()).digest())
+    sha.update(b"filterRecombinants=" + str(bool(filterRecombinants)).encode())
+
+    return sha.hexdigest()
+
+def readLineageTreeCache(cacheFile, key):
+    """ Reads a lineage tree written by writeLineageTreeCache.
+
+    Parameters:
+        cacheFile: path to the cache file.
+
+        key: the key of the tree being built (see getLineageTreeCacheKey)
+
+    Output:
+        The cached LineageTree (with its list of invalid lineages). None if the cache
+        file does not exist, cannot be read, or was built from different inputs.
+    """
+    if not os.path.exists(cacheFile):
+        return None
+
+    try:
+        with open(cacheFile, "rb") as f:
+            header = json.loads(f.readline().decode("utf-8"))
+
+            if not isinstance(header, dict) or header.get("version") != LINEAGE_TREE_CACHE_VERSION \
+                or header.get("key") != key:
+                return None
+
+            tree = LineageTree.fromBytes(f.read())
+            tree.invalid = header["invalid"]
+    except (ValueError, KeyError, IndexError, OSError):
+        print("WARNING: The lineage tree cache {0} could not be read. The tree will be rebuilt.\n".format(cacheFile))
+        return None
+
+    return tree
+
+def writeLineageTreeCache(cacheFile, key, tree):
+    """ Writes a lineage tree to a cache file so that it does not need
+    to be rebuilt by the next run with the same inputs.
+
+    Parameters:
+        cacheFile: path to the cache file.
+
+        key: the key of the tree (see getLineageTreeCacheKey)
+
+        tree: the LineageTree to be cached
+
+    Output:
+        None
+    """
+    header = {"version": LINEAGE_TREE_CACHE_VERSION, "key": key, "invalid": tree.invalid}
+
+    # Writes to a temporary file first so that an interrupted run does not
+    # leave a partial cache behind.
+    with open(cacheFile + ".tmp", "wb") as f:
+        f.write(json.dumps(header).encode("utf-8") + b"\n")
+        f.write(tree.toBytes())
+    os.replace(cacheFile + ".tmp", cacheFile)
 
 def getSublineageCollapse(tree, groups, recombinants, barcodeLineages):
     """ Creates the sublineage collapse map 
@@ -383,13 +712,9 @@ def getSublineageCollapse(tree, groups, recombinants, barcodeLineages):
             # from that other group.
             linDescendants = [p]
 
-            # Grabs the sublineages of that lineage
-            sublins = getSubLineages(tree, p)
-
-            # If sublineages were returned, 
-            # append the parent to the list
-            if sublins != None:
-                linDescendants.extend(sublins)
+            # Adds the sublineages of that lineage (if any)
+            # to the list.
+            linDescendants.extend(iterSubLineages(tree, p))
 
             # If the lineage were a recombinant, then
             # we need to remove it and its sublineages
@@ -415,16 +740,18 @@ def getSublineageCollapse(tree, groups, recombinants, barcodeLineages):
         for p2 in parentSublineages.keys():
 
             # Checks whether the parent is present in the
-            # sublineages of another parent. (Because the sublineage
-            # list also contains the parent, we have to be sure that the 
-            # parents we are looking at are not the same)
-            if p in parentSublineages[p2] and p != p2:
+            # sublineages of another parent. A parent can only be present
+            # if it descends from the other parent, which the tree can answer
+            # without scanning the list, so the list is only searched for
+            # nested parents (it may already have been removed by
+            # another parent in between).
+            if isDescendant(tree, p, p2) and p in parentSublineages[p2]:
                 
                 # If the parent is present, we can then simply remove
                 # all of lineages from the first parent's sublineages
                 # from the other parent's.
                 p2Sublins = parentSublineages[p2]
-                p1Sublins = parentSublineages[p]
+                p1Sublins = set(parentSublineages[p])
                 parentSublineages[p2] = [item for item in p2Sublins if item not in p1Sublins]
 
 
@@ -464,33 +791,19 @@ def getSublineageCollapse(tree, groups, recombinants, barcodeLineages):
     # Create an empty list to store the "Not a VOC" lineages
     notAVOC = []
 
-    # Loops over every node in the tree.
-    for node in tree.expand_tree(mode=Tree.DEPTH):
+    # Gathers every lineage already placed in a group into a set,
+    # so that each lineage in the tree can be checked with a single lookup
+    # rather than searching each group's list.
+    collapsedLins = set()
+    for groupValues in sublineageMap.values():
+        collapsedLins.update(groupValues[1])
 
-        # Grabs the id of each node, which corresponds
-        # to the lineages name
-        lin = tree[node].identifier
-        
-        # Creates a boolean value denoting
-        # whether the lineage is present in
-        # another grouping.
-        notCollapsed = True
-
-        # Loops over all of the values (lists of lineages in each group)
-        # in the collapse map
-        for list in sublineageMap.values():
-            # If the lineage is present in the groups list of lineages,
-            # set the boolean to false and exit the loop 
-            # (too prevent unnecessary comparisons) 
-            groupLins = list[1]
-            if lin in groupLins:
-                notCollapsed = False
-                break
-
-        # If the boolean value is still true (the lineage
-        # was not found in the existing groups), add it
-        # to the list of "Not A VOC" lineages
-        if notCollapsed:
+    # Loops over every lineage in the tree.
+    for lin in getLineagesInTree(tree):
+
+        # If the lineage was not found in the existing groups,
+        # add it to the list of "Not A VOC" lineages
+        if lin not in collapsedLins:
             notAVOC.append(lin)
 
     # Create a new group in the sublineage map mapping 
@@ -591,6 +904,35 @@ def removeFromSublineageMap(lins, sm):
     # Return the modified sublineage map
     return sm
 
+def writeGroupedBarcodes(barcodeFile, barcodes, labels, rows, chunkSize=1000):
+    """ Writes a barcode file containing one row per group of lineages with
+    identical barcodes. Only the packed rows of the groups are copied, and the
+    values are formatted the same as writing the grouped barcodes with pandas'
+    to_csv().
+
+    Parameters:
+        barcodeFile: path to the output file.
+
+        barcodes: a BarcodeMatrix containing the barcodes of every lineage
+
+        labels: a list containing the label of each group
+
+        rows: a list containing the (integer) row of the barcodes to
+            write for each group
+
+        chunkSize: (optional) the number of rows to write at once.
+
+    Output:
+        None
+    """
+    # The rows of a dataframe share one type, so if any column contains
+    # floats, every value of the grouped barcodes is written as a float.
+    floatColumns = np.full(len(barcodes.mutations), barcodes.floatColumns.any())
+
+    # The first column (the group labels) is left unnamed.
+    grouped = BarcodeMatrix(barcodes.bits[rows], labels, barcodes.mutations, floatColumns, '')
+    grouped.writeCSV(barcodeFile, chunkSize)
+
 def writeSublineageMap(sm, outDir):
     """ Writes a sublineage map to a file
 
@@ -631,6 +973,37 @@ def getMutPos(m):
     """
     return int(m[1:len(m) - 1])
 
+def getMutPositions(mutations):
+    """ Calculates the positions of a list of mutations at once
+    (see getMutPos()).
+
+    Parameters:
+        mutations: a list (or pandas Index) of mutations in the format "A#####T"
+
+    Output:
+        A numpy array containing the integer position of each mutation.
+    """
+    return pd.Index(mutations).str.slice(1, -1).astype(int).to_numpy()
+
+def getSGeneColumns(columns):
+    """ Selects the barcode columns needed for S gene barcodes: the first column
+    (containing the lineage names) and the mutations within the S gene. The
+    positions of all mutations are parsed at once and compared against the
+    S gene's start and end positions with a single mask.
+
+    Parameters:
+        columns: the columns of the barcode file (the lineage column
+            followed by the mutations)
+
+    Output:
+        A list of the columns to keep.
+    """
+    mutations = pd.Index(columns[1:])
+    positions = getMutPositions(mutations)
+    inSGene = (positions >= S_GENE_START) & (positions <= S_GENE_END)
+
+    return [columns[0]] + mutations[inSGene].tolist()
+
 def runFreyjaUpdate(o):
     """ Runs the Freyja update module to download the most
     up-to-date set of barcodes.
@@ -663,12 +1036,47 @@ def main():
     parser.add_argument("--filterRecombinants", required=False, \
         help = "This pipeline automatically removed barcodes for 'proposed' and 'misc' lineages, but keeps recombinant lineages by default. Supply this argument to filter out recombinant lineages as well", \
         action ='store_true', dest = 'noRecombinants')
+    parser.add_argument("--treeCacheDir", required=False, type=str, \
+        help = "Directory to store the lineage tree cache in (the output directory by default). The tree is only rebuilt when the lineage, alias, or clade files (or the --filterRecombinants option) change", \
+        action = 'store', dest = 'treeCacheDir')
+    parser.add_argument("--barcodeCacheDir", required=False, type=str, \
+        help = "Directory to cache the parsed barcodes in. Barcode files that were already parsed (with the same contents) are loaded from the cache rather than parsed again. If not provided, the barcodes are not cached", \
+        action = 'store', dest = 'barcodeCacheDir')
 
     args = parser.parse_args()
 
     # Parses the output directory inputted by the user
     outdir = parseDirectory(args.outdir)
 
+    # Parses the lineage tree cache directory (the output directory by default)
+    treeCacheDir = outdir
+    if args.treeCacheDir:
+        os.makedirs(args.treeCacheDir, exist_ok=True)
+        treeCacheDir = parseDirectory(args.treeCacheDir)
+
+    # Parses the barcode cache directory (if supplied)
+    barcodeCacheDir = None
+    if args.barcodeCacheDir:
+        os.makedirs(args.barcodeCacheDir, exist_ok=True)
+        barcodeCacheDir = parseDirectory(args.barcodeCacheDir)
+
+    # If a previous run left its lineage files and a cached tree behind, the previous
+    # tree and the files it was built from are kept so that the tree can be updated
+    # from the differences in the new files rather than built again from scratch.
+    treeCacheFile = treeCacheDir + LINEAGE_TREE_CACHE_FILE
+    treeInputFiles = [outdir + "lineages.txt", outdir + "alias_key.json", outdir + "NSClades.json"]
+    previousTree = None
+    previousTreeKey = None
+    if os.path.exists(treeCacheFile) and all(os.path.exists(f) for f in treeInputFiles):
+        previousTreeKey = getLineageTreeCacheKey(treeInputFiles, args.noRecombinants)
+        previousTree = readLineageTreeCache(treeCacheFile, previousTreeKey)
+
+        if previousTree != None:
+            with open(outdir + "lineages.txt", "r") as f:
+                f.readline()
+                previousLineageLines = f.readlines()
+            previousAliases = json.load(open(outdir + "alias_key.json"))
+
     # Now, we need to download files to create a lineage hierarchy.
 
     # Most lineages are obtained from the pango-designation github. This data source is
@@ -700,8 +1108,9 @@ def main():
     ur.urlretrieve(NextStrainCladeUrl, outdir + "NSClades.json")
     
     # Reads the alias and nextstrain clade json files into 
-    # dictionaries.
-    aliases = json.load(open(outdir + "/alias_key.json"))
+    # dictionaries. The aliases are wrapped in an AliasResolver so that
+    # alias lookups are only built once.
+    aliases = AliasResolver(json.load(open(outdir + "/alias_key.json")))
     nsclades = json.load(open(outdir + "/NSClades.json"))
 
     # Opens the lineages file and skips the header line.
@@ -709,41 +1118,48 @@ def main():
     lineageFile.readline()
 
     # Parses the --input option
-    df = ''
+    barcodeMatrix = ''
+    barcodes = ''
     if args.infile:
 
-        # If the user supplied the input file to use, parse that file into 
-        # a pandas dataframe and notify the user.
-        df = parseCSVToDF(args.infile, ',', header=True)
+        # If the user supplied the input file to use, this file will be parsed
+        # into a barcode matrix. Notify the user.
+        barcodes = args.infile
         print("Input file, {0}, provided. Freyja update will not be run and this file will be used instead.\n".format(args.infile))
     else:
         # If the user did not supply an input file, run 'freyja update' and read the barcode in
-        # as a pandas dataframe. 
+        # as a barcode matrix. 
         print("Fetching latest barcodes using 'freyja update'\n")
         runFreyjaUpdate(outdir)
         barcodes = outdir + "usher_barcodes.csv"
-        df = parseCSVToDF(barcodes, ',', header=True)
+
+    # If the user supplied the --s_gene option, the mutations outside of the S gene
+    # will be removed from the barcodes. Thus, only the lineage column and the S gene
+    # mutation columns are read from the file.
+    barcodeColumns = None
+    if args.sgene and os.path.exists(barcodes):
+        barcodeColumns = getSGeneColumns(pd.read_csv(barcodes, nrows=0).columns)
+
+    # The barcodes are stored bit-packed (see BarcodeMatrix), with the
+    # lineage names stored separately. If a barcode cache directory was supplied,
+    # barcodes that were already parsed are loaded from the cache.
+    barcodeMatrix = parseBarcodeCSV(barcodes, usecols=barcodeColumns, cacheDir=barcodeCacheDir)
 
 
     print("NOTE: All 'proposed' and 'misc' lineages will be filtered from the barcodes by default\n")
     # Filter the barcodes to removed any proposed lineages or
     # misc lineages
-    filterProposed = df.iloc[:,0].str.contains("proposed\d+")
-    df = df[~filterProposed]
-    filterMisc = df.iloc[:,0].str.contains("misc.*")
-    df = df[~filterMisc]
-    df.iloc[:,0] = df.iloc[:,0].str.replace(" ", '')
+    lineageNames = pd.Series(barcodeMatrix.lineages)
+    filterProposed = lineageNames.str.contains("proposed\d+")
+    filterMisc = lineageNames.str.contains("misc.*")
+    barcodeMatrix = barcodeMatrix.selectLineages(~(filterProposed | filterMisc).to_numpy())
+    barcodeMatrix = barcodeMatrix.renameLineages(pd.Series(barcodeMatrix.lineages).str.replace(" ", '').tolist())
 
     # Next, recombinant lineages are identified within the
-    # barcodes and stored in a list.
-    recombinantLineages = []
-    for lin in df.iloc[:,0].tolist():
-        if checkIfRecombinant(lin, aliases):
-            recombinantLineages.append(lin)
-    
-    # A filter is created for the recombinant lineages identified
-    # in the previous lines.
-    filterRecombinant = df.iloc[:,0].isin(recombinantLineages)
+    # barcodes. This creates a filter for the recombinant lineages,
+    # which are also stored in a list.
+    filterRecombinant = checkIfRecombinants(barcodeMatrix.lineages, aliases)
+    recombinantLineages = barcodeMatrix.lineages[filterRecombinant].tolist()
     
     # Check whether the user supplied the option to filter out
     # recombinant lineages.
@@ -753,19 +1169,38 @@ def main():
         print("NOTE: Recombinant Lineage Filter Option Supplied By User - Recombinant lineages will not be included in barcodes or sublineage map\n")
         
         # Remove the recombinant lineages from the barcodes.
-        df = df[~filterRecombinant]
+        barcodeMatrix = barcodeMatrix.selectLineages(~filterRecombinant)
         
         # Set the list of recombinant lineages to empty as they have been
         # filtered out, and this list is later used to 
         # build the sublineage map.
         recombinantLineages = []
 
-    # Creates the lineage tree
-    lineageTree = buildLineageTree(lineageFile, aliases, nsclades, args.noRecombinants)
+    # Creates the lineage tree. If the tree was already built from the same lineage, alias,
+    # and clade files (with the same recombinant option), it is loaded from the cache instead.
+    # If the files changed since the previous run, the previous tree is updated using the
+    # differences between the files and the changes are written to lineage-tree-changes.tsv.
+    treeCacheKey = getLineageTreeCacheKey(treeInputFiles, args.noRecombinants)
+    if previousTree != None and previousTreeKey == treeCacheKey:
+        lineageTree = previousTree
+    else:
+        lineageTree = readLineageTreeCache(treeCacheFile, treeCacheKey)
+
+    if lineageTree != None:
+        print("Lineage tree loaded from cache {0}\n".format(treeCacheFile))
+    elif previousTree != None:
+        lineageTree, changes = updateLineageTree(previousTree, previousLineageLines, lineageFile, \
+            previousAliases, aliases, nsclades, args.noRecombinants)
+        writeLineageTreeChanges(outdir + "lineage-tree-changes.tsv", changes)
+        writeLineageTreeCache(treeCacheFile, treeCacheKey, lineageTree)
+        print("Lineage tree updated from the previous run ({0} lineages changed). Changes written to {1}\n".format(len(changes), outdir + "lineage-tree-changes.tsv"))
+    else:
+        lineageTree = buildLineageTree(lineageFile, aliases, nsclades, args.noRecombinants)
+        writeLineageTreeCache(treeCacheFile, treeCacheKey, lineageTree)
 
-    # Sets the index to the first column which contains
-    # lineages names
-    df = df.set_index('Unnamed: 0')
+    # Indexes the finished tree so that the common parent of
+    # the S-gene identical groups can be found quickly.
+    lcaIndex = LineageLCAIndex(lineageTree)
 
     # Parses the sublineage map option and creates the collapse
     # map dictionary. 
@@ -800,7 +1235,7 @@ def main():
 
         # Uses the lineages to collapse dictionary created from the input file
         # to create a sublineage map file
-        sublineageMap = getSublineageCollapse(lineageTree, lineagesToCollapse, recombinantLineages, list(df.index))
+        sublineageMap = getSublineageCollapse(lineageTree, lineagesToCollapse, recombinantLineages, barcodeMatrix.lineages.tolist())
     else:
         # If the file does not exist, exit the script and notify the user.
         sys.exit("ERROR: File {0} does not exist!".format(args.collapse))
@@ -811,59 +1246,32 @@ def main():
     # groupings to the collapse map
     if args.sgene:
         print("S-Gene Option supplied.\nModifying barcodes and sublineage map to account for S-gene identical variants\n")
-        # Saves the start and end positions of the SARS-CoV-2 S gene
-        s_gene_start = 21563
-        s_gene_end = 25384
-
-        # Loops over each column in the barcode file, which represents a
-        # mutation. Removes the mutations outside of the s gene.
-        for column in df:
-        
-            # Skips the first column which contains the variant names
-            if column != "Unnamed: 0":
-            
-                # Grabs the mutation position from the column.
-                pos = getMutPos(column)
-            
-                # Drops the column if the mutation position is outside
-                # of the s gene.
-                if pos < s_gene_start or pos > s_gene_end:
-                    df = df.drop(column, axis=1) 
-    
+        # The mutations outside of the S gene were left out when the
+        # barcodes were read (see getSGeneColumns()).
 
         # Writes a csv that contains the barcodes before identical rows are combined. 
-        df.to_csv("{0}S_Gene_Unfiltered.csv".format(outdir))
+        barcodeMatrix.writeCSV("{0}S_Gene_Unfiltered.csv".format(outdir))
 
-        # Places all of the columns in the dataframe into a list
-        cols = df.columns.values.tolist()
-
-        # Uses pandas' groupby function to great groups of rows based on having matching columns.
-        # Essentially, this creates groups of variants with the same mutation profiles.
-        dup_grouped = df.groupby(cols)
-        dup_groups = dup_grouped.groups
+        # Creates groups of variants with the same mutation profiles.
+        dup_groups = barcodeMatrix.groupIdentical()
 
         # Creates a human-readable file that contains the lineage groupings
         # and the lineages present in 
         groupFile = open("{0}S-Gene-Indistinguishable-Groups.txt".format(outdir), "w+")
     
-        # Creates a new dataframe to store the combined lineages and their mutation profiles
-        newCols = cols
-        newCols.insert(0, '')
-        newdf = pd.DataFrame(columns=newCols)
+        # Creates lists to store the label of each combined group of lineages and the
+        # row of the barcodes containing its mutation profile (the profile of its first lineage).
+        # The combined barcodes are written all at once after the groups have been labeled.
+        rowOfLineage = barcodeMatrix.getLineageRows()
+        groupLabels = []
+        groupRows = []
 
         #parentSubGroups = {}
-        # Loops over all of the groups produced by the groupby
-        # function to combine them into 1 entry in the new dataframe.
+        # Loops over all of the groups of variants to combine
+        # them into 1 entry in the new dataframe.
         # The groups will contain 1+ lineages (an s-gene unique lineage 
         # will be its own group)
-        for grp in dup_groups.keys():
-
-            # Grabs the individual variants from the group
-            groupLins = list(dup_groups[grp].values)
-
-            # Grabs the columns where the variants have a 1. This indicates 
-            # that the variant has a given mutation 
-            muts = df.columns[df.loc[groupLins[0],:].isin([1])].values
+        for groupLins in dup_groups:
 
             # Create a variable to store the label for the group in the final
             # barcodes file.
@@ -974,7 +1382,7 @@ def main():
 
                 # Now, we can find the parent lineage to add to the group name, by finding
                 # the common parent of the lineages in the s-gene identical group.
-                parent = getCommonLineageParent(lineageTree, groupLins)
+                parent = getCommonLineageParent(lineageTree, groupLins, lcaIndex)
 
                 # If the parent is 'root', it means that 
                 # both B and A sublineages are present in the group
@@ -1021,20 +1429,17 @@ def main():
                 # name
                 bcLabel = groupLins[0]
 
-            # Grabs the entire row for one of the variants in the group from the original dataframe
-            # (since they are all the same within the group, we can just grab the first one).
-            barcodes = df.loc[groupLins[0],:].values.tolist()
-
-            # Adds the row into the new dataframe.
-            barcodes.insert(0, bcLabel)
-            newdf.loc[len(newdf.index)] = barcodes
+            # Saves the label and the row of one of the variants in the group
+            # (since they are all the same within the group, we can just use the first one).
+            groupLabels.append(bcLabel)
+            groupRows.append(rowOfLineage[groupLins[0]])
 
-        # Writes the dataframe to a csv and closes the text filestream.
-        newdf.to_csv("{0}S_Gene_barcodes.csv".format(outdir), index=False)
+        # Writes the combined barcodes to a csv and closes the text filestream.
+        writeGroupedBarcodes("{0}S_Gene_barcodes.csv".format(outdir), barcodeMatrix, groupLabels, groupRows)
         groupFile.close()
     else:
-        df.index.name = None
-        df.to_csv("{0}filtered_barcodes.csv".format(outdir), index=True)
+        barcodeMatrix.indexName = ''
+        barcodeMatrix.writeCSV("{0}filtered_barcodes.csv".format(outdir))
 
     writeSublineageMap(sublineageMap, outdir)
     if os.path.exists("{0}usher_barcodes.csv".format(outdir)):
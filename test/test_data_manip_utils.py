@@ -1,5 +1,7 @@
+import io
 import os
 import sys
+import shutil
 
 # Sets the path so that the scripts can be imported
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
@@ -7,11 +9,15 @@ sys.path.append(os.path.dirname(SCRIPT_DIR))
 
 import unittest
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 from datetime import datetime as dt
 
 from bin.scripts.data_manip_utils import findLineageGroup, parseDirectory, \
     parseDate, parseCSVToDF, collapseLineages, parseSublinMap, writeDataFrame,\
-    writeLineageMatrix, getMutationCoords
+    writeLineageMatrix, getMutationCoords, SublineageMap, collapseLineageTable, \
+    LineageMatrix, DataFrameWriter, CollapsedDataFrameWriter, ColumnarWriter, BarcodeMatrix, parseBarcodes, \
+    parseBarcodeCSV, getBarcodeCacheKey, getBarcodeCacheFiles, readBarcodeCache, getUniqueColumnNames
 
 TEST_FILE_DIR = SCRIPT_DIR + "/data-manip-utils-test"
 
@@ -162,6 +168,38 @@ class TestUtilityFunctions(unittest.TestCase):
         self.assertEqual(findLineageGroup("BA.1", map), "BA.1")
         self.assertEqual(findLineageGroup("B.1.1.529_Sublineage_Like_BA.1", map), "BA.1")
 
+    def test_SublineageMap_getGroup(self):
+        map = parseSublinMap(TEST_FILE_DIR + "/test-sublin-map.tsv")
+
+        self.assertIsInstance(map, SublineageMap)
+        self.assertEqual(map.getGroup("AY.1"), "Delta")
+        self.assertEqual(map.getGroup("AY.1.2"), "AY.1_Sublineages_Like_AY.1.1")
+        self.assertEqual(map.getGroup("BA.7"), None)
+
+    def test_SublineageMap_findGroup(self):
+        map = parseSublinMap(TEST_FILE_DIR + "/test-sublin-map.tsv")
+
+        self.assertEqual(map.findGroup("AY.1.3"), "Delta")
+        self.assertEqual(map.findGroup("AY.1_Sublineages_Like_AY.1.4"), "Delta")
+        self.assertEqual(map.findGroup("GG.2_Sublineages_Like_CC.5"), "Unknown")
+
+    def test_SublineageMap_updatedGroups(self):
+        map = parseSublinMap(TEST_FILE_DIR + "/test-sublin-map.tsv")
+        self.assertEqual(map.findGroup("BA.1"), "Unknown")
+
+        # Adding a group rebuilds the index
+        map["Omicron"] = ["Parent-Group", ["BA.1"]]
+        self.assertEqual(map.findGroup("BA.1"), "Omicron")
+
+    def test_findLineageGroup_plainDictionary(self):
+        map = {
+            "Delta": ["Parent-Group", ["AY.1", "AY.1_Sublineages_Like_AY.1.1"]],
+            "AY.1_Sublineages_Like_AY.1.1": ["Sub-Group", ["AY.1.1"]]
+        }
+
+        self.assertEqual(findLineageGroup("AY.1.1", map), "Delta")
+        self.assertEqual(findLineageGroup("AV.1", map), "Unknown")
+
     def test_collapseLineages_collapse_all(self):
         # Creates data for a test input
         sample = "Sample1"
@@ -196,6 +234,39 @@ class TestUtilityFunctions(unittest.TestCase):
         # correct (intended) result
         self.assertEqual(result, correct_results)
 
+    def test_collapseLineageTable_matchesCollapseLineages(self):
+        # Creates data for two samples in a long-format table
+        unfiltData = readCSVToList(TEST_FILE_DIR + "/test-unfiltered-data.csv")
+        unfiltData = unfiltData + [["Sample2"] + row[1:] for row in unfiltData]
+        table = pd.DataFrame(unfiltData, columns=["sample", "lineage", "abundance", "site"])
+        map = parseSublinMap(TEST_FILE_DIR + "/test-sublin-map.tsv")
+
+        for cutoff in [100, 0.5, 0.25]:
+            expected = collapseLineages("Sample1", unfiltData[:3], cutoff, map) + \
+                collapseLineages("Sample2", unfiltData[3:], cutoff, map)
+            expected = [[s, l, float(a), site] for s, l, a, site in expected]
+
+            result = collapseLineageTable(table, cutoff, map)
+
+            self.assertEqual(result.values.tolist(), expected)
+
+    def test_collapseLineageTable_lineageNamedAsGroup(self):
+        # A lineage above the cutoff replaces the abundance already collapsed into
+        # a group with the same name (as collapseLineages does)
+        table = pd.DataFrame([["Sample1", "AY.10", "0.1", "site1"], ["Sample1", "Delta", "0.6", "site1"], \
+            ["Sample1", "AY.1", "0.3", "site1"]], columns=["sample", "lineage", "abundance", "site"])
+        map = parseSublinMap(TEST_FILE_DIR + "/test-sublin-map.tsv")
+
+        result = collapseLineageTable(table, 0.5, map)
+
+        self.assertEqual(result.values.tolist(), [["Sample1", "Delta", 0.8999999999999999, "site1"]])
+
+    def test_collapseLineageTable_empty(self):
+        table = pd.DataFrame([], columns=["sample", "lineage", "abundance", "site"])
+        map = parseSublinMap(TEST_FILE_DIR + "/test-sublin-map.tsv")
+
+        self.assertEqual(len(collapseLineageTable(table, 0.5, map).index), 0)
+
     def test_writeDataFrame(self):
 
         # Creates data for test input
@@ -220,6 +291,165 @@ class TestUtilityFunctions(unittest.TestCase):
         f.close()
         os.remove(outfile + ".csv")
 
+    def test_DataFrameWriter_streaming(self):
+
+        # Writes rows to the file in multiple batches
+        outfile = TEST_FILE_DIR + "/testOut"
+        with DataFrameWriter(outfile, "sample,lineage,abundance,site\n") as writer:
+            writer.writeRows([["Sample1", "Delta", "0.123456", "site1"]])
+            writer.writeRows(pd.DataFrame([["Sample2", "BA.1", 1.0, "site2"]]))
+
+        # Checks that every row was written in the order provided
+        self.assertEqual(readCSVToList(outfile + ".csv"), [["sample", "lineage", "abundance", "site"], \
+            ["Sample1", "Delta", "0.1235", "site1"], ["Sample2", "BA.1", "1.0", "site2"]])
+
+        os.remove(outfile + ".csv")
+
+    def test_DataFrameWriter_discardOnError(self):
+        outfile = TEST_FILE_DIR + "/testOut"
+
+        for outputFormat in ["csv", "parquet", "feather"]:
+            with DataFrameWriter(outfile, "sample,lineage,abundance,site\n", outputFormat) as writer:
+                writer.writeRows([["Sample1", "Delta", 0.5, "site1"]])
+            previous = open(outfile + "." + outputFormat, "rb").read()
+
+            # A failure while writing leaves the previous file in place and
+            # removes the temporary file.
+            with self.assertRaises(RuntimeError):
+                with DataFrameWriter(outfile, "sample,lineage,abundance,site\n", outputFormat) as writer:
+                    writer.writeRows([["Sample2", "BA.1", 1.0, "site2"]])
+                    raise RuntimeError("Failed")
+
+            self.assertEqual(open(outfile + "." + outputFormat, "rb").read(), previous)
+            self.assertFalse(os.path.exists(outfile + "." + outputFormat + ".tmp"))
+
+            os.remove(outfile + "." + outputFormat)
+
+    def test_CollapsedDataFrameWriter_batches(self):
+
+        # Creates data for three samples, with the second sample split across
+        # two writes.
+        unfiltData = readCSVToList(TEST_FILE_DIR + "/test-unfiltered-data.csv")
+        sample2 = [["Sample2"] + row[1:] for row in unfiltData]
+        sample3 = [["Sample3"] + row[1:] for row in unfiltData]
+        map = parseSublinMap(TEST_FILE_DIR + "/test-sublin-map.tsv")
+        table = pd.DataFrame(unfiltData + sample2 + sample3, columns=["sample", "lineage", "abundance", "site"])
+
+        # Writes the data with a batch size small enough that a batch is written
+        # after every write (except within a sample).
+        outfile = TEST_FILE_DIR + "/testOut"
+        with CollapsedDataFrameWriter(outfile, "sample,lineage,abundance,site\n", 0.5, map, batchRows=1) as writer:
+            writer.writeRows(unfiltData)
+            writer.writeRows(sample2[:1])
+            writer.writeRows(sample2[1:])
+            writer.writeRows(sample3)
+
+        # The output matches the data collapsed at once
+        expected = [[s, l, str(round(a, 4)), site] for s, l, a, site in \
+            collapseLineageTable(table, 0.5, map).values.tolist()]
+        self.assertEqual(readCSVToList(outfile + ".csv")[1:], expected)
+
+        os.remove(outfile + ".csv")
+
+    def test_DataFrameWriter_parquet(self):
+
+        # Writes rows to a parquet file
+        outfile = TEST_FILE_DIR + "/testOut"
+        with DataFrameWriter(outfile, "sample,lineage,abundance,site\n", "parquet") as writer:
+            writer.writeRows([["Sample1", "Delta", "0.123456", "site1"]])
+            writer.writeRows([["Sample2", "BA.1", 1.0, "site2"]])
+
+        self.assertTrue(os.path.exists(outfile + ".parquet"))
+
+        # Checks that the file contains the same (typed) data as the csv
+        df = pd.read_parquet(outfile + ".parquet")
+        self.assertEqual(df.values.tolist(), [["Sample1", "Delta", 0.1235, "site1"], ["Sample2", "BA.1", 1.0, "site2"]])
+        self.assertEqual(str(df["lineage"].dtype), "category")
+        self.assertEqual(str(df["site"].dtype), "category")
+
+        os.remove(outfile + ".parquet")
+
+    def test_ColumnarWriter_batches(self):
+        outfile = TEST_FILE_DIR + "/testOut"
+        columns = [("sample", "str"), ("lineage", "category"), ("abundance", "float"), ("site", "category")]
+        rows = [["Sample1", "BA.1", 0.5, "site1"], ["Sample1", "BA.2", 0.5, "site1"], ["Sample2", "BA.1", 1.0, "site2"], \
+            ["Sample3", "XBB", 0.25, "site1"], ["Sample3", "BA.2", 0.75, "site1"]]
+
+        for outputFormat in ["parquet", "feather"]:
+            # Writes the rows in batches of 2. Each batch is written once it is full,
+            # so no more than 2 rows are held at once.
+            writer = ColumnarWriter(outfile, columns, outputFormat, batchRows=2)
+            for row in rows:
+                writer.writeRow(row)
+                self.assertTrue(len(writer.values[0]) < 2)
+            writer.close()
+
+            if outputFormat == "parquet":
+                self.assertEqual(pq.ParquetFile(outfile + ".parquet").num_row_groups, 3)
+                df = pd.read_parquet(outfile + ".parquet")
+            else:
+                self.assertEqual(pa.ipc.open_file(outfile + ".feather").num_record_batches, 3)
+                df = pd.read_feather(outfile + ".feather")
+
+            # Categories are kept in the order they first appeared, across batches.
+            self.assertEqual(df.values.tolist(), rows)
+            self.assertEqual(list(df["lineage"].cat.categories), ["BA.1", "BA.2", "XBB"])
+            self.assertEqual(list(df["site"].cat.categories), ["site1", "site2"])
+
+            os.remove(outfile + "." + outputFormat)
+
+    def test_writeLineageMatrix_feather(self):
+
+        # Creates data for test input
+        outfile = TEST_FILE_DIR + "/testOut"
+        samples = ["Sample1", "Sample2", "Sample3"]
+        lineageAbunds = {
+            "BA.1": ["1.0", "0.5", "0.0"],
+            "BA.5": ["0.0", "0.5", "1.0"]
+        }
+
+        writeLineageMatrix(samples, lineageAbunds, outfile, "feather")
+
+        # Checks that the file contains a lineage column followed by the samples
+        df = pd.read_feather(outfile + ".feather")
+        self.assertEqual(list(df.columns), ["lineage", "Sample1", "Sample2", "Sample3"])
+        self.assertEqual(df.values.tolist(), [["BA.1", 1.0, 0.5, 0.0], ["BA.5", 0.0, 0.5, 1.0]])
+
+        os.remove(outfile + ".feather")
+
+    def test_writeLineageMatrix_duplicateSamples(self):
+
+        # A sample listed twice in the masterfile has a column for each listing.
+        outfile = TEST_FILE_DIR + "/testOut"
+        samples = ["S1", "S1", "S2"]
+        lineageAbunds = {
+            "BA.1": ["1.0", "1.0", "0.0"],
+            "BA.5": ["0.0", "0.0", "1.0"]
+        }
+
+        for outputFormat in ["csv", "parquet", "feather"]:
+            writeLineageMatrix(samples, lineageAbunds, outfile, outputFormat)
+
+            if outputFormat == "csv":
+                df = pd.read_csv(outfile + ".csv", index_col=0)
+            elif outputFormat == "parquet":
+                df = pd.read_parquet(outfile + ".parquet").set_index("lineage")
+            else:
+                df = pd.read_feather(outfile + ".feather").set_index("lineage")
+
+            # Every format reads back with the same column names.
+            self.assertEqual(list(df.columns), ["S1", "S1.1", "S2"])
+            self.assertEqual(df.values.tolist(), [[1.0, 1.0, 0.0], [0.0, 0.0, 1.0]])
+
+            os.remove(outfile + "." + outputFormat)
+
+    def test_getUniqueColumnNames(self):
+        # Matches the columns pandas reads from a csv file with the same header.
+        names = ["lineage", "S1", "S1", "S1.1", "lineage", "S1"]
+        expected = list(pd.read_csv(io.StringIO(",".join(names) + "\n")).columns)
+        self.assertEqual(expected, ["lineage", "S1", "S1.2", "S1.1", "lineage.1", "S1.3"])
+        self.assertEqual(getUniqueColumnNames(names), expected)
+
     def test_writeLineageMatrix(self):
 
         # Creates data for test input
@@ -249,6 +479,142 @@ class TestUtilityFunctions(unittest.TestCase):
         f.close()
         os.remove(outfile + ".csv")
 
+    def test_LineageMatrix_iterRows(self):
+
+        # Creates a matrix, appending a column after values were set.
+        matrix = LineageMatrix(["Sample1", "Sample2"])
+        matrix.setValue("BA.1", 0, "1.0")
+        matrix.setValue("BA.5", 1, 0.5)
+        matrix.setValue("BA.1", 1, 0.25)
+        matrix.setValue("BA.1", 1, 0.5)
+        col = matrix.addColumn("Sample3")
+        matrix.setValue("BA.5", col, 1.0)
+        matrix.addLineage("XBB")
+
+        rows = [(lin, list(values)) for lin, values in matrix.iterRows()]
+
+        # Lineages are in the order they were added, unset values are 0,
+        # and the last value set is kept.
+        self.assertEqual(rows, [
+            ("BA.1", [1.0, 0.5, 0.0]),
+            ("BA.5", [0.0, 0.5, 1.0]),
+            ("XBB", [0.0, 0.0, 0.0])
+        ])
+
+    def test_writeLineageMatrix_LineageMatrix(self):
+
+        # Creates data for test input
+        outfile = TEST_FILE_DIR + "/testOut"
+        samples = ["Sample1", "Sample2", "Sample3"]
+        matrix = LineageMatrix(samples)
+        matrix.setValue("BA.1", 0, 1.0)
+        matrix.setValue("BA.1", 1, 0.5)
+        matrix.setValue("BA.5", 1, 0.5)
+        matrix.setValue("BA.5", 2, 0.123456)
+
+        writeLineageMatrix(samples, matrix, outfile)
+
+        # Opens the output file and checks that it matches the matrix
+        f = open(outfile + ".csv", "r")
+        self.assertEqual(f.readline(), ",Sample1,Sample2,Sample3\n")
+        self.assertEqual(f.readline(), "BA.1,1.0,0.5,0.0\n")
+        self.assertEqual(f.readline(), "BA.5,0.0,0.5,0.1235\n")
+
+        # Closes the filestream and deletes the file.
+        f.close()
+        os.remove(outfile + ".csv")
+
+    def test_BarcodeMatrix_readCSV(self):
+        barcodes = BarcodeMatrix.readCSV(TEST_FILE_DIR + "/test-barcodes.csv", chunkSize=2)
+        df = pd.read_csv(TEST_FILE_DIR + "/test-barcodes.csv", header=0).set_index("Unnamed: 0")
+
+        # 9 mutations are packed into 2 bytes per lineage.
+        self.assertEqual(barcodes.bits.shape, (5, 2))
+        self.assertEqual(barcodes.lineages.tolist(), ["BA.1", "BA.2", "BA.1.1", "XBB", "BA.2.1"])
+        self.assertEqual(barcodes.floatColumns.tolist(), [True, True, True, False, True, True, True, True, True])
+        pd.testing.assert_frame_equal(barcodes.toDataFrame(), df)
+
+        self.assertTrue("BA.2" in barcodes)
+        self.assertFalse("BA.3" in barcodes)
+        self.assertEqual(barcodes.getMutations("XBB"), ["T12C", "A20G", "C21T", "T31A"])
+        self.assertEqual(barcodes.getMutations("BA.3"), None)
+
+    def test_BarcodeMatrix_writeCSV(self):
+        outfile = TEST_FILE_DIR + "/testOut.csv"
+        barcodes = BarcodeMatrix.readCSV(TEST_FILE_DIR + "/test-barcodes.csv")
+        df = pd.read_csv(TEST_FILE_DIR + "/test-barcodes.csv", header=0).set_index("Unnamed: 0")
+
+        # The file written should match the file written by pandas.
+        barcodes.writeCSV(outfile, chunkSize=2)
+        self.assertEqual(open(outfile).read(), df.to_csv())
+
+        os.remove(outfile)
+
+    def test_BarcodeMatrix_binary(self):
+        outfile = TEST_FILE_DIR + "/testOut.npz"
+        barcodes = BarcodeMatrix.readCSV(TEST_FILE_DIR + "/test-barcodes.csv")
+
+        barcodes.writeBinary(outfile)
+        binaryBarcodes = parseBarcodes(outfile)
+
+        self.assertEqual(binaryBarcodes.lineages.tolist(), barcodes.lineages.tolist())
+        self.assertEqual(binaryBarcodes.mutations.tolist(), barcodes.mutations.tolist())
+        self.assertEqual(binaryBarcodes.indexName, barcodes.indexName)
+        self.assertTrue((binaryBarcodes.bits == barcodes.bits).all())
+        self.assertTrue((binaryBarcodes.floatColumns == barcodes.floatColumns).all())
+
+        # Columns can be selected when reading either format.
+        selected = parseBarcodes(outfile, usecols=["Unnamed: 0", "C5T", "A40C"])
+        self.assertEqual(selected.mutations.tolist(), ["C5T", "A40C"])
+        self.assertEqual(selected.getMutations("BA.2"), ["C5T", "A40C"])
+
+        os.remove(outfile)
+
+    def test_BarcodeMatrix_select_and_group(self):
+        barcodes = BarcodeMatrix.readCSV(TEST_FILE_DIR + "/test-barcodes.csv")
+        df = pd.read_csv(TEST_FILE_DIR + "/test-barcodes.csv", header=0).set_index("Unnamed: 0")
+
+        subset = barcodes.selectLineages(barcodes.lineages != "XBB").selectMutations([0, 1, 3], chunkSize=2)
+        pd.testing.assert_frame_equal(subset.toDataFrame(), df.drop("XBB").iloc[:, [0, 1, 3]])
+
+        # Groups match pandas' groupby (sorted by barcode).
+        groups = df.groupby(df.columns.tolist()).groups
+        self.assertEqual(barcodes.groupIdentical(), [list(groups[k]) for k in groups.keys()])
+        self.assertEqual(barcodes.groupIdentical(), [["XBB"], ["BA.2", "BA.2.1"], ["BA.1", "BA.1.1"]])
+
+    def test_parseBarcodeCSV_cache(self):
+        cacheDir = TEST_FILE_DIR + "/barcode-cache"
+        os.makedirs(cacheDir, exist_ok=True)
+        barcodeFile = TEST_FILE_DIR + "/test-barcodes.csv"
+
+        # The first parse writes the barcodes to the cache.
+        key = getBarcodeCacheKey(barcodeFile)
+        self.assertEqual(readBarcodeCache(cacheDir, key), None)
+        barcodes = parseBarcodeCSV(barcodeFile, cacheDir=cacheDir)
+
+        # Later parses load the same barcodes from the cache.
+        cached = readBarcodeCache(cacheDir, key)
+        self.assertNotEqual(cached, None)
+        self.assertEqual(cached.lineages.tolist(), barcodes.lineages.tolist())
+        self.assertEqual(cached.mutations.tolist(), barcodes.mutations.tolist())
+        self.assertEqual(cached.indexName, barcodes.indexName)
+        self.assertTrue((cached.bits == barcodes.bits).all())
+        self.assertTrue((cached.floatColumns == barcodes.floatColumns).all())
+        pd.testing.assert_frame_equal(parseBarcodeCSV(barcodeFile, cacheDir=cacheDir).toDataFrame(), barcodes.toDataFrame())
+
+        # Reading a subset of the columns uses a different key.
+        usecols = ["Unnamed: 0", "C5T", "A40C"]
+        self.assertNotEqual(getBarcodeCacheKey(barcodeFile, usecols), key)
+        self.assertEqual(parseBarcodeCSV(barcodeFile, usecols, cacheDir).mutations.tolist(), ["C5T", "A40C"])
+        self.assertEqual(parseBarcodeCSV(barcodeFile, usecols, cacheDir).getMutations("BA.2"), ["C5T", "A40C"])
+
+        # A corrupted cache is ignored.
+        infoFile = getBarcodeCacheFiles(cacheDir, key)[1]
+        with open(infoFile, "w") as f:
+            f.write("{")
+        self.assertEqual(readBarcodeCache(cacheDir, key), None)
+
+        shutil.rmtree(cacheDir)
 
 if __name__ == "__main__":
     unittest.main(verbosity=2)
@@ -1,14 +1,20 @@
 import os
 import sys
 import shutil
+import tempfile
 
 import unittest
+from unittest import mock
 import subprocess as sp
 import pandas as pd
 
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
 TEST_FILE_DIR = SCRIPT_DIR + "/freyja-parse-test-files"
 
+sys.path.insert(0, SCRIPT_DIR + "/../bin/scripts")
+
+import parse_freyja
+
 # A quick function to read in a csv. Loops over every line in
 # the csv files and places the data into a list. Then returns a
 # master list containing all individual lists.
@@ -196,6 +202,183 @@ class TestFreyjaParser(unittest.TestCase):
             for f in files:
                 os.remove(os.path.join(root, f))
 
+    def test_script_valid_SGene_bySample_multipleJobs(self):
+        cmd="python3 {0}/../bin/scripts/parse_freyja.py -i {1}/inDir-SGene -o {1}/outDir -s {1}/sublin-map-sGene.tsv -m {1}/master-test.csv --jobs 2".format(SCRIPT_DIR, TEST_FILE_DIR)
+        sp.run(cmd, check=True, stdout=sp.PIPE, stderr=sys.stdout, shell=True)
+
+        # Parsing the files across multiple processes should produce the same output
+        # as a serial run.
+        outFiltered = readCSVToList(TEST_FILE_DIR + "/outDir/Filtered-dataframe.csv")
+        correctFiltered = readCSVToList(TEST_FILE_DIR + "/correctBySample-SGene/Filtered-dataframe.csv")
+        outUnfiltered = readCSVToList(TEST_FILE_DIR + "/outDir/Unfiltered-dataframe.csv")
+        correctUnfiltered = readCSVToList(TEST_FILE_DIR + "/correctBySample-SGene/Unfiltered-dataframe.csv")
+        outSite1Matrix = readCSVToList(TEST_FILE_DIR + "/outDir/Site-1-lineageMatrix.csv")
+        correctSite1Matrix = readCSVToList(TEST_FILE_DIR + "/correctBySample-SGene/Site-1-lineageMatrix.csv")
+        outSite2Matrix = readCSVToList(TEST_FILE_DIR + "/outDir/Site-2-lineageMatrix.csv")
+        correctSite2Matrix = readCSVToList(TEST_FILE_DIR + "/correctBySample-SGene/Site-2-lineageMatrix.csv")
+
+        self.assertEqual(outFiltered, correctFiltered)
+        self.assertEqual(outUnfiltered, correctUnfiltered)
+        self.assertEqual(outSite1Matrix, correctSite1Matrix)
+        self.assertEqual(outSite2Matrix, correctSite2Matrix)
+
+        for root, dirs, files in os.walk(TEST_FILE_DIR + "/outDir/"):
+            for f in files:
+                os.remove(os.path.join(root, f))
+
+    def test_script_valid_WholeGenome_byDate_combineAll(self):
+        cmd="python3 {0}/../bin/scripts/parse_freyja.py -i {1}/inDir-WholeGenome -o {1}/outDir -s {1}/sublin-map-whole-genome.tsv -m {1}/master-test.csv --byDate --combineAll".format(SCRIPT_DIR, TEST_FILE_DIR)
+        sp.run(cmd, check=True, stdout=sp.PIPE, stderr=sys.stdout, shell=True)
+
+        self.assertTrue(os.path.exists(TEST_FILE_DIR + "/outDir/All-lineageMatrix.csv"))
+
+        # The 'All' site is calculated from the same parsed data as the other
+        # sites, so the rows for the individual sites should be unchanged.
+        outFiltered = readCSVToList(TEST_FILE_DIR + "/outDir/Filtered-dataframe.csv")
+        correctFiltered = readCSVToList(TEST_FILE_DIR + "/correctByDate-WholeGenome/Filtered-dataframe.csv")
+        outUnfiltered = readCSVToList(TEST_FILE_DIR + "/outDir/Unfiltered-dataframe.csv")
+        correctUnfiltered = readCSVToList(TEST_FILE_DIR + "/correctByDate-WholeGenome/Unfiltered-dataframe.csv")
+        outSite1Matrix = readCSVToList(TEST_FILE_DIR + "/outDir/Site-1-lineageMatrix.csv")
+        correctSite1Matrix = readCSVToList(TEST_FILE_DIR + "/correctByDate-WholeGenome/Site-1-lineageMatrix.csv")
+
+        self.assertEqual([row for row in outFiltered if row[-1] != "All"], correctFiltered)
+        self.assertEqual([row for row in outUnfiltered if row[-1] != "All"], correctUnfiltered)
+        self.assertTrue(len([row for row in outFiltered if row[-1] == "All"]) > 0)
+        self.assertEqual(outSite1Matrix, correctSite1Matrix)
+
+        for root, dirs, files in os.walk(TEST_FILE_DIR + "/outDir/"):
+            for f in files:
+                os.remove(os.path.join(root, f))
+
+    def test_script_valid_SGene_bySample_cache(self):
+        cmd="python3 {0}/../bin/scripts/parse_freyja.py -i {1}/inDir-SGene -o {1}/outDir -s {1}/sublin-map-sGene.tsv -m {1}/master-test.csv --cache".format(SCRIPT_DIR, TEST_FILE_DIR)
+
+        # The first run parses every file and writes the cache. The second run
+        # loads every file from the cache and should produce the same output.
+        for run in range(2):
+            sp.run(cmd, check=True, stdout=sp.PIPE, stderr=sys.stdout, shell=True)
+
+            self.assertTrue(os.path.exists(TEST_FILE_DIR + "/outDir/demix-cache.json"))
+
+            outFiltered = readCSVToList(TEST_FILE_DIR + "/outDir/Filtered-dataframe.csv")
+            correctFiltered = readCSVToList(TEST_FILE_DIR + "/correctBySample-SGene/Filtered-dataframe.csv")
+            outUnfiltered = readCSVToList(TEST_FILE_DIR + "/outDir/Unfiltered-dataframe.csv")
+            correctUnfiltered = readCSVToList(TEST_FILE_DIR + "/correctBySample-SGene/Unfiltered-dataframe.csv")
+            outSite1Matrix = readCSVToList(TEST_FILE_DIR + "/outDir/Site-1-lineageMatrix.csv")
+            correctSite1Matrix = readCSVToList(TEST_FILE_DIR + "/correctBySample-SGene/Site-1-lineageMatrix.csv")
+
+            self.assertEqual(outFiltered, correctFiltered)
+            self.assertEqual(outUnfiltered, correctUnfiltered)
+            self.assertEqual(outSite1Matrix, correctSite1Matrix)
+
+        for root, dirs, files in os.walk(TEST_FILE_DIR + "/outDir/"):
+            for f in files:
+                os.remove(os.path.join(root, f))
+
+    def test_loadDemixFiles_cache(self):
+        # Copies the .demix files to a temporary directory so that they can be modified.
+        indir = tempfile.mkdtemp() + "/"
+        for f in os.listdir(TEST_FILE_DIR + "/inDir-SGene"):
+            shutil.copy(TEST_FILE_DIR + "/inDir-SGene/" + f, indir)
+
+        samples = ["sample1", "sample2", "sample3", "sample4"]
+        sampleToFile = {s: s for s in samples}
+        cache = {}
+
+        # The first load parses every file and stores them in the cache.
+        with mock.patch.object(parse_freyja, "parseDemix", wraps=parse_freyja.parseDemix) as parser:
+            expected = parse_freyja.loadDemixFiles(samples, indir, sampleToFile, cache=cache)
+            self.assertEqual(parser.call_count, 4)
+        self.assertEqual(sorted(cache.keys()), sorted(os.path.abspath(indir + s + ".demix") for s in samples))
+
+        # Unchanged files are loaded from the cache without being parsed.
+        with mock.patch.object(parse_freyja, "parseDemix", wraps=parse_freyja.parseDemix) as parser:
+            self.assertEqual(parse_freyja.loadDemixFiles(samples, indir, sampleToFile, cache=cache), expected)
+            parser.assert_not_called()
+
+        # A file whose size changed and a file whose modification time changed are parsed again.
+        with open(indir + "sample2.demix", "a") as f:
+            f.write("\n")
+        stat = os.stat(indir + "sample3.demix")
+        os.utime(indir + "sample3.demix", ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000000000))
+
+        with mock.patch.object(parse_freyja, "parseDemix", wraps=parse_freyja.parseDemix) as parser:
+            self.assertEqual(parse_freyja.loadDemixFiles(samples, indir, sampleToFile, cache=cache), expected)
+            self.assertEqual(sorted(c.args[0] for c in parser.call_args_list), [indir + "sample2.demix", indir + "sample3.demix"])
+        self.assertEqual(cache[os.path.abspath(indir + "sample2.demix")]["size"], os.stat(indir + "sample2.demix").st_size)
+
+        # A run on a subset of the samples keeps the entries of the other files.
+        with mock.patch.object(parse_freyja, "parseDemix", wraps=parse_freyja.parseDemix) as parser:
+            parse_freyja.loadDemixFiles(samples[:1], indir, sampleToFile, cache=cache)
+            parser.assert_not_called()
+        self.assertEqual(sorted(cache.keys()), sorted(os.path.abspath(indir + s + ".demix") for s in samples))
+
+        # The entries of a file that was removed and a file that changed (but was not
+        # loaded) are dropped from the cache.
+        os.remove(indir + "sample4.demix")
+        with open(indir + "sample3.demix", "a") as f:
+            f.write("\n")
+        with mock.patch.object(parse_freyja, "parseDemix", wraps=parse_freyja.parseDemix) as parser:
+            parse_freyja.loadDemixFiles(samples[:2], indir, sampleToFile, cache=cache)
+            parser.assert_not_called()
+        self.assertEqual(sorted(cache.keys()), sorted(os.path.abspath(indir + s + ".demix") for s in samples[:2]))
+
+        shutil.rmtree(indir)
+
+    def test_writeGroupedOutput_failure(self):
+        outdir = tempfile.mkdtemp() + "/"
+        indir = TEST_FILE_DIR + "/inDir-SGene/"
+        master = pd.read_csv(TEST_FILE_DIR + "/master-test.csv")
+        master = master[master["Sample"].isin(["sample1", "sample2", "sample3", "sample4"])]
+        demixData = parse_freyja.loadDemixFiles(master.Sample.tolist(), indir, {s: s for s in master.Sample})
+        abundanceTable = parse_freyja.buildAbundanceTable(demixData)
+        sublinMap = parse_freyja.data_manip_utils.parseSublinMap(TEST_FILE_DIR + "/sublin-map-sGene.tsv")
+
+        for outputFormat in ["csv", "parquet", "feather"]:
+            # The run fails after the dataframes have been partially written, so
+            # they should not be written at all.
+            with mock.patch.object(parse_freyja.data_manip_utils, "writeLineageMatrix", side_effect=RuntimeError("Failed")):
+                with self.assertRaises(RuntimeError):
+                    parse_freyja.writeGroupedOutput("Sample", ["Site-1", "Site-2"], master, demixData, abundanceTable, \
+                        outdir, 0.05, sublinMap, outputFormat)
+
+            self.assertEqual(os.listdir(outdir), [])
+
+            # Once the run succeeds, the dataframes are written.
+            parse_freyja.writeGroupedOutput("Sample", ["Site-1", "Site-2"], master, demixData, abundanceTable, \
+                outdir, 0.05, sublinMap, outputFormat)
+            self.assertTrue(os.path.exists(outdir + "Unfiltered-dataframe." + outputFormat))
+            self.assertTrue(os.path.exists(outdir + "Filtered-dataframe." + outputFormat))
+            self.assertFalse(any(f.endswith(".tmp") for f in os.listdir(outdir)))
+
+            for f in os.listdir(outdir):
+                os.remove(outdir + f)
+
+        shutil.rmtree(outdir)
+
+    def test_script_valid_WholeGenome_allGroupings(self):
+        cmd="python3 {0}/../bin/scripts/parse_freyja.py -i {1}/inDir-WholeGenome -o {1}/outDir -s {1}/sublin-map-whole-genome.tsv -m {1}/master-test.csv --allGroupings".format(SCRIPT_DIR, TEST_FILE_DIR)
+        sp.run(cmd, check=True, stdout=sp.PIPE, stderr=sys.stdout, shell=True)
+
+        # Each grouping should be written to its own subdirectory and match the
+        # output of a run with only that grouping.
+        for subdir, correctDir in [("by-sample", "correctBySample-WholeGenome"), \
+            ("by-date", "correctByDate-WholeGenome"), ("by-week", "correctByWeek-WholeGenome")]:
+            for f in ["Filtered-dataframe.csv", "Unfiltered-dataframe.csv", "Site-1-lineageMatrix.csv", "Site-2-lineageMatrix.csv"]:
+                out = readCSVToList(TEST_FILE_DIR + "/outDir/" + subdir + "/" + f)
+                correct = readCSVToList(TEST_FILE_DIR + "/" + correctDir + "/" + f)
+                self.assertEqual(out, correct)
+
+        shutil.rmtree(TEST_FILE_DIR + "/outDir/by-sample")
+        shutil.rmtree(TEST_FILE_DIR + "/outDir/by-date")
+        shutil.rmtree(TEST_FILE_DIR + "/outDir/by-week")
+
+    def test_script_invalid_allGroupings_byDate(self):
+        cmd="python3 {0}/../bin/scripts/parse_freyja.py -i {1}/inDir-WholeGenome -o {1}/outDir -s {1}/sublin-map-whole-genome.tsv -m {1}/master-test.csv --allGroupings --byDate".format(SCRIPT_DIR, TEST_FILE_DIR)
+
+        with self.assertRaises(sp.CalledProcessError):
+            sp.run(cmd, check=True, stdout=sp.PIPE, stderr=sp.PIPE, shell=True)
+
     """
     def test_script_valid_byDate(self):
         cmd="python3 {0}/../bin/scripts/parse_freyja.py -i {1}/inDir -o {1}/outDir -s {1}/sublin-test.csv -m {1}/master-test.csv --byDate".format(SCRIPT_DIR, TEST_FILE_DIR)
@@ -0,0 +1,75 @@
+import os
+import sys
+import io
+import shutil
+import tempfile
+import unittest
+import subprocess as sp
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+TEST_FILE_DIR = SCRIPT_DIR + "/lineage-query-test-files"
+TREE_UTILS_TEST_FILE_DIR = SCRIPT_DIR + "/tree-utils-test-files"
+
+sys.path.insert(0, SCRIPT_DIR + "/../bin/scripts")
+
+from lineage_query import answerQuery, loadLineageTree, runQueries
+
+class TestLineageQuery(unittest.TestCase):
+
+    def setUp(self):
+        # The module reads the lineage, alias, and clade files from a single directory,
+        # so the lineage file is placed in a temporary directory with the alias key and
+        # clade files used by the tree utility tests.
+        self.lineageDir = tempfile.mkdtemp() + "/"
+        shutil.copy(TEST_FILE_DIR + "/lineages.txt", self.lineageDir)
+        shutil.copy(TREE_UTILS_TEST_FILE_DIR + "/alias_key.json", self.lineageDir)
+        shutil.copy(TREE_UTILS_TEST_FILE_DIR + "/NSClades.json", self.lineageDir)
+
+    def tearDown(self):
+        shutil.rmtree(self.lineageDir)
+
+    def test_answerQuery(self):
+        tree, aliases = loadLineageTree(self.lineageDir, self.lineageDir, False)
+
+        self.assertEqual(answerQuery(tree, aliases, "ancestor", ["BA.2.1"]), "BA.2,B.1.1.529,B.1.1,B.1,B")
+        self.assertEqual(answerQuery(tree, aliases, "ancestor", ["B"]), "")
+        self.assertEqual(answerQuery(tree, aliases, "ancestor", ["GG.5"]), "None")
+        self.assertEqual(answerQuery(tree, aliases, "descendants", ["BA.2"]).split(",")[0], "BA.2.1")
+        self.assertEqual(answerQuery(tree, aliases, "descendants", ["BA.2.1"]), "")
+        self.assertEqual(answerQuery(tree, aliases, "lca", ["BA.1", "BA.2.1"]), "B.1.1.529")
+        self.assertEqual(answerQuery(tree, aliases, "lca", ["BA.1", "C.1.1", "GG.5"]), "B.1.1")
+        self.assertEqual(answerQuery(tree, aliases, "lca", ["GG.5"]), "None")
+        self.assertEqual(answerQuery(tree, aliases, "recombinant", ["XA.1"]), "True")
+        self.assertEqual(answerQuery(tree, aliases, "recombinant", ["BA.1"]), "False")
+        self.assertEqual(answerQuery(tree, aliases, "alias", ["BA.2.1"]), "B.1.1.529.2.1")
+        self.assertEqual(answerQuery(tree, aliases, "alias", ["B.1.1"]), "B.1.1")
+
+        # The tree is cached after it is built, and the cached tree is
+        # used to answer later queries.
+        self.assertTrue(os.path.exists(self.lineageDir + "lineage-tree.cache"))
+        cachedTree, aliases = loadLineageTree(self.lineageDir, self.lineageDir, False)
+        self.assertEqual(answerQuery(cachedTree, aliases, "ancestor", ["BA.2.1"]), "BA.2,B.1.1.529,B.1.1,B.1,B")
+
+    def test_runQueries(self):
+        tree, aliases = loadLineageTree(self.lineageDir, self.lineageDir, False)
+
+        queries = io.StringIO("# A comment\nlca BA.1 BA.2.1\n\nrecombinant XA.1,BA.1\nbogus B\n")
+        out = io.StringIO()
+
+        runQueries(tree, aliases, queries, out)
+
+        expected = ["Command\tQuery\tResult", "lca\tBA.1,BA.2.1\tB.1.1.529", "recombinant\tXA.1\tTrue", \
+            "recombinant\tBA.1\tFalse", "bogus\tB\tNone"]
+        self.assertEqual(out.getvalue().splitlines(), expected)
+
+    def test_script_stdin(self):
+        cmd = "python3 {0}/../bin/scripts/lineage_query.py -d {1} -o {1}test-answers.tsv".format(SCRIPT_DIR, self.lineageDir)
+        sp.run(cmd, check=True, input="ancestor C.1.1\nlca BA.1 C.1.1\n", stdout=sp.PIPE, stderr=sp.PIPE, shell=True, text=True)
+
+        answers = open(self.lineageDir + "test-answers.tsv").read().splitlines()
+
+        self.assertEqual(answers, ["Command\tQuery\tResult", "ancestor\tC.1.1\tC.1,B.1.1.1,B.1.1,B.1,B", "lca\tBA.1,C.1.1\tB.1.1"])
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
@@ -10,7 +10,7 @@ from treelib import Node, Tree
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
 TEST_FILE_DIR = SCRIPT_DIR + "/tree-utils-test-files"
 
-from bin.scripts.tree_utils import addLineagesToTree, addWithdrawnLineagesToTree, checkLineageExists, commonAncestor, convertLongAlias, getCommonLineageParent, getLineagesInTree, getParentLineage, getSubLineages, parseParentFromLineage
+from bin.scripts.tree_utils import AliasResolver, addLineagesToTree, addWithdrawnLineagesToTree, checkIfRecombinant, checkIfRecombinants, checkLineageExists, commonAncestor, convertLongAlias, getCommonLineageParent, getInsertionOrder, getLineagesInTree, getParentLineage, getSubLineages, isDescendant, iterSubLineages, parseParentFromLineage, LineageTree, LineageLCAIndex
 
 aliases = json.load(open(TEST_FILE_DIR + "/alias_key.json"))
 
@@ -283,6 +283,354 @@ class TestLineageTreeUtils(unittest.TestCase):
 
         self.assertEqual(invalidWithdrawn, ["GG.2"])
 
+    def test_LineageTree_queries(self):
+        t = LineageTree()
+        t.create_node("B", "B", parent="root")
+        t.create_node("B.1", "B.1", parent="B")
+        t.create_node("B.1.1", "B.1.1", parent="B.1")
+        t.create_node('B.1.2', "B.1.2", parent="B.1")
+        t.create_node("B.1.1.1", "B.1.1.1", parent="B.1.1")
+        t.create_node("B.2", "B.2", parent="B")
+        t.create_node("B.2.1", "B.2.1", parent="B.2")
+
+        self.assertTrue(checkLineageExists(t, "B.1.1"))
+        self.assertFalse(checkLineageExists(t, "A"))
+
+        self.assertEqual(getParentLineage(t, "B.1.1"), "B.1")
+        self.assertEqual(getParentLineage(t, "A"), None)
+
+        self.assertEqual(getSubLineages(t, "B"), ["B.1", "B.1.1", "B.1.1.1", "B.1.2", "B.2", "B.2.1"])
+        self.assertEqual(getSubLineages(t, "B.1.2"), None)
+        self.assertEqual(getSubLineages(t, "A"), None)
+
+        self.assertEqual(getLineagesInTree(t), ["root", "B", "B.1", "B.1.1", "B.1.1.1", "B.1.2", "B.2", "B.2.1"])
+
+        self.assertEqual(commonAncestor(t, "B.1.1.1", "B.1.2"), "B.1")
+        self.assertEqual(commonAncestor(t, "B.1.1", "B.2.1"), "B")
+
+        self.assertEqual(getCommonLineageParent(t, ["B.1.1.1", "B.1.1", "A"]), "B.1.1")
+        self.assertEqual(getCommonLineageParent(t, ["B.1.2", "B.2.1"]), "B")
+
+    def test_LineageTree_invalidAdd(self):
+        t = LineageTree()
+        t.addLineage("B", "root")
+
+        with self.assertRaises(ValueError):
+            t.addLineage("B", "root")
+        with self.assertRaises(ValueError):
+            t.addLineage("B.1", "A")
+
+    def test_LineageTree_matchesTreelib(self):
+        treelibTree = Tree()
+        treelibTree.create_node("root", "root")
+        treelibTree, invalid = addLineagesToTree(treelibTree, getLineageList(), aliases)
+        treelibTree, invalidWithdrawn = addWithdrawnLineagesToTree(treelibTree, getWithdrawnLines(), aliases, False)
+
+        arrayTree = LineageTree()
+        arrayTree, arrayInvalid = addLineagesToTree(arrayTree, getLineageList(), aliases)
+        arrayTree, arrayInvalidWithdrawn = addWithdrawnLineagesToTree(arrayTree, getWithdrawnLines(), aliases, False)
+
+        self.assertEqual(invalid, arrayInvalid)
+        self.assertEqual(invalidWithdrawn, arrayInvalidWithdrawn)
+        self.assertEqual(getLineagesInTree(treelibTree), getLineagesInTree(arrayTree))
+        for lin in getLineagesInTree(treelibTree)[1:]:
+            self.assertEqual(getParentLineage(treelibTree, lin), getParentLineage(arrayTree, lin))
+            self.assertEqual(getSubLineages(treelibTree, lin), getSubLineages(arrayTree, lin))
+
+    def test_LineageLCAIndex(self):
+        t = Tree()
+        t.create_node("root", "root")
+        t.create_node("B", "B", parent="root")
+        t.create_node("B.1", "B.1", parent="B")
+        t.create_node("B.1.1", "B.1.1", parent="B.1")
+        t.create_node('B.1.2', "B.1.2", parent="B.1")
+        t.create_node("B.1.1.1", "B.1.1.1", parent="B.1.1")
+        t.create_node("B.2", "B.2", parent="B")
+        t.create_node("B.2.1", "B.2.1", parent="B.2")
+        t.create_node("A", "A", parent="root")
+
+        index = LineageLCAIndex(t)
+
+        self.assertEqual(index.commonAncestor("B.1.1", "B.1.2"), "B.1")
+        self.assertEqual(index.commonAncestor("B.1.1.1", "B.1.1"), "B.1.1")
+        self.assertEqual(index.commonAncestor("B.1.1", "B.1.1"), "B.1.1")
+        self.assertEqual(index.commonAncestor("B.1.1", "B.2.1"), "B")
+        self.assertEqual(index.commonAncestor("B.2.1", "A"), "root")
+
+        self.assertEqual(getCommonLineageParent(t, ["B.1.1.1", "B.1.1", "C"], index), "B.1.1")
+        self.assertEqual(getCommonLineageParent(t, ["B.1", "C", "B.1.2"], index), "B.1")
+        self.assertEqual(getCommonLineageParent(t, ["B.1.2", "B.2.1", "B.1.1.1"], index), "B")
+        self.assertEqual(getCommonLineageParent(t, ["C", "D"], index), "None")
+
+    def test_getCommonLineageParent_largeGroup(self):
+        # Builds a single chain of lineages deeper than Python's
+        # recursion limit.
+        t = LineageTree()
+        chain = ["L{0}".format(i) for i in range(3000)]
+        t.addLineage(chain[0], "root")
+        for i in range(1, len(chain)):
+            t.addLineage(chain[i], chain[i - 1])
+        t.addLineage("Other", "root")
+
+        index = LineageLCAIndex(t)
+
+        self.assertEqual(getCommonLineageParent(t, chain[::-1]), "L0")
+        self.assertEqual(getCommonLineageParent(t, chain[1000:], index), "L1000")
+        self.assertEqual(getCommonLineageParent(t, chain + ["Other"], index), "root")
+
+    def test_isDescendant(self):
+        for t in [Tree(), LineageTree()]:
+            if isinstance(t, Tree):
+                t.create_node("root", "root")
+            t.create_node("B", "B", parent="root")
+            t.create_node("B.1", "B.1", parent="B")
+            t.create_node("B.1.1", "B.1.1", parent="B.1")
+            t.create_node("B.2", "B.2", parent="B")
+
+            self.assertTrue(isDescendant(t, "B.1.1", "B"))
+            self.assertTrue(isDescendant(t, "B.1.1", "B.1"))
+            self.assertTrue(isDescendant(t, "B", "root"))
+            self.assertFalse(isDescendant(t, "B.1.1", "B.2"))
+            self.assertFalse(isDescendant(t, "B", "B.1"))
+            self.assertFalse(isDescendant(t, "B.1", "B.1"))
+            self.assertFalse(isDescendant(t, "A", "B"))
+            self.assertFalse(isDescendant(t, "B.1", "A"))
+
+    def test_LineageTree_numberingUpdatesOnAdd(self):
+        t = LineageTree()
+        t.addLineage("B", "root")
+        t.addLineage("B.1", "B")
+        t.addLineage("B.2", "B")
+
+        self.assertEqual(getSubLineages(t, "B"), ["B.1", "B.2"])
+        self.assertFalse(isDescendant(t, "B.1.1", "B"))
+
+        # Adding a lineage after a query must be reflected in
+        # later queries.
+        t.addLineage("B.1.1", "B.1")
+
+        self.assertEqual(getSubLineages(t, "B"), ["B.1", "B.1.1", "B.2"])
+        self.assertEqual(getSubLineages(t, "B.1"), ["B.1.1"])
+        self.assertTrue(isDescendant(t, "B.1.1", "B"))
+
+    def test_AliasResolver_matchesDict(self):
+        resolver = AliasResolver(aliases)
+
+        for lin in ["B.1.1.529.1", "B.1.1.529.5.3.1.5", "B.2.2.2.2", "B.2.2.2.2.2.2.2"]:
+            self.assertEqual(convertLongAlias(lin, resolver), convertLongAlias(lin, aliases))
+
+        for lin in ["B", "B.1", "B.1.117.3", "BA.1", "BE.1", "CW.1", "GG.5", "XA", "XA.1"]:
+            self.assertEqual(parseParentFromLineage(lin, resolver), parseParentFromLineage(lin, aliases))
+            self.assertEqual(checkIfRecombinant(lin, resolver), checkIfRecombinant(lin, aliases))
+
+    def test_AliasResolver_recombinantAlias(self):
+        resolver = AliasResolver({"B": "", "BA": "B.1.1.529", "XBB": ["BJ.1", "BM.1.1.1"], "EG": "XBB.1.9.2"})
+
+        self.assertTrue(resolver.isRecombinant("XBB.1.5"))
+        self.assertTrue(resolver.isRecombinant("EG.5.1"))
+        self.assertFalse(resolver.isRecombinant("BA.2"))
+        self.assertFalse(resolver.isRecombinant("B.1"))
+
+        self.assertEqual(resolver.parent("EG.1"), "XBB.1.9.2")
+        self.assertEqual(resolver.parent("XBB.1"), "XBB")
+
+    def test_AliasResolver_dealias(self):
+        resolver = AliasResolver(aliases)
+
+        self.assertEqual(resolver.dealias("BA.5.1"), "B.1.1.529.5.1")
+        self.assertEqual(resolver.dealias("BA"), "B.1.1.529")
+        self.assertEqual(resolver.dealias("B.1.1"), "B.1.1")
+        self.assertEqual(resolver.dealias("XA.1"), "XA.1")
+        self.assertEqual(resolver.dealias("GG.5"), "GG.5")
+
+    def test_addLineagesToTree_aliasResolver(self):
+        lineages = ["BA.5", "LL.5", "B.1", "XA", "B.2", "B.1.1.529", "XC", "B.3", "B.1.1", "B", "F.1", "XA.1"]
+
+        t = LineageTree()
+
+        t, invalid = addLineagesToTree(t, lineages, AliasResolver(aliases))
+
+        self.assertEqual(getParentLineage(t, "BA.5"), "B.1.1.529")
+        self.assertEqual(getParentLineage(t, "XA.1"), "XA")
+        self.assertEqual(invalid, ["LL.5", "F.1"])
+
+    def test_getInsertionOrder(self):
+        t = LineageTree()
+        t.addLineage("B", "root")
+
+        lineages = ["B.1.1", "B.2", "B.1", "B.1.1.1", "C.1", "C.1.1"]
+        parents = ["B.1", "B", "B", "B.1.1", "C", "C.1"]
+
+        order, unplaceable = getInsertionOrder(t, lineages, parents)
+
+        # B.2 and B.1 can be added in the first pass (B.1.1 came before B.1 so
+        # it is added in the second pass, followed by its child).
+        self.assertEqual(order, [("B.2", "B"), ("B.1", "B"), ("B.1.1", "B.1"), ("B.1.1.1", "B.1.1")])
+        self.assertEqual(unplaceable, ["C.1", "C.1.1"])
+
+    def test_addLineagesToTree_unplaceable(self):
+        lineages = ["B", "B.1.7.3", "B.1.7.3.1", "B.2", "GG.5"]
+
+        t = LineageTree()
+
+        t, invalid = addLineagesToTree(t, lineages, aliases)
+
+        self.assertEqual(getLineagesInTree(t), ["root", "B", "B.2"])
+        self.assertEqual(invalid, ["GG.5", "B.1.7.3", "B.1.7.3.1"])
+
+    def test_LineageTree_bytesRoundTrip(self):
+        t = LineageTree()
+        t, invalid = addLineagesToTree(t, getLineageList(), aliases)
+        t, invalidWithdrawn = addWithdrawnLineagesToTree(t, getWithdrawnLines(), aliases, False)
+
+        restored = LineageTree.fromBytes(t.toBytes())
+
+        self.assertEqual(len(restored), len(t))
+        self.assertEqual(getLineagesInTree(restored), getLineagesInTree(t))
+        for lin in t.names:
+            self.assertEqual(getParentLineage(restored, lin), getParentLineage(t, lin))
+            self.assertEqual(getSubLineages(restored, lin), getSubLineages(t, lin))
+
+        with self.assertRaises(ValueError):
+            LineageTree.fromBytes(t.toBytes()[:-4])
+
+    def test_LineageTree_moveLineage(self):
+        t = LineageTree()
+        t.addLineage("B", "root")
+        t.addLineage("B.1", "B")
+        t.addLineage("B.1.1", "B.1")
+        t.addLineage("B.2", "B")
+        t.addLineage("B.2.1", "B.2")
+
+        # Numbers the tree before the move to make sure the numbering is reset.
+        self.assertTrue(isDescendant(t, "B.1.1", "B.1"))
+
+        t.moveLineage("B.1", "B.2.1")
+
+        self.assertEqual(getParentLineage(t, "B.1"), "B.2.1")
+        self.assertEqual(t.getDepth("B.1.1"), 5)
+        self.assertEqual(getSubLineages(t, "B.2"), ["B.2.1", "B.1", "B.1.1"])
+        self.assertTrue(isDescendant(t, "B.1.1", "B.2"))
+
+        # A lineage cannot be moved under one of its own sublineages.
+        with self.assertRaises(ValueError):
+            t.moveLineage("B.2", "B.1.1")
+        with self.assertRaises(ValueError):
+            t.moveLineage("GG.5", "B")
+
+    def test_LineageTree_removeLineage(self):
+        t = LineageTree()
+        t.addLineage("B", "root")
+        t.addLineage("B.1", "B")
+        t.addLineage("B.2", "B")
+
+        t.removeLineage("B.1")
+
+        self.assertFalse(checkLineageExists(t, "B.1"))
+        self.assertEqual(getLineagesInTree(t), ["root", "B", "B.2"])
+        self.assertEqual(len(t), 3)
+
+        # The lineage can be added back afterward.
+        t.addLineage("B.1", "B.2")
+        self.assertEqual(getParentLineage(t, "B.1"), "B.2")
+
+        # Lineages with sublineages cannot be removed.
+        with self.assertRaises(ValueError):
+            t.removeLineage("B")
+        with self.assertRaises(ValueError):
+            t.removeLineage("B.1.1")
+
+    def test_LineageTree_sortChildren(self):
+        t = LineageTree()
+        t.addLineage("B", "root")
+        t.addLineage("B.2", "B")
+        t.addLineage("B.1", "B")
+        t.addLineage("B.1.1", "B.1")
+        t.addLineage("B.3", "B")
+
+        # Numbers the tree before sorting to make sure the numbering is reset.
+        self.assertEqual(getSubLineages(t, "B"), ["B.2", "B.1", "B.1.1", "B.3"])
+
+        t.sortChildren("B", lambda lin: lin)
+
+        self.assertEqual(getSubLineages(t, "B"), ["B.1", "B.1.1", "B.2", "B.3"])
+
+        # New children are still added after the last child.
+        t.addLineage("B.4", "B")
+        self.assertEqual(getSubLineages(t, "B"), ["B.1", "B.1.1", "B.2", "B.3", "B.4"])
+
+    def test_getInsertionOrder_exists(self):
+        t = LineageTree()
+        t.addLineage("B", "root")
+        t.addLineage("B.1", "B")
+
+        # B.1 is in the tree, but is being placed again, so it cannot be
+        # used as a parent until it has been placed.
+        order, unplaceable = getInsertionOrder(t, ["B.1.1", "B.1"], ["B.1", "B"], \
+            exists=lambda lin: lin in ["root", "B"])
+
+        self.assertEqual(order, [("B.1", "B"), ("B.1.1", "B.1")])
+        self.assertEqual(unplaceable, [])
+
+    def test_iterSubLineages(self):
+        t = Tree()
+        t.create_node("root", "root")
+        t.create_node("B", "B", parent="root")
+        t.create_node("B.1", "B.1", parent="B")
+        t.create_node("B.1.1", "B.1.1", parent="B.1")
+        t.create_node("B.1.1.1", "B.1.1.1", parent="B.1.1")
+        t.create_node("B.2", "B.2", parent="B")
+
+        lt = LineageTree()
+        for lin in ["B", "B.1", "B.1.1", "B.1.1.1", "B.2"]:
+            lt.addLineage(lin, getParentLineage(t, lin))
+
+        for tree in [t, lt]:
+            self.assertEqual(list(iterSubLineages(tree, "B")), ["B.1", "B.1.1", "B.1.1.1", "B.2"])
+            self.assertEqual(list(iterSubLineages(tree, "B", includeRoot=True)), ["B", "B.1", "B.1.1", "B.1.1.1", "B.2"])
+            self.assertEqual(list(iterSubLineages(tree, "B", maxDepth=1)), ["B.1", "B.2"])
+            self.assertEqual(list(iterSubLineages(tree, "B", maxDepth=2)), ["B.1", "B.1.1", "B.2"])
+            self.assertEqual(list(iterSubLineages(tree, "B", maxDepth=0, includeRoot=True)), ["B"])
+            self.assertEqual(list(iterSubLineages(tree, "B.2")), [])
+            self.assertEqual(list(iterSubLineages(tree, "A", includeRoot=True)), [])
+
+    def test_getSubLineages_deepTree(self):
+        # A chain of lineages deeper than python's recursion limit.
+        depth = sys.getrecursionlimit() + 100
+
+        t = Tree()
+        t.create_node("root", "root")
+        lt = LineageTree()
+
+        parent = "root"
+        for i in range(depth):
+            t.create_node(str(i), str(i), parent=parent)
+            lt.addLineage(str(i), parent)
+            parent = str(i)
+
+        for tree in [t, lt]:
+            subLins = getSubLineages(tree, "0")
+            self.assertEqual(len(subLins), depth - 1)
+            self.assertEqual(subLins[-1], str(depth - 1))
+
+    def test_checkIfRecombinants(self):
+        recombAliases = {"B": "", "BA": "B.1.1.529", "XBB": ["BJ.1", "BM.1.1.1"], "EG": "XBB.1.9.2"}
+        lins = ["XBB.1.5", "EG.5.1", "BA.2", "B.1", "EG", "XA", "GG.5"]
+
+        expected = [True, True, False, False, True, True, False]
+        self.assertEqual(checkIfRecombinants(lins, recombAliases).tolist(), expected)
+        self.assertEqual(checkIfRecombinants(lins, AliasResolver(recombAliases)).tolist(), expected)
+
+        # A Series with a non-default index gives the same results in the same order.
+        series = pd.Series(lins, index=range(10, 10 + len(lins)))
+        self.assertEqual(checkIfRecombinants(series, recombAliases).tolist(), expected)
+
+        # Matches checking each lineage individually.
+        testLins = getLineageList()
+        self.assertEqual(checkIfRecombinants(testLins, aliases).tolist(), [checkIfRecombinant(lin, aliases) for lin in testLins])
+
+        self.assertEqual(checkIfRecombinants([], aliases).tolist(), [])
+
 
 if __name__ == "__main__":
     unittest.main(verbosity=2)
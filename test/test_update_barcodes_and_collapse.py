@@ -4,21 +4,35 @@ from dis import findlinestarts
 import os
 from re import A
 import sys
+import json
+import shutil
+import tempfile
 from tabnanny import check
 
 import unittest
+import numpy as np
 import pandas as pd
 import subprocess as sp
+from unittest import mock
 from treelib import Node, Tree
 
 from bin.scripts.data_manip_utils import parseSublinMap, findLineageGroup
 
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)) + "/../bin/scripts")
+
+from data_manip_utils import BarcodeMatrix
+from tree_utils import getLineagesInTree, getParentLineage, getSubLineages
+import update_barcodes_and_collapse
+from update_barcodes_and_collapse import buildLineageTree, getLineageTreeCacheKey, getMutPos, getMutPositions, getSGeneColumns, readLineageTreeCache, \
+    updateLineageTree, writeGroupedBarcodes, writeLineageTreeChanges
+
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
 TEST_FILE_DIR = SCRIPT_DIR + "/update-barcodes-and-collapse-test-files"
+TREE_FILE_DIR = SCRIPT_DIR + "/tree-utils-test-files"
 
 def cleanUpFiles():
     FilesToRemove = ["S_Gene_barcodes.csv", "S_Gene_Unfiltered.csv", "S-Gene-Indistinguishable-Groups.txt", "sublineage-map.tsv", "filtered_barcodes.csv", "public-latest.all.masked.pb.gz", \
-                        "alias_key.json", "lineages.txt", "NSClades.json", "raw_barcodes.csv", "curated_lineages.json"]
+                        "alias_key.json", "lineages.txt", "NSClades.json", "raw_barcodes.csv", "curated_lineages.json", "lineage-tree.cache", "lineage-tree-changes.tsv"]
 
     for f in FilesToRemove:
         fp = TEST_FILE_DIR + "/" + f
@@ -281,5 +295,197 @@ class TestSGeneBarcodeParser(unittest.TestCase):
         #os.remove(TEST_FILE_DIR + "/S_Gene_Unfiltered.csv")
         #os.remove(TEST_FILE_DIR + "/LineageGroups.txt")
 
+class TestSGeneColumns(unittest.TestCase):
+
+    def test_getMutPositions(self):
+        mutations = ["A21563G", "C100T", "T25384A", "G30000C"]
+
+        self.assertEqual(getMutPositions(mutations).tolist(), [getMutPos(m) for m in mutations])
+
+    def test_getSGeneColumns(self):
+        columns = ["Unnamed: 0", "A21562G", "A21563G", "C22000T", "T25384A", "G25385C", "C100T"]
+
+        self.assertEqual(getSGeneColumns(columns), ["Unnamed: 0", "A21563G", "C22000T", "T25384A"])
+
+        # Matches dropping each column outside of the S gene from the test barcodes.
+        df = pd.read_csv(TEST_FILE_DIR + "/test-input-barcodes.csv", header=0)
+        expected = df
+        for column in df:
+            if column != "Unnamed: 0" and (getMutPos(column) < 21563 or getMutPos(column) > 25384):
+                expected = expected.drop(column, axis=1)
+
+        self.assertEqual(getSGeneColumns(df.columns), list(expected.columns))
+
+class TestGroupIdenticalBarcodes(unittest.TestCase):
+
+    def test_groupIdentical(self):
+        values = np.array([[1, 0], [0, 1], [1, 0], [0, 0], [1, 1]])
+        barcodes = BarcodeMatrix(np.packbits(values == 1, axis=1), ["BA.2", "BA.1", "BA.2.1", "B", "BA.5"], ["A1G", "C2T"])
+
+        # Groups are sorted by mutation profile, with the lineages in their
+        # original order.
+        self.assertEqual(barcodes.groupIdentical(), [["B"], ["BA.1"], ["BA.2", "BA.2.1"], ["BA.5"]])
+
+    def test_groupIdentical_matchesGroupby(self):
+        df = pd.read_csv(TEST_FILE_DIR + "/test-input-barcodes.csv", header=0).set_index("Unnamed: 0")
+        barcodes = BarcodeMatrix.readCSV(TEST_FILE_DIR + "/test-input-barcodes.csv")
+
+        groups = df.groupby(df.columns.values.tolist()).groups
+        expected = [list(groups[k].values) for k in groups.keys()]
+
+        self.assertEqual(barcodes.groupIdentical(), expected)
+
+    def test_writeGroupedBarcodes(self):
+        df = pd.read_csv(TEST_FILE_DIR + "/test-input-barcodes.csv", header=0).set_index("Unnamed: 0")
+        barcodes = BarcodeMatrix.readCSV(TEST_FILE_DIR + "/test-input-barcodes.csv")
+
+        groups = barcodes.groupIdentical()
+        labels = ["Group_{0}".format(i) for i in range(len(groups))]
+        rows = [barcodes.getLineageRows()[g[0]] for g in groups]
+
+        # The output should match a dataframe built row by row.
+        expected = pd.DataFrame(columns=[''] + df.columns.tolist())
+        for label, g in zip(labels, groups):
+            expected.loc[len(expected.index)] = [label] + df.loc[g[0],:].values.tolist()
+
+        outFile = TEST_FILE_DIR + "/test-grouped-barcodes.csv"
+        writeGroupedBarcodes(outFile, barcodes, labels, rows, chunkSize=7)
+        self.assertEqual(open(outFile).read(), expected.to_csv(index=False))
+
+        os.remove(outFile)
+
+def getLineageLines():
+    lines = []
+    for f in ["/test-lineages.txt", "/test-withdrawn.txt"]:
+        with open(TREE_FILE_DIR + f, "r") as lineageFile:
+            lines.extend(line.strip() + "\n" for line in lineageFile)
+
+    return lines
+
+class TestUpdateLineageTree(unittest.TestCase):
+
+    def setUp(self):
+        self.lines = getLineageLines()
+        self.aliases = json.load(open(TREE_FILE_DIR + "/alias_key.json"))
+        self.nsclades = json.load(open(TREE_FILE_DIR + "/NSClades.json"))
+
+    def assertMatchesBuild(self, newLines, newAliases, oldLines=None):
+        """ Updates a tree built from the old files to the new files and checks that it
+        matches a tree built from the new files. Returns the list of changes.
+        """
+        if oldLines == None:
+            oldLines = self.lines
+
+        tree = buildLineageTree(oldLines, self.aliases, self.nsclades, False)
+        updated, changes = updateLineageTree(tree, oldLines, newLines, self.aliases, newAliases, self.nsclades, False)
+        expected = buildLineageTree(newLines, newAliases, self.nsclades, False)
+
+        # The sublineages are listed depth-first with children in the order they were added, so
+        # this also checks the order of each lineage's children.
+        self.assertEqual(getSubLineages(updated, "root"), getSubLineages(expected, "root"))
+        for lin in getLineagesInTree(expected):
+            self.assertEqual(getParentLineage(updated, lin), getParentLineage(expected, lin))
+        self.assertEqual(updated.invalid, expected.invalid)
+
+        return changes
+
+    def test_updateLineageTree_added(self):
+        # B.2 is listed before its parent and B.1.2 before its sibling B.1.1, so
+        # they should not simply be placed after the existing children.
+        newLines = ["B.2\n"] + self.lines[:2] + ["B.1.2\n"] + self.lines[2:]
+
+        changes = self.assertMatchesBuild(newLines, self.aliases)
+
+        # The withdrawn lineages B.2.1 and B.2.6 are now placed under their parent, and the clade
+        # 20G (B.1.2) is named after its clade number and placed under B.1.2 now that it exists.
+        self.assertEqual(changes, [("added", "20G", None, "B.1.2"), ("added", "B.1.2", None, "B.1"), ("added", "B.2", None, "B"), \
+            ("reparented", "B.2.1", "B.40", "B.2"), ("reparented", "B.2.6", "B.35", "B.2"), ("removed", "20G(B.1.2)", "20C", None)])
+
+    def test_updateLineageTree_withdrawnWithSublineages(self):
+        newLines = [line if line != "B.1.1.1\n" else "*B.1.1.1\tWithdrawn: Reassigned to B.3\n" for line in self.lines]
+
+        changes = self.assertMatchesBuild(newLines, self.aliases)
+
+        # C.1 (an alias of B.1.1.1.1) and its sublineage can no longer be placed.
+        self.assertEqual(changes, [("withdrawn", "B.1.1.1", "B.1.1", "B.1.1"), \
+            ("removed", "C.1", "B.1.1.1", None), ("removed", "C.1.1", "C.1", None)])
+
+    def test_updateLineageTree_aliasChanged(self):
+        newAliases = dict(self.aliases)
+        newAliases["C"] = "B.35"
+
+        changes = self.assertMatchesBuild(self.lines, newAliases)
+
+        self.assertEqual(changes, [("reparented", "C.1", "B.1.1.1", "B.35"), ("reparented", "C.15", "B.1.1.1", "B.35")])
+
+    def test_updateLineageTree_previouslyUnplaceable(self):
+        oldLines = ["B.5.1\n"] + self.lines
+        newLines = oldLines + ["B.5\n"]
+
+        changes = self.assertMatchesBuild(newLines, self.aliases, oldLines)
+
+        self.assertEqual(changes, [("added", "B.5", None, "B"), ("added", "B.5.1", None, "B.5")])
+
+    def test_writeLineageTreeChanges(self):
+        outDir = tempfile.mkdtemp()
+        changeFile = outDir + "/lineage-tree-changes.tsv"
+
+        writeLineageTreeChanges(changeFile, [("added", "B.5", None, "B"), ("reparented", "C.1", "B.1.1.1", "B.35"), \
+            ("removed", "C.1.1", "C.1", None)])
+
+        self.assertEqual(open(changeFile).read(), "Change\tLineage\tPrevious Parent\tNew Parent\n" \
+            + "added\tB.5\t\tB\n" + "reparented\tC.1\tB.1.1.1\tB.35\n" + "removed\tC.1.1\tC.1\t\n")
+
+        shutil.rmtree(outDir)
+
+    def test_main_updatesPreviousTree(self):
+        newLines = ["B.2\n"] + self.lines[:2] + ["B.1.2\n"] + self.lines[2:]
+        newAliases = dict(self.aliases)
+        newAliases["C"] = "B.35"
+
+        inputDir = tempfile.mkdtemp()
+        for name, lines, aliases in [("old", self.lines, self.aliases), ("new", newLines, newAliases)]:
+            os.makedirs(inputDir + "/" + name)
+            with open(inputDir + "/" + name + "/lineage_notes.txt", "w") as f:
+                f.write("Lineage\tDescription\n" + "".join(lines))
+            json.dump(aliases, open(inputDir + "/" + name + "/alias_key.json", "w"))
+            shutil.copy(TREE_FILE_DIR + "/NSClades.json", inputDir + "/" + name + "/clades.json")
+
+        def runMain(inputFiles, outdir):
+            # The lineage files are copied from the input directory rather than downloaded.
+            download = lambda url, dest: shutil.copy(inputFiles + "/" + url.split("/")[-1], dest)
+            argv = ["update_barcodes_and_collapse.py", "-i", TEST_FILE_DIR + "/test-input-barcodes.csv", "-o", outdir, \
+                "-c", TEST_FILE_DIR + "/test-collapse.tsv"]
+            with mock.patch.object(update_barcodes_and_collapse.ur, "urlretrieve", side_effect=download), \
+                mock.patch.object(sys, "argv", argv), \
+                mock.patch.object(update_barcodes_and_collapse, "updateLineageTree", wraps=updateLineageTree) as update:
+                update_barcodes_and_collapse.main()
+            return update.call_count
+
+        # The second run updates the tree left by the first run.
+        updatedDir = tempfile.mkdtemp()
+        self.assertEqual(runMain(inputDir + "/old", updatedDir), 0)
+        self.assertEqual(runMain(inputDir + "/new", updatedDir), 1)
+
+        freshDir = tempfile.mkdtemp()
+        self.assertEqual(runMain(inputDir + "/new", freshDir), 0)
+
+        self.assertEqual(open(updatedDir + "/lineage-tree-changes.tsv").read().splitlines(), ["Change\tLineage\tPrevious Parent\tNew Parent", \
+            "added\t20G\t\tB.1.2", "added\tB.1.2\t\tB.1", "added\tB.2\t\tB", "reparented\tB.2.1\tB.40\tB.2", "reparented\tB.2.6\tB.35\tB.2", \
+            "reparented\tC.1\tB.1.1.1\tB.35", "reparented\tC.15\tB.1.1.1\tB.35", "removed\t20G(B.1.2)\t20C\t"])
+        self.assertFalse(os.path.exists(freshDir + "/lineage-tree-changes.tsv"))
+
+        # The updated tree is cached and matches the tree built from scratch.
+        treeInputFiles = [updatedDir + "/lineages.txt", updatedDir + "/alias_key.json", updatedDir + "/NSClades.json"]
+        cached = readLineageTreeCache(updatedDir + "/lineage-tree.cache", getLineageTreeCacheKey(treeInputFiles, False))
+        expected = buildLineageTree(newLines, newAliases, self.nsclades, False)
+        self.assertEqual(getSubLineages(cached, "root"), getSubLineages(expected, "root"))
+        self.assertEqual(cached.invalid, expected.invalid)
+
+        self.assertEqual(open(updatedDir + "/sublineage-map.tsv").read(), open(freshDir + "/sublineage-map.tsv").read())
+
+        for d in [inputDir, updatedDir, freshDir]:
+            shutil.rmtree(d)
+
 if __name__ == "__main__":
     unittest.main(verbosity=2)